@@ -0,0 +1,388 @@
+import argparse
+import json
+import math
+import os
+from datetime import datetime, timedelta
+
+from fields import parse_adv_id, MISSING
+from mongoconnect import read_chunks
+from normalise import EUR_TO_BGN
+from parquet_writer import to_float, to_timestamp
+
+# Market aggregates kept up to date as records are ingested, so questions like
+# "median price per sqm in Кършияка for 2-СТАЕН" are a dictionary lookup
+# instead of a regroup of the whole history. Each
+# (city, neighbourhood, property type, period) key holds count, sum, min,
+# max and a quantile sketch of price, size and price per sqm. Every ad
+# also goes into the key's ALL_PERIODS total, once however often its
+# Publish Date month changes. Records without a Publish Date go into
+# UNKNOWN_PERIOD.
+#
+# The ads already counted are remembered for SEEN_RETENTION_DAYS after a run
+# last met them; an ad that comes back after that is counted again.
+#
+# Stores saved by separate runs (shards) merge by adding up their
+# summaries. Each remembered ad keeps the values it contributed, so an ad
+# both stores counted (consecutive runs share most of their ads) is taken
+# back out of the merged sums once:
+#
+#   python aggregates.py ingest aggregates.json properties.csv
+#   python aggregates.py merge aggregates.json shard-1.json shard-2.json
+#   python aggregates.py query aggregates.json Пловдив Кършияка "Продава 2-СТАЕН"
+
+DEFAULT_AGGREGATES_PATH = 'aggregates.json'
+
+# Records are grouped by the month of their Publish Date
+PERIOD_FORMAT = '%Y-%m'
+ALL_PERIODS = '*'
+UNKNOWN_PERIOD = 'unknown'
+
+# Days an ad is remembered as counted after the last run that met it
+SEEN_RETENTION_DAYS = 90
+
+# Quantiles are accurate to within this relative error
+RELATIVE_ACCURACY = 0.01
+
+METRICS = ('price_bgn', 'size', 'price_per_sqm_bgn')
+
+
+# Mergeable quantile sketch with relative error guarantees. Positive values
+# are counted in logarithmic buckets (bucket i covers gamma^(i-1)..gamma^i),
+# so two sketches merge exactly by adding their bucket counts.
+class QuantileSketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value):
+        if value <= 0:
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def remove(self, value):
+        if value <= 0:
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        if self.buckets.get(index):
+            self.buckets[index] -= 1
+            if not self.buckets[index]:
+                del self.buckets[index]
+            self.count -= 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return None
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'buckets': self.buckets}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'])
+        sketch.buckets = {int(index): count for index, count in data['buckets'].items()}
+        sketch.count = sum(sketch.buckets.values())
+        return sketch
+
+
+# count / sum / min / max plus a quantile sketch for one metric
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    # Function to take a value back out; min and max can't be undone, so
+    # they keep it (it was still a real value of that ad)
+    def remove(self, value):
+        self.count -= 1
+        self.total -= value
+        self.sketch.remove(value)
+        if not self.count:
+            self.total = 0.0
+            self.min = self.max = None
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.sketch.merge(other.sketch)
+
+    def describe(self):
+        # Sketch estimates are clamped to the exact min/max
+        def quantile(q):
+            value = self.sketch.quantile(q)
+            return None if value is None else min(max(value, self.min), self.max)
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'p25': quantile(0.25),
+            'median': quantile(0.5),
+            'p75': quantile(0.75),
+            'max': self.max,
+        }
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+                'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.count, summary.total = data['count'], data['sum']
+        summary.min, summary.max = data['min'], data['max']
+        summary.sketch = QuantileSketch.from_dict(data['sketch'])
+        return summary
+
+
+# Function to split "град Пловдив, Кършияка" into ('Пловдив', 'Кършияка')
+def parse_location(location):
+    if not location or location == MISSING:
+        return MISSING, MISSING
+    city, _, neighbourhood = str(location).partition(',')
+    city = city.strip()
+    for prefix in ('град ', 'гр. ', 'село ', 'с. '):
+        if city.startswith(prefix):
+            city = city[len(prefix):]
+    return city, neighbourhood.strip() or MISSING
+
+
+def to_bgn(amount, currency):
+    if amount is None:
+        return None
+    return amount * EUR_TO_BGN if str(currency).startswith('EUR') else amount
+
+
+# Function to pull the metric values out of a scraped record (raw or typed)
+def record_metrics(record):
+    price_bgn = to_bgn(to_float(record.get('Price')), record.get('Currency'))
+    size = to_float(record.get('Size'))
+    sqm_text = str(record.get('Price per sqm') or '')
+    sqm_currency = 'лв.' if 'лв' in sqm_text else 'EUR' if 'EUR' in sqm_text else record.get('Currency')
+    price_per_sqm_bgn = to_bgn(to_float(record.get('Price per sqm')), sqm_currency)
+    if price_per_sqm_bgn is None and price_bgn is not None and size:
+        price_per_sqm_bgn = price_bgn / size
+    return {'price_bgn': price_bgn, 'size': size, 'price_per_sqm_bgn': price_per_sqm_bgn}
+
+
+def record_period(record):
+    try:
+        published = to_timestamp(record.get('Publish Date'))
+    except ValueError:
+        published = None
+    return published.strftime(PERIOD_FORMAT) if published else UNKNOWN_PERIOD
+
+
+class MarketAggregates:
+    def __init__(self):
+        # (city, neighbourhood, property type, period) -> {metric: Summary}
+        self.groups = {}
+        # adv_id -> {'periods': {period: {'key': [city, neighbourhood,
+        # property type], 'values': metrics it added}}, 'all': the period whose
+        # values went into ALL_PERIODS, 'last_seen': date of the last run that
+        # met it}, so daily runs don't count an ad twice and merge() can take
+        # back an ad both stores counted
+        self.seen = {}
+
+    def _group(self, key):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {metric: Summary() for metric in METRICS}
+        return group
+
+    # Function to add one record; returns False if the ad was already counted for its period
+    def add(self, record):
+        period = record_period(record)
+        key_periods = [period, ALL_PERIODS]
+        city, neighbourhood = parse_location(record.get('Location'))
+        property_type = record.get('Property Type') or MISSING
+        adv_id = parse_adv_id(record.get('URL') or '')
+        metrics = None
+        if adv_id != MISSING:
+            entry = self.seen.get(adv_id)
+            if entry is None:
+                entry = self.seen[adv_id] = {'periods': {}, 'all': period, 'last_seen': None}
+            else:
+                # Already in the all-time total, under an earlier period
+                key_periods.remove(ALL_PERIODS)
+            entry['last_seen'] = datetime.now().date().isoformat()
+            if period in entry['periods']:
+                return False
+            metrics = record_metrics(record)
+            entry['periods'][period] = {'key': [city, neighbourhood, property_type], 'values': metrics}
+
+        metrics = metrics or record_metrics(record)
+        for key_period in key_periods:
+            group = self._group((city, neighbourhood, property_type, key_period))
+            for metric, value in metrics.items():
+                if value is not None:
+                    group[metric].add(value)
+        return True
+
+    # Function to take one counted period of an ad back out of the summaries;
+    # returns False if the store was saved without the ad's values
+    def _uncount(self, counted, period):
+        if counted is None:
+            return False
+        group = self._group((*counted['key'], period))
+        for metric, value in counted['values'].items():
+            if value is not None:
+                group[metric].remove(value)
+        return True
+
+    # Function to add another store's summaries, taking back what both stores
+    # counted for the same ad; returns (ads in both stores, how many of those
+    # couldn't be taken back because a store was saved without their values)
+    def merge(self, other):
+        for key, other_group in other.groups.items():
+            group = self._group(key)
+            for metric, summary in other_group.items():
+                group[metric].merge(summary)
+
+        shared, unresolved = 0, 0
+        for adv_id, other_entry in other.seen.items():
+            entry = self.seen.get(adv_id)
+            if entry is None:
+                self.seen[adv_id] = dict(other_entry, periods=dict(other_entry['periods']))
+                continue
+            shared += 1
+            resolved = self._uncount(other_entry['periods'].get(other_entry['all']), ALL_PERIODS)
+            for period, counted in other_entry['periods'].items():
+                if period in entry['periods']:
+                    resolved = self._uncount(counted, period) and resolved
+                else:
+                    entry['periods'][period] = counted
+            unresolved += not resolved
+            entry['last_seen'] = max(entry['last_seen'], other_entry['last_seen'])
+        return shared, unresolved
+
+    # Function to forget ads no run has met for retention_days
+    def trim(self, retention_days=SEEN_RETENTION_DAYS):
+        cutoff = (datetime.now().date() - timedelta(days=retention_days)).isoformat()
+        stale = [adv_id for adv_id, entry in self.seen.items() if entry['last_seen'] < cutoff]
+        for adv_id in stale:
+            del self.seen[adv_id]
+        return len(stale)
+
+    # Function to describe every metric for one key; period defaults to all time
+    def query(self, city, neighbourhood, property_type, period=ALL_PERIODS):
+        group = self.groups.get((city, neighbourhood, property_type, period))
+        if group is None:
+            return None
+        return {metric: summary.describe() for metric, summary in group.items()}
+
+    def save(self, path):
+        self.trim()
+        data = {
+            'groups': [{'key': list(key), 'metrics': {metric: summary.to_dict() for metric, summary in group.items()}}
+                       for key, group in self.groups.items()],
+            'seen': dict(sorted(self.seen.items())),
+        }
+        part_path = path + '.part'
+        with open(part_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(part_path, path)
+
+    @classmethod
+    def load(cls, path):
+        aggregates = cls()
+        if not os.path.exists(path):
+            return aggregates
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        for entry in data['groups']:
+            aggregates.groups[tuple(entry['key'])] = {metric: Summary.from_dict(summary)
+                                                      for metric, summary in entry['metrics'].items()}
+        aggregates.seen = data['seen']
+        for entry in aggregates.seen.values():
+            if isinstance(entry['periods'], list):
+                # Saved before stores kept each ad's values
+                entry['periods'] = dict.fromkeys(entry['periods'])
+                entry.setdefault('all', None)
+        return aggregates
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Maintain and query market aggregates")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help="add the records of a CSV or Parquet dataset to a store")
+    ingest.add_argument('store')
+    ingest.add_argument('inputs', nargs='+')
+
+    merge = commands.add_parser('merge', help="merge stores from separate runs into one")
+    merge.add_argument('store')
+    merge.add_argument('shards', nargs='+')
+
+    query = commands.add_parser('query', help="print the aggregates for one key")
+    query.add_argument('store')
+    query.add_argument('city')
+    query.add_argument('neighbourhood')
+    query.add_argument('property_type')
+    query.add_argument('--period', default=ALL_PERIODS, help=f"month as YYYY-MM (default: all, '{ALL_PERIODS}')")
+    return parser.parse_args()
+
+
+def main(args):
+    aggregates = MarketAggregates.load(args.store)
+    if args.command == 'ingest':
+        added = 0
+        for path in args.inputs:
+            for rows in read_chunks(path):
+                added += sum(aggregates.add(row) for row in rows)
+        aggregates.save(args.store)
+        print(f"Added {added} records; {len(aggregates.groups)} groups in {args.store}")
+    elif args.command == 'merge':
+        shared, unresolved = 0, 0
+        for shard in args.shards:
+            shard_shared, shard_unresolved = aggregates.merge(MarketAggregates.load(shard))
+            shared += shard_shared
+            unresolved += shard_unresolved
+        aggregates.save(args.store)
+        print(f"Merged {len(args.shards)} shards ({shared} ads counted in more than one, kept once); "
+              f"{len(aggregates.groups)} groups in {args.store}")
+        if unresolved:
+            print(f"Warning: {unresolved} of those ads come from a store saved without per-ad values "
+                  f"and are counted more than once; re-ingest that store's records to fix it")
+    else:
+        result = aggregates.query(args.city, args.neighbourhood, args.property_type, args.period)
+        if result is None:
+            print("No data for that key")
+            return
+        for metric, stats in result.items():
+            print(f"{metric}: " + ', '.join(f"{name}={value:,.0f}" if isinstance(value, float) else f"{name}={value}"
+                                            for name, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,16 +1,10 @@
-import pandas as pd
+from normalise import load_properties
 
-# Load data from CSV files
-df_properties = pd.read_csv('properties.csv')
-df_private_sellers = pd.read_csv('private_seller_properties.csv')
-
-# Combine both datasets into one if needed
-df_all_properties = pd.concat([df_properties, df_private_sellers], ignore_index=True)
+# Load both CSVs as one typed frame (cached between runs, see normalise.py)
+df_all_properties = load_properties()
 
 
 # Summary statistics
-price_stats = df_all_properties['Price'].describe()
-print("Summary Statistics of Property Prices:")
+price_stats = df_all_properties['Price in BGN'].describe()
+print("Summary Statistics of Property Prices in BGN:")
 print(price_stats)
-
-
@@ -0,0 +1,251 @@
+import argparse
+import csv
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+from metrics import METRICS_JSON_VARIABLE
+from replay_server import start_url
+from scheduler import add_scheduler_arguments, limits_from_args, limits_environ
+
+# Runs each crawler against replay_server.py and records throughput, request
+# latency, CPU time and peak memory. Request latency is measured by the crawler
+# itself (the 'fetch' stage of metrics.py, written to $IMOT_METRICS_JSON), from
+# sending the request to reading the body; the server side latency is kept next
+# to it. Every variant gets the same scheduler limits through the
+# IMOT_* variables (see scheduler.py). Each variant runs in its own temporary
+# directory, so cache/journal/state files never carry over between variants.
+# Results are saved as JSON named after the current commit, so two commits can
+# be compared:
+#
+#   python crawl_benchmark.py --pages 20 --latency 50 --jitter 20
+#   python crawl_benchmark.py --compare bench_results/<old>.json bench_results/<new>.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = 'bench_results'
+
+VARIANTS = {
+    'main': ['main.py'],
+    'main2': ['main2.py'],
+    'main4': ['main4.py'],
+    'test': ['test.py'],
+    'optimised': ['optimised.py'],
+}
+
+OUTPUTS = ('properties.csv', 'private_seller_properties.csv')
+
+# Metrics where a smaller number is better, for --compare
+LOWER_IS_BETTER = ('wall_s', 'cpu_s', 'peak_rss_mb', 'latency_mean_ms', 'latency_p50_ms', 'latency_p99_ms')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"replay server did not start on port {port}")
+
+
+def server_call(port, path):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=10) as response:
+        return json.load(response)
+
+
+def count_rows(directory):
+    total = 0
+    for name in OUTPUTS:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, newline='', encoding='utf-8') as f:
+                total += max(0, sum(1 for _ in csv.reader(f)) - 1)
+    return total
+
+
+# Function to read the crawler's metrics snapshot, or None if it didn't write one
+def read_snapshot(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Function to run one variant to completion and collect its resource usage
+def run_variant(name, port, timeout, limits):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    metrics_path = os.path.join(workdir, 'metrics.json')
+    env = dict(os.environ, IMOT_BASE_URL=start_url(port), PYTHONPATH=REPO_DIR, **limits_environ(limits))
+    env[METRICS_JSON_VARIABLE] = metrics_path
+    server_call(port, '/_reset')
+    started = time.perf_counter()
+    with open(os.path.join(workdir, 'stdout.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, VARIANTS[name][0])] + VARIANTS[name][1:],
+                                   cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            time.sleep(0.02)
+    wall = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    stats = server_call(port, '/_stats')
+    pages = stats['counts'].get('listing', 0)
+    listings = count_rows(workdir)
+    snapshot = read_snapshot(metrics_path)
+    fetch = (snapshot or {}).get('stages', {}).get('fetch', {})
+    result = {
+        'exit_code': process.returncode,
+        'wall_s': wall,
+        'cpu_s': usage.ru_utime + usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'requests': stats['requests'],
+        'pages': pages,
+        'listings': listings,
+        'pages_per_s': pages / wall,
+        'listings_per_s': listings / wall,
+        # Client side, bucketed (see metrics.LATENCY_BUCKETS); None if the crawler wrote no snapshot
+        'latency_mean_ms': fetch.get('mean_ms'),
+        'latency_p50_ms': fetch.get('p50_ms'),
+        'latency_p99_ms': fetch.get('p99_ms'),
+        'server_latency_p50_ms': stats['latency_p50_ms'],
+        'server_latency_p99_ms': stats['latency_p99_ms'],
+        'responses': stats['counts'],
+        # URLs the crawler was served more than once; should be empty
+        'duplicate_fetches': stats['duplicate_fetches'],
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def format_ms(value):
+    return f"{value:7.1f}" if value is not None else f"{'-':>7}"
+
+
+def print_results(results):
+    print(f"{'variant':<10} {'wall s':>7} {'cpu s':>7} {'rss MB':>7} {'pages/s':>8} {'list/s':>8} "
+          f"{'mean ms':>7} {'p50 ms':>7} {'p99 ms':>7} {'rows':>5}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['wall_s']:7.2f} {r['cpu_s']:7.2f} {r['peak_rss_mb']:7.1f} {r['pages_per_s']:8.1f} "
+              f"{r['listings_per_s']:8.1f} {format_ms(r['latency_mean_ms'])} {format_ms(r['latency_p50_ms'])} "
+              f"{format_ms(r['latency_p99_ms'])} {r['listings']:5d}"
+              + ('' if r['exit_code'] == 0 else f"  (exit {r['exit_code']})"))
+    for name, r in results.items():
+        for url, count in r['duplicate_fetches'].items():
+            print(f"warning: {name} fetched {url} {count} times")
+
+
+# Function to print the per-variant change between two saved result files
+def compare(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"{old['revision']} -> {new['revision']}")
+    if old.get('scheduler') != new.get('scheduler'):
+        print(f"note: scheduler limits differ: {old.get('scheduler')} -> {new.get('scheduler')}")
+    for name, new_result in new['results'].items():
+        old_result = old['results'].get(name)
+        if old_result is None:
+            continue
+        changes = []
+        for metric in ('wall_s', 'cpu_s', 'peak_rss_mb', 'pages_per_s', 'listings_per_s', 'latency_mean_ms',
+                       'latency_p99_ms'):
+            before, after = old_result.get(metric), new_result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = change > 0 if metric in LOWER_IS_BETTER else change < 0
+            changes.append(f"{metric} {before:.2f}->{after:.2f} ({change:+.1f}%{' worse' if worse else ''})")
+        print(f"{name}: " + ', '.join(changes))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the crawlers against a local replay server")
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=20.0, help="ms")
+    parser.add_argument('--jitter', type=float, default=10.0, help="ms")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None, help="requests/s")
+    # Scheduler limits for every crawler, passed on as IMOT_* variables
+    add_scheduler_arguments(parser)
+    parser.add_argument('--timeout', type=float, default=300, help="seconds before a variant is killed")
+    parser.add_argument('--output', help=f"results file (default: {RESULTS_DIR}/<commit>-<time>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two saved result files")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    limits = limits_from_args(args)
+    port = free_port()
+    server_args = ['--port', str(port), '--pages', str(args.pages), '--per-page', str(args.per_page),
+                   '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate)]
+    if args.rate_limit:
+        server_args += ['--rate-limit', str(args.rate_limit)]
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'replay_server.py')] + server_args,
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = {}
+        for name in args.variants:
+            print(f"Running {name}...", flush=True)
+            results[name] = run_variant(name, port, args.timeout, limits)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_results(results)
+    revision = git_revision()
+    report = {
+        'revision': revision,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare') and key not in limits},
+        'scheduler': limits,
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{revision}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
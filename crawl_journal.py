@@ -0,0 +1,119 @@
+import json
+import sqlite3
+
+# Journal of a crawl in progress, so a crash or Ctrl-C doesn't lose the run.
+# It records the listing pages discovered and completed, the detail pages
+# queued and completed, the records an incremental crawl carried forward
+# without a fetch, and every record emitted, each as it happens.
+# A --resume run reloads the records, re-queues only the unfinished pages,
+# detail pages and carried-forward records, and carries on from there.
+#
+# Every event is its own transaction. In WAL mode with synchronous=NORMAL a
+# commit is an append to the log without an fsync, so this stays cheap while
+# still surviving the process dying at any point.
+
+DEFAULT_JOURNAL_PATH = 'crawl_journal.sqlite'
+
+
+class CrawlJournal:
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0, search TEXT);
+            CREATE TABLE IF NOT EXISTS details (url TEXT PRIMARY KEY, listing TEXT NOT NULL,
+                                                done INTEGER NOT NULL DEFAULT 0,
+                                                carried INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS records (url TEXT PRIMARY KEY, record TEXT NOT NULL);
+        ''')
+        # Journals written before pages were tagged with their search
+        if 'search' not in {column for _, column, *_ in self.db.execute('PRAGMA table_info(pages)')}:
+            self.db.execute('ALTER TABLE pages ADD COLUMN search TEXT')
+        # Journals written before carried-forward records were journaled
+        if 'carried' not in {column for _, column, *_ in self.db.execute('PRAGMA table_info(details)')}:
+            self.db.execute('ALTER TABLE details ADD COLUMN carried INTEGER NOT NULL DEFAULT 0')
+        self.db.commit()
+
+    # Function to begin a run for base_url (one search's URL, or an id for a
+    # set of searches); a fresh run clears the previous journal, a resumed one
+    # checks it belongs to the same crawl. first_pages: (url, search) of each
+    # search's first page, by default just base_url.
+    def start(self, base_url, resume=False, first_pages=None):
+        if resume:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'base_url'").fetchone()
+            if row is not None and row[0] != base_url:
+                raise ValueError(f"{self.path} journals a crawl of {row[0]}, not {base_url}")
+            if row is not None:
+                return
+        with self.db:
+            self.db.execute('DELETE FROM pages')
+            self.db.execute('DELETE FROM details')
+            self.db.execute('DELETE FROM records')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('base_url', ?)", (base_url,))
+            self.db.executemany('INSERT OR IGNORE INTO pages (url, search) VALUES (?, ?)',
+                                first_pages or [(base_url, None)])
+
+    def is_page_done(self, url):
+        row = self.db.execute('SELECT done FROM pages WHERE url = ?', (url,)).fetchone()
+        return row is not None and row[0] == 1
+
+    # Function to mark a listing page finished, together with the pages of its search still to fetch
+    def page_completed(self, url, new_pages=(), search=None):
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO pages (url, search) VALUES (?, ?)',
+                                ((page, search) for page in new_pages))
+            self.db.execute('UPDATE pages SET done = 1 WHERE url = ?', (url,))
+
+    def detail_queued(self, listing):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO details (url, listing) VALUES (?, ?)',
+                            (listing['URL'], json.dumps(listing, ensure_ascii=False)))
+
+    # Function to store a previous run's record that goes to the sink without
+    # a detail fetch; it is pending until record_emitted()
+    def record_carried(self, record):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO details (url, listing, carried) VALUES (?, ?, 1)',
+                            (record['URL'], json.dumps(record, ensure_ascii=False, default=str)))
+
+    # Function to store an emitted record and mark its detail page finished
+    def record_emitted(self, record):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                            (record['URL'], json.dumps(record, ensure_ascii=False, default=str)))
+            self.db.execute('UPDATE details SET done = 1 WHERE url = ?', (record['URL'],))
+
+    def page_count(self):
+        return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    # Function to list the unfinished pages as (url, search)
+    def pending_pages(self):
+        return self.db.execute('SELECT url, search FROM pages WHERE done = 0 ORDER BY rowid').fetchall()
+
+    def pending_details(self):
+        return [json.loads(listing) for listing, in
+                self.db.execute('SELECT listing FROM details WHERE done = 0 AND carried = 0 ORDER BY rowid')]
+
+    def pending_carried(self):
+        return [json.loads(record) for record, in
+                self.db.execute('SELECT listing FROM details WHERE done = 0 AND carried = 1 ORDER BY rowid')]
+
+    # Every ad whose record was already emitted, so resumed listing pages don't queue it again
+    def completed_urls(self):
+        return {url for url, in self.db.execute('SELECT url FROM details WHERE done = 1 UNION SELECT url FROM records')}
+
+    def records(self):
+        for record, in self.db.execute('SELECT record FROM records ORDER BY rowid'):
+            yield json.loads(record)
+
+    def summary(self):
+        pages_done, pages = self.db.execute('SELECT SUM(done), COUNT(*) FROM pages').fetchone()
+        details_done, details = self.db.execute('SELECT COALESCE(SUM(done), 0), COUNT(*) FROM details').fetchone()
+        records = self.db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        return f"pages={pages_done}/{pages}, details={details_done}/{details}, records={records}"
+
+    def close(self):
+        self.db.close()
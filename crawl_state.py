@@ -0,0 +1,92 @@
+import json
+import sqlite3
+import time
+from collections import Counter
+
+from fields import parse_adv_id, MISSING
+
+# State kept between daily runs for incremental crawls: for every ad id the
+# price, currency and seller seen on the listing page, when its detail page
+# was last fetched, and the record built from it. During the listing pass
+# needs_detail() decides whether an ad has to be fetched again; if not, the
+# previous record is carried forward.
+
+DEFAULT_STATE_PATH = 'crawl_state.sqlite'
+MAX_DETAIL_AGE_DAYS = 7
+
+# Commit after this many writes so a crash loses at most a few ads' state
+COMMIT_EVERY = 200
+
+
+class CrawlState:
+    def __init__(self, path=DEFAULT_STATE_PATH, max_detail_age_days=MAX_DETAIL_AGE_DAYS):
+        self.path = path
+        self.max_detail_age = max_detail_age_days * 24 * 60 * 60
+        # new / changed / stale / unchanged decisions made this run
+        self.stats = Counter()
+        self.pending_writes = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS ads (
+                adv_id TEXT PRIMARY KEY,
+                price TEXT,
+                currency TEXT,
+                seller TEXT,
+                detail_fetched_at REAL,
+                last_seen_at REAL,
+                record TEXT
+            )''')
+        self.db.commit()
+
+    # Function to decide whether a listing needs its detail page fetched.
+    # Returns (reason, previous_record); reason is None for unchanged ads.
+    def needs_detail(self, listing):
+        adv_id = parse_adv_id(listing['URL'])
+        if adv_id == MISSING:
+            self.stats['new'] += 1
+            return 'new', None
+
+        row = self.db.execute(
+            'SELECT price, currency, seller, detail_fetched_at, record FROM ads WHERE adv_id = ?',
+            (adv_id,)).fetchone()
+        if row is None or row[4] is None:
+            reason = 'new'
+        elif (row[0], row[1], row[2]) != (str(listing['Price']), listing['Currency'], listing['Seller']):
+            reason = 'changed'
+        elif time.time() - row[3] > self.max_detail_age:
+            reason = 'stale'
+        else:
+            reason = None
+
+        self.stats[reason or 'unchanged'] += 1
+        if reason is None:
+            self._write('UPDATE ads SET last_seen_at = ? WHERE adv_id = ?', (time.time(), adv_id))
+            return None, json.loads(row[4])
+        return reason, None
+
+    # Function to remember the record built from a freshly fetched detail page
+    def record_detail(self, listing, record):
+        adv_id = parse_adv_id(listing['URL'])
+        if adv_id == MISSING:
+            return
+        now = time.time()
+        self._write(
+            'INSERT OR REPLACE INTO ads VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (adv_id, str(listing['Price']), listing['Currency'], listing['Seller'], now, now,
+             json.dumps(record, ensure_ascii=False, default=str)))
+
+    def _write(self, sql, params):
+        self.db.execute(sql, params)
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def summary(self):
+        return ', '.join(f"{key}={self.stats[key]}" for key in ('new', 'changed', 'stale', 'unchanged'))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
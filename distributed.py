@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import os
+import socket
+import time
+from collections import Counter
+
+import aiohttp
+
+from scheduler import RequestScheduler, scheduler_limits
+from retries import RetryPolicy
+from parse_pool import ParsePool
+from http_cache import ResponseCache, DEFAULT_CACHE_PATH, canonical_url
+from searches import Search, load_searches
+from metrics import crawl_metrics
+from optimised import Crawl, listing_key, open_writer, PARSE_WORKERS, MAX_PENDING_PARSES
+from work_queue import open_queue, serve_queue, is_finished, DEFAULT_QUEUE_PATH, MEMORY_URI, LEASE_TIMEOUT, \
+    MAX_DELIVERIES
+from scrape_logging import setup_logging, get_logger, fields
+
+# Distributed crawl: one coordinator and any number of workers, on one or
+# more machines, sharing a work queue (work_queue.py).
+#
+#   python distributed.py coordinator [--config searches.json] [--queue PATH] [--serve PORT]
+#   python distributed.py worker [--queue PATH | --queue http://coordinator:PORT]
+#
+# The coordinator fetches the first page of each search and puts the rest of
+# its pages (pagination.py) and the ads it lists on the queue. Workers lease
+# listing pages and ack them with the ads they list, and lease ads (detail
+# pages) and ack them with the extracted record. An ad is queued once,
+# keyed by its adv id, however many pages and searches list it. The
+# coordinator collects the records into properties.csv (or Parquet) as they
+# arrive, and exits once every item is done or dead.
+
+# Seconds between polls of the queue when there is nothing to do
+POLL_INTERVAL = 1.0
+# Seconds between progress lines from the coordinator
+STATUS_INTERVAL = 10.0
+# Items each worker process processes at once
+WORKER_CONCURRENCY = 8
+
+log = get_logger('distributed')
+
+
+def page_item(url, search):
+    return {'kind': 'page', 'key': canonical_url(url), 'payload': {'url': url, 'search': search}}
+
+
+def detail_item(listing):
+    return {'kind': 'detail', 'key': listing_key(listing['URL']), 'payload': listing}
+
+
+# Function to queue one search: the ads of its first page, then its other pages
+async def discover_search(crawl, queue, search):
+    try:
+        content, content_type = await crawl.fetch(search.url)
+        listings, page_urls = await crawl.parse_listing(content, content_type, search.url, True)
+    except Exception as e:
+        log.error(f"Error fetching first page of {search.name} {search.url}: {e}",
+                  extra=fields(search=search.name, url=search.url, error=type(e).__name__))
+        return
+    if search.max_pages:
+        page_urls = page_urls[:search.max_pages]
+    for listing in listings:
+        listing['Search'] = search.name
+    ads = await queue.put([detail_item(listing) for listing in listings])
+    pages = await queue.put([page_item(url, search.name) for url in page_urls[1:]])
+    log.info(f"Total pages to scrape for {search.name}: {len(page_urls)}, {pages} queued, {ads} ads from page 1",
+             extra=fields(search=search.name, pages=len(page_urls), queued=pages, ads=ads))
+
+
+# Function to write the records workers ack, until the crawl is finished
+async def collect(queue, property_writer):
+    after = 0
+    reported = time.monotonic()
+    while True:
+        # Read the status first: once it says finished, every ack (and its
+        # records) is already on the queue for the results() below
+        status = await queue.status()
+        batch = await queue.results(after)
+        for seq, property_entry in batch:
+            with crawl_metrics.time('write'):
+                property_writer.write(property_entry)
+            crawl_metrics.record_fields(property_entry)
+            after = seq
+        if batch:
+            continue
+        if is_finished(status):
+            return status
+        if time.monotonic() - reported >= STATUS_INTERVAL:
+            reported = time.monotonic()
+            log.info(f"Queue: {queue_summary(status)}", extra=fields(**status))
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def queue_summary(status):
+    return (f"pending={status['pending']}, leased={status['leased']}, done={status['done']}, "
+            f"dead={status['dead']}, records={status['results']}")
+
+
+# Function to fetch a listing page; returns the queue items for the ads it lists
+async def process_page(crawl, page):
+    content, content_type = await crawl.fetch(page['url'])
+    listings, _ = await crawl.parse_listing(content, content_type, page['url'])
+    for listing in listings:
+        listing['Search'] = page['search']
+    return [detail_item(listing) for listing in listings]
+
+
+# Function to fetch a detail page; returns its record
+async def process_detail(crawl, listing):
+    content, content_type = await crawl.fetch(listing['URL'])
+    property_entry = await crawl.parse_detail(content, content_type, listing['URL'], listing['Phone'])
+    property_entry['Search'] = listing.get('Search')
+    return property_entry
+
+
+# Function to lease, process and ack items one at a time until the crawl is finished
+async def work(queue, crawl, worker, stats, lease_timeout=LEASE_TIMEOUT):
+    while True:
+        item = await queue.lease(worker, lease_timeout)
+        if item is None:
+            if is_finished(await queue.status()):
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+
+        records, items = [], []
+        try:
+            if item['kind'] == 'page':
+                items = await process_page(crawl, item['payload'])
+            else:
+                records = [await process_detail(crawl, item['payload'])]
+        except Exception as e:
+            stats['failed'] += 1
+            log.error(f"Error processing {item['kind']} {item['key']} (delivery {item['deliveries']}): {e}",
+                      extra=fields(kind=item['kind'], key=item['key'], deliveries=item['deliveries'],
+                                   error=type(e).__name__))
+            await queue.fail(item['id'], item['token'], f"{type(e).__name__}: {e}")
+            continue
+
+        if await queue.ack(item['id'], item['token'], records, items):
+            stats[item['kind']] += 1
+        else:
+            stats['lost'] += 1
+            log.warning(f"Lease on {item['kind']} {item['key']} expired before the ack; another worker has it",
+                        extra=fields(kind=item['kind'], key=item['key']))
+
+
+def open_crawl(session, args):
+    scheduler = RequestScheduler(**dict(scheduler_limits(), requests_per_second=args.rate))
+    parse_pool = ParsePool(PARSE_WORKERS, MAX_PENDING_PARSES)
+    cache = ResponseCache(args.cache) if args.cache else None
+    # Failures left after the retries go back to the queue for another delivery
+    return Crawl(session, scheduler, parse_pool, cache, retry=RetryPolicy())
+
+
+def close_crawl(crawl):
+    crawl.parse_pool.shutdown()
+    if crawl.cache is not None:
+        crawl.cache.close()
+
+
+def log_summary(stats, crawl):
+    for line in crawl_metrics.summary_lines():
+        log.info(line)
+    log.info(f"Processed pages={stats['page']}, details={stats['detail']}, failed={stats['failed']}, "
+             f"lost leases={stats['lost']}", extra=fields(**stats))
+    log.info(f"Retries: {crawl.retry.summary()}")
+
+
+async def run_coordinator(args):
+    if args.config:
+        searches = load_searches(args.config)
+    else:
+        base_url = os.environ.get('IMOT_BASE_URL', 'https://www.imot.bg/pcgi/imot.cgi?act=3&slink=av2f36&f1=1')
+        searches = [Search(base_url)]
+    crawl_metrics.reset()
+    queue = open_queue(args.queue, args.max_deliveries)
+    resumed = False
+    if args.resume:
+        status = await queue.status()
+        resumed = status['discovered']
+        log.info(f"Resuming distributed crawl: {queue_summary(status)}")
+    else:
+        await queue.reset()
+    server = await serve_queue(queue, args.serve, args.serve_host) if args.serve else None
+    property_writer = open_writer(args, 'properties', searches)
+    stats = Counter()
+
+    async with aiohttp.ClientSession() as session:
+        crawl = open_crawl(session, args)
+        workers = [asyncio.create_task(work(queue, crawl, f"{socket.gethostname()}-{os.getpid()}-{number}", stats,
+                                            args.lease_timeout))
+                   for number in range(args.workers)]
+        try:
+            if not resumed:
+                await asyncio.gather(*(discover_search(crawl, queue, search) for search in searches))
+                await queue.finish_discovery()
+            status = await collect(queue, property_writer)
+            await asyncio.gather(*workers)
+            if server is not None:
+                # Give remote workers time to see the crawl is finished before the server goes away
+                await asyncio.sleep(2 * POLL_INTERVAL)
+        except BaseException:
+            # The queue keeps the progress; --resume picks it up
+            property_writer.abort()
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            close_crawl(crawl)
+            if server is not None:
+                await server.cleanup()
+            log_summary(stats, crawl)
+
+    property_writer.close()
+    dead = await queue.dead_items()
+    await queue.close()
+    log.info(f"Distributed crawl of {', '.join(search.name for search in searches)} completed: "
+             f"{queue_summary(status)}; data saved to {property_writer.path}", extra=fields(**status))
+    for item in dead[:10]:
+        log.warning(f"Gave up on {item['kind']} {item['key']}: {item['error']}", extra=fields(**item))
+
+
+async def run_worker(args):
+    crawl_metrics.reset()
+    queue = open_queue(args.queue, args.max_deliveries)
+    name = args.id or f"{socket.gethostname()}-{os.getpid()}"
+    stats = Counter()
+    async with aiohttp.ClientSession() as session:
+        crawl = open_crawl(session, args)
+        try:
+            await asyncio.gather(*(work(queue, crawl, f"{name}-{number}", stats, args.lease_timeout)
+                                   for number in range(args.concurrency)))
+        finally:
+            close_crawl(crawl)
+            await queue.close()
+            log_summary(stats, crawl)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Crawl imot.bg with a coordinator and workers sharing a work queue")
+    roles = parser.add_subparsers(dest='role', required=True)
+    coordinator = roles.add_parser('coordinator', help="discover the pages, queue them and collect the records")
+    worker = roles.add_parser('worker', help="process queued pages until the crawl is finished")
+
+    for role in (coordinator, worker):
+        role.add_argument('--queue', default=DEFAULT_QUEUE_PATH, metavar='URI',
+                          help=f"work queue: a SQLite file shared on this host (default: {DEFAULT_QUEUE_PATH}), "
+                               f"{MEMORY_URI}, or http://HOST:PORT of a coordinator started with --serve")
+        role.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT, metavar='SECONDS',
+                          help="hand an item to another worker if it isn't acked within this time")
+        role.add_argument('--max-deliveries', type=int, default=MAX_DELIVERIES, metavar='N',
+                          help="give up on an item after this many deliveries (ignored for http:// queues)")
+        role.add_argument('--rate', type=float, default=scheduler_limits()['requests_per_second'], metavar='RPS',
+                          help="requests per second for this process; split the site's budget between processes")
+        role.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_PATH, default=None, metavar='PATH',
+                          help=f"cache responses on disk (default path: {DEFAULT_CACHE_PATH})")
+        role.add_argument('--log-text', action='store_true',
+                          help="write scraping_log.log as plain text instead of JSON lines")
+
+    coordinator.add_argument('--config', default=None, metavar='PATH',
+                             help="JSON list of searches to crawl (see searches.py; default: IMOT_BASE_URL)")
+    coordinator.add_argument('--resume', action='store_true',
+                             help="carry on with the crawl already on the queue instead of starting over")
+    coordinator.add_argument('--format', choices=('csv', 'parquet'), default='csv',
+                             help="write properties.csv, or a Parquet dataset under properties_parquet/")
+    coordinator.add_argument('--serve', type=int, default=None, metavar='PORT',
+                             help="serve the queue to workers on other hosts at http://HOST:PORT")
+    coordinator.add_argument('--serve-host', default='127.0.0.1', metavar='HOST',
+                             help="address to serve the queue on (0.0.0.0 for every interface)")
+    coordinator.add_argument('--workers', type=int, default=0, metavar='N',
+                             help="also process N items at once in the coordinator process")
+
+    worker.add_argument('--id', default=None, help="worker name in leases (default: host-pid)")
+    worker.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, metavar='N',
+                        help="items processed at once")
+
+    args = parser.parse_args()
+    if args.role == 'coordinator' and args.queue == MEMORY_URI and not (args.serve or args.workers):
+        parser.error(f"a {MEMORY_URI} queue needs --serve or --workers, or no worker can reach it")
+    if args.queue.startswith(('http://', 'https://')) and args.role == 'coordinator':
+        parser.error("the coordinator owns the queue; give it a SQLite path or memory://")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(json_lines=not args.log_text)
+    asyncio.run(run_coordinator(args) if args.role == 'coordinator' else run_worker(args))
@@ -0,0 +1,97 @@
+import codecs
+import re
+from collections import Counter
+from urllib.parse import urlparse
+
+import chardet
+
+from metrics import crawl_metrics
+
+# How much of the body to scan for a <meta> charset, and the largest prefix
+# chardet is allowed to look at when nothing else answers
+META_SCAN_BYTES = 4096
+CHARDET_PREFIX_BYTES = 16384
+
+# Hosts known to always serve the same charset; matched on the host suffix
+# so that every imot.bg city subdomain is covered
+KNOWN_HOST_ENCODINGS = {
+    'imot.bg': 'windows-1251',
+}
+
+CONTENT_TYPE_CHARSET = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+# How often each resolution path was taken: header, meta, host, chardet, default
+encoding_stats = Counter()
+
+# Encoding last resolved for each host
+host_encodings = {}
+
+
+# Function to return the normalised codec name, or None if Python doesn't know it
+def normalise_encoding(name):
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+def charset_from_content_type(content_type):
+    if not content_type:
+        return None
+    match = CONTENT_TYPE_CHARSET.search(content_type)
+    return normalise_encoding(match.group(1)) if match else None
+
+
+# Covers both <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+def charset_from_meta(content):
+    match = META_CHARSET.search(content[:META_SCAN_BYTES])
+    return normalise_encoding(match.group(1).decode('ascii', 'ignore')) if match else None
+
+
+def charset_from_host(host):
+    if host in host_encodings:
+        return host_encodings[host]
+    for suffix, encoding in KNOWN_HOST_ENCODINGS.items():
+        if host == suffix or host.endswith('.' + suffix):
+            return normalise_encoding(encoding)
+    return None
+
+
+# Function to pick the encoding of a response body. Tries the Content-Type
+# header, then the <meta> tag, then what the host used before, and only then
+# runs chardet on a bounded prefix of the body.
+def resolve_encoding(content, content_type=None, url=None):
+    host = (urlparse(url).hostname or '') if url else ''
+
+    encoding = charset_from_content_type(content_type)
+    if encoding:
+        path = 'header'
+    else:
+        encoding = charset_from_meta(content)
+        if encoding:
+            path = 'meta'
+        else:
+            encoding = charset_from_host(host) if host else None
+            if encoding:
+                path = 'host'
+            else:
+                with crawl_metrics.time('chardet', min(len(content), CHARDET_PREFIX_BYTES)):
+                    encoding = normalise_encoding(chardet.detect(content[:CHARDET_PREFIX_BYTES])['encoding'])
+                path = 'chardet' if encoding else 'default'
+                encoding = encoding or 'utf-8'
+
+    encoding_stats[path] += 1
+    if host:
+        host_encodings[host] = encoding
+    return encoding
+
+
+def decode_content(content, content_type=None, url=None):
+    return content.decode(resolve_encoding(content, content_type, url), errors='replace')
+
+
+def encoding_summary():
+    return ', '.join(f"{path}={count}" for path, count in encoding_stats.most_common())
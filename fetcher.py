@@ -0,0 +1,57 @@
+from encoding import decode_content
+from metrics import crawl_metrics
+from retries import check_status
+
+
+# Shared fetch() for the aiohttp scrapers. When a scheduler is given the
+# request only starts once it has a global, per-host and rate-limit slot.
+# An error status raises retries.FetchError; with a RetryPolicy transient
+# failures are retried first (see retries.py).
+async def fetch(session, url, scheduler=None, cache=None, retry=None):
+    content, content_type = await fetch_raw(session, url, scheduler, cache, retry)
+    return decode_content(content, content_type, url)
+
+
+# Same as fetch() but returns the undecoded body and its Content-Type, for
+# callers that decode elsewhere (e.g. in a parse worker process). With a
+# ResponseCache (http_cache.py) fresh entries are served without touching
+# the network and stale ones are revalidated with a conditional request.
+async def fetch_raw(session, url, scheduler=None, cache=None, retry=None):
+    entry = None
+    headers = {}
+    if cache is not None:
+        entry, fresh = cache.lookup(url)
+        if fresh:
+            return entry.body, entry.content_type
+        headers = cache.conditional_headers(entry)
+
+    if retry is None:
+        status, content, response_headers = await _request(session, url, headers, scheduler)
+        check_status(url, status)
+    else:
+        # Waits between attempts happen outside the scheduler slot
+        status, content, response_headers = await retry.run(url, lambda: _request(session, url, headers, scheduler))
+
+    if cache is not None:
+        if status == 304 and entry is not None:
+            cache.revalidated(entry)
+            return entry.body, entry.content_type
+        if status == 200:
+            cache.store(url, content, response_headers.get('Content-Type'),
+                        response_headers.get('ETag'), response_headers.get('Last-Modified'))
+    return content, response_headers.get('Content-Type')
+
+
+async def _request(session, url, headers, scheduler):
+    if scheduler is None:
+        return await _get(session, url, headers)
+    async with scheduler.slot(url):
+        return await _get(session, url, headers)
+
+
+async def _get(session, url, headers=None):
+    with crawl_metrics.time('fetch'):
+        async with session.get(url, headers=headers) as response:
+            content = await response.read()
+    crawl_metrics.add_bytes('fetch', len(content))
+    return response.status, content, response.headers
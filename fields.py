@@ -0,0 +1,137 @@
+import re
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+# Field extraction shared by every scraper. All patterns are declared once
+# here and compiled at import; the scrapers only locate the text on the page
+# and hand it to the functions below.
+
+MISSING = 'N/A'
+
+BULGARIAN_MONTHS = {
+    'януари': 1, 'февруари': 2, 'март': 3, 'април': 4, 'май': 5, 'юни': 6,
+    'юли': 7, 'август': 8, 'септември': 9, 'октомври': 10, 'ноември': 11, 'декември': 12
+}
+
+
+# A field pulled out of free text: its record column, a pattern with a single
+# named group (the column name slugified), and the converter for the match
+class Field:
+    def __init__(self, name, pattern, converter=str):
+        self.name = name
+        self.group = re.sub(r'\W', '_', name.lower())
+        self.pattern = pattern.format(group=self.group)
+        self.regex = re.compile(self.pattern)
+        self.converter = converter
+
+    def search(self, text):
+        match = self.regex.search(text)
+        return self.converter(match.group(self.group)) if match else MISSING
+
+
+# Fields read from the listing description cell, e.g.
+# "65 кв.м, 3-ти ет. от 6, Тухла 2008 г., ... тел.: 0888123456"
+DESCRIPTION_FIELDS = (
+    Field('Size', r'(?P<{group}>\d+)\s*кв\.м', int),
+    Field('Floor', r'(?P<{group}>\d+)-ти\s*ет', int),
+    Field('Year', r'Тухла\s*(?P<{group}>\d{{4}})\s*г\.', int),
+    Field('Phone', r'тел\.: (?P<{group}>\d{{10,12}})'),
+)
+
+# One alternation over every description field, so the text is scanned once
+DESCRIPTION_PATTERN = re.compile('|'.join(field.pattern for field in DESCRIPTION_FIELDS))
+DESCRIPTION_BY_GROUP = {field.group: field for field in DESCRIPTION_FIELDS}
+
+PRICE_PATTERN = re.compile(r'(\d+\s?\d*)\s*(лв\.|EUR)')
+NUMBER_PATTERN = re.compile(r'(\d+)')
+FLOOR_OF_PATTERN = re.compile(r'(\d+)-ти от (\d+)')
+MATERIAL_YEAR_PATTERN = re.compile(r'(.*), (\d{4}) г\.')
+PUBLISH_DATE_PATTERN = re.compile(
+    r"(Публикувана в|Коригирана в) (\d{1,2}:\d{2}) на (\d{1,2}) ([а-я]+), (\d{4}) год.", re.IGNORECASE)
+PHONE_PREFIX = "тел.:"
+
+
+# Function to pull every description field out of the text in a single pass
+def parse_description(description_text):
+    values = dict.fromkeys((field.name for field in DESCRIPTION_FIELDS), MISSING)
+    remaining = len(values)
+    for match in DESCRIPTION_PATTERN.finditer(description_text):
+        field = DESCRIPTION_BY_GROUP[match.lastgroup]
+        if values[field.name] is MISSING:
+            values[field.name] = field.converter(match.group(match.lastgroup))
+            remaining -= 1
+            if not remaining:
+                break
+    return values
+
+
+# Function to split "125 000 EUR" / "95000 лв." into (125000, 'EUR')
+def parse_price(price_text):
+    match = PRICE_PATTERN.search(price_text)
+    if match:
+        return int(match.group(1).replace(' ', '')), match.group(2)
+    return MISSING, MISSING
+
+
+def _parse_size(value, values):
+    match = NUMBER_PATTERN.search(value)
+    values['Size'] = int(match.group(1)) if match else MISSING
+
+
+def _parse_floor(value, values):
+    match = FLOOR_OF_PATTERN.search(value)
+    if match:
+        values['Floor'] = int(match.group(1))
+        values['Total Floors'] = int(match.group(2))
+    else:
+        # Ordinals other than -ти ("2-ри", "1-ви") are kept as written
+        values['Floor'] = value.split(" ")[0]
+
+
+def _parse_construction(value, values):
+    match = MATERIAL_YEAR_PATTERN.search(value)
+    if match:
+        values['Material'] = match.group(1).strip()
+        values['Year'] = int(match.group(2))
+
+
+# Rows of the detail page adParams block, by label
+AD_PARAM_FIELDS = (
+    ('Площ:', _parse_size),
+    ('Етаж:', _parse_floor),
+    ('Строителство:', _parse_construction),
+)
+AD_PARAM_COLUMNS = ('Size', 'Floor', 'Total Floors', 'Material', 'Year')
+
+
+# Function to turn the text of each adParams row into Size/Floor/Total Floors/Material/Year
+def parse_ad_params(row_texts):
+    values = dict.fromkeys(AD_PARAM_COLUMNS, MISSING)
+    for text in row_texts:
+        for label, parser in AD_PARAM_FIELDS:
+            if label in text:
+                parser(text.split(":")[1].strip(), values)
+                break
+    return values
+
+
+# Function to parse "Коригирана в 16:47 на 12 юли, 2024 год." into (status, datetime)
+def parse_publish_date(date_str):
+    match = PUBLISH_DATE_PATTERN.search(date_str)
+    if match:
+        status, time, day, month, year = match.groups()
+        month_number = BULGARIAN_MONTHS.get(month.lower(), 1)
+        hour, minute = time.split(':')
+        return status, datetime(int(year), month_number, int(day), int(hour), int(minute))
+    return MISSING, MISSING
+
+
+# Function to strip the "тел.:" prefix from a seller phone block
+def parse_seller_phone(phone_text):
+    return phone_text.replace(PHONE_PREFIX, "").strip()
+
+
+# Function to return the ad id from a detail URL (...imot.cgi?act=5&adv=1b169935039292213)
+def parse_adv_id(url):
+    values = parse_qs(urlparse(url).query).get('adv')
+    return values[0] if values else MISSING
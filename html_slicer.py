@@ -0,0 +1,83 @@
+import re
+
+# Byte-level pre-slicing of HTML for restricted parses. Instead of building
+# the whole DOM, the raw page is scanned for the start tags of the regions we
+# read (listing tables, pagination, adPrice/adParams/... blocks), each region
+# is cut out up to its matching end tag, and only those slices are parsed.
+# Works on the undecoded bytes since tag syntax is ASCII in both windows-1251
+# and UTF-8, so the rest of the page is never decoded either.
+
+ATTRIBUTE = re.compile(rb'''([\w:-]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+
+_tag_patterns = {}
+
+
+def _tag_patterns_for(tag):
+    if tag not in _tag_patterns:
+        name = re.escape(tag.encode('ascii'))
+        _tag_patterns[tag] = (
+            re.compile(rb'<' + name + rb'\b([^>]*)>', re.IGNORECASE),
+            re.compile(rb'<(/?)' + name + rb'\b[^>]*>', re.IGNORECASE),
+        )
+    return _tag_patterns[tag]
+
+
+def _parse_attributes(raw):
+    attrs = {}
+    for match in ATTRIBUTE.finditer(raw):
+        name, double, single, bare = match.groups()
+        value = double if double is not None else single if single is not None else bare or b''
+        attrs[name.decode('ascii', 'ignore').lower()] = value.decode('ascii', 'ignore')
+    return attrs
+
+
+# Function to find the end of the element whose start tag ends at `position`
+def _element_end(content, tag_pattern, position):
+    depth = 1
+    for match in tag_pattern.finditer(content, position):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+        elif not match.group(0).endswith(b'/>'):
+            depth += 1
+    # Unclosed element: keep the rest of the page
+    return len(content)
+
+
+# Function to return (start, end) byte ranges of every element matching any of the selectors
+def find_regions(content, selectors):
+    by_tag = {}
+    for selector in selectors:
+        by_tag.setdefault(selector.tag, []).append(selector)
+
+    regions = []
+    for tag, tag_selectors in by_tag.items():
+        start_pattern, tag_pattern = _tag_patterns_for(tag)
+        position = 0
+        while True:
+            match = start_pattern.search(content, position)
+            if not match:
+                break
+            attrs = _parse_attributes(match.group(1))
+            if any(selector.matches(attrs) for selector in tag_selectors):
+                end = _element_end(content, tag_pattern, match.end())
+                regions.append((match.start(), end))
+                position = end
+            else:
+                position = match.end()
+
+    # Document order, dropping regions nested inside an earlier one
+    regions.sort()
+    merged = []
+    for start, end in regions:
+        if merged and start < merged[-1][1]:
+            continue
+        merged.append((start, end))
+    return merged
+
+
+# Function to cut the matching regions out of a page into a minimal document
+def slice_regions(content, selectors):
+    regions = find_regions(content, selectors)
+    return b'<html><body>' + b''.join(content[start:end] for start, end in regions) + b'</body></html>'
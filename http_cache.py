@@ -0,0 +1,166 @@
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+# Persistent response cache used by fetch_raw() in fetcher.py. Bodies are
+# stored zlib-compressed in a SQLite file together with their validators
+# (ETag / Last-Modified). Entries older than their URL class's TTL are
+# revalidated with If-None-Match / If-Modified-Since, and the least recently
+# used entries are evicted once the stored bodies exceed the size budget.
+
+DEFAULT_CACHE_PATH = 'http_cache.sqlite'
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+# Seconds before an entry must be revalidated, by URL class
+TTLS = {
+    'listing': 60 * 60,
+    'detail': 7 * 24 * 60 * 60,
+}
+
+
+class CacheMiss(Exception):
+    pass
+
+
+# Function to normalise a URL so equivalent URLs share one cache entry
+def canonical_url(url):
+    parsed = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/', '', query, ''))
+
+
+# Detail pages are the act=5&adv=... URLs, everything else is a listing page
+def url_class(url):
+    query = dict(parse_qsl(urlparse(url).query))
+    return 'detail' if query.get('act') == '5' or 'adv' in query else 'listing'
+
+
+class CacheEntry:
+    def __init__(self, url, body, content_type, etag, last_modified, fetched_at):
+        self.url = url
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, ttls=TTLS):
+        return time.time() - self.fetched_at < ttls[url_class(self.url)]
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=MAX_CACHE_BYTES, ttls=None, offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.offline = offline
+        # hit: served fresh, revalidated: 304 from the site, miss: downloaded,
+        # stored: written to the cache, evicted: dropped by LRU
+        self.stats = Counter()
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                content_type TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        key = canonical_url(url)
+        row = self.db.execute(
+            'SELECT body, content_type, etag, last_modified, fetched_at FROM responses WHERE url = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), key))
+        self.db.commit()
+        body, content_type, etag, last_modified, fetched_at = row
+        return CacheEntry(url, zlib.decompress(body), content_type, etag, last_modified, fetched_at)
+
+    # Function to look up a URL; returns (entry, fresh). In offline mode every
+    # cached entry counts as fresh and a missing one raises CacheMiss.
+    def lookup(self, url):
+        entry = self.get(url)
+        if self.offline:
+            if entry is None:
+                self.stats['miss'] += 1
+                raise CacheMiss(f"{url} is not cached and the cache is offline")
+            self._served(entry, 'hit')
+            return entry, True
+        if entry is not None and entry.is_fresh(self.ttls):
+            self._served(entry, 'hit')
+            return entry, True
+        return entry, False
+
+    # Request headers that let the site answer 304 Not Modified
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    # Function to mark a stale entry as confirmed unchanged by a 304
+    def revalidated(self, entry):
+        now = time.time()
+        self.db.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?',
+                        (now, now, canonical_url(entry.url)))
+        self.db.commit()
+        entry.fetched_at = now
+        self._served(entry, 'revalidated')
+
+    def store(self, url, body, content_type=None, etag=None, last_modified=None):
+        self.stats['miss'] += 1
+        key = canonical_url(url)
+        compressed = zlib.compress(body)
+        now = time.time()
+        previous = self.db.execute('SELECT size FROM responses WHERE url = ?', (key,)).fetchone()
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, compressed, len(compressed), content_type, etag, last_modified, now, now))
+        self.db.commit()
+        self.total_bytes += len(compressed) - (previous[0] if previous else 0)
+        self.stats['stored'] += 1
+        self.stats['bytes_downloaded'] += len(body)
+        self._evict()
+
+    def _served(self, entry, kind):
+        self.stats[kind] += 1
+        self.stats['bytes_saved'] += len(entry.body)
+
+    # Drop least recently used entries until the stored size fits the budget
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed_at LIMIT 100').fetchall()
+            if not rows:
+                break
+            evicted = []
+            for url, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted.append((url,))
+                self.total_bytes -= size
+            self.db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+            self.db.commit()
+            self.stats['evicted'] += len(evicted)
+
+    def summary(self):
+        keys = ('hit', 'revalidated', 'miss', 'evicted', 'bytes_saved')
+        return ', '.join(f"{key}={self.stats[key]}" for key in keys)
+
+    def close(self):
+        self.db.close()
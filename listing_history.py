@@ -0,0 +1,219 @@
+import argparse
+import sqlite3
+import time
+from datetime import datetime
+
+from fields import parse_adv_id, MISSING
+from mongoconnect import read_chunks
+from parquet_writer import to_int, to_timestamp
+
+# Per-ad history across runs. Instead of a snapshot per day, only changes are
+# stored: a row whenever an ad's price, currency, status or publish/edit date
+# differs from the last run, plus 'listed' and 'relisted' events. Visit counts
+# are sampled at most once every VISIT_SAMPLE_DAYS.
+#
+# The tables are WITHOUT ROWID and clustered by (adv_id, time), so an ad's
+# history is a single range scan. A partial index on price changes answers
+# "ads whose price changed in the last N days" without touching other rows.
+#
+#   python listing_history.py ingest listing_history.sqlite properties.csv --date 2024-07-12
+#   python listing_history.py ad listing_history.sqlite 1b169935039292213
+#   python listing_history.py price-changes listing_history.sqlite --days 7
+
+DEFAULT_HISTORY_PATH = 'listing_history.sqlite'
+
+VISIT_SAMPLE_DAYS = 7
+
+# An ad missing for longer than this and then seen again counts as re-listed
+RELIST_GAP_DAYS = 3
+
+TRACKED_FIELDS = ('price', 'currency', 'status', 'publish_date')
+
+COMMIT_EVERY = 500
+
+DAY = 24 * 60 * 60
+
+
+# Function to reduce a record to the tracked values
+def tracked_values(record):
+    try:
+        published = to_timestamp(record.get('Publish Date'))
+    except ValueError:
+        published = None
+    status = record.get('Status')
+    currency = record.get('Currency')
+    return {
+        'price': to_int(record.get('Price')),
+        'currency': None if currency in (None, MISSING) else str(currency),
+        'status': None if status in (None, MISSING) else str(status),
+        'publish_date': published.isoformat(sep=' ') if published else None,
+    }
+
+
+class HistoryStore:
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.pending_writes = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS ads (
+                adv_id TEXT PRIMARY KEY,
+                first_seen INTEGER NOT NULL,
+                last_seen INTEGER NOT NULL,
+                price INTEGER,
+                currency TEXT,
+                status TEXT,
+                publish_date TEXT,
+                visits_sampled_at INTEGER
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS changes (
+                adv_id TEXT NOT NULL,
+                observed_at INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                old TEXT,
+                new TEXT,
+                PRIMARY KEY (adv_id, observed_at, field)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS changes_price ON changes (observed_at) WHERE field = 'price';
+            CREATE TABLE IF NOT EXISTS visits (
+                adv_id TEXT NOT NULL,
+                observed_at INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (adv_id, observed_at)
+            ) WITHOUT ROWID;
+        ''')
+        self.db.commit()
+
+    # Function to record one observation of an ad; returns the changed fields
+    def observe(self, record, observed_at=None):
+        adv_id = parse_adv_id(record.get('URL') or '')
+        if adv_id == MISSING:
+            return []
+        now = int(observed_at if observed_at is not None else time.time())
+        values = tracked_values(record)
+        row = self.db.execute(
+            'SELECT last_seen, price, currency, status, publish_date, visits_sampled_at FROM ads WHERE adv_id = ?',
+            (adv_id,)).fetchone()
+
+        changed = []
+        if row is None:
+            self._change(adv_id, now, 'listed', None, values['price'])
+            self.db.execute('INSERT INTO ads VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+                            (adv_id, now, now, values['price'], values['currency'], values['status'],
+                             values['publish_date']))
+            visits_sampled_at = None
+            changed.append('listed')
+        else:
+            last_seen, visits_sampled_at = row[0], row[5]
+            if now < last_seen:
+                # Older snapshot than what's stored; history only moves forward
+                return []
+            if now - last_seen > RELIST_GAP_DAYS * DAY:
+                self._change(adv_id, now, 'relisted', datetime.fromtimestamp(last_seen).date().isoformat(), None)
+                changed.append('relisted')
+            for field, old in zip(TRACKED_FIELDS, row[1:5]):
+                if values[field] is not None and values[field] != old:
+                    self._change(adv_id, now, field, old, values[field])
+                    changed.append(field)
+            self.db.execute('UPDATE ads SET last_seen = ?, price = COALESCE(?, price), '
+                            'currency = COALESCE(?, currency), status = COALESCE(?, status), '
+                            'publish_date = COALESCE(?, publish_date) WHERE adv_id = ?',
+                            (now, values['price'], values['currency'], values['status'],
+                             values['publish_date'], adv_id))
+
+        visits = to_int(record.get('Visits Count'))
+        if visits is not None and (visits_sampled_at is None or now - visits_sampled_at >= VISIT_SAMPLE_DAYS * DAY):
+            self.db.execute('INSERT OR REPLACE INTO visits VALUES (?, ?, ?)', (adv_id, now, visits))
+            self.db.execute('UPDATE ads SET visits_sampled_at = ? WHERE adv_id = ?', (now, adv_id))
+
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending_writes = 0
+        return changed
+
+    # Function to record that an ad is still listed, without taking its
+    # values (e.g. a record carried forward from an earlier run) as observed
+    def touch(self, record, observed_at=None):
+        adv_id = parse_adv_id(record.get('URL') or '')
+        if adv_id == MISSING:
+            return
+        now = int(observed_at if observed_at is not None else time.time())
+        self.db.execute('UPDATE ads SET last_seen = MAX(last_seen, ?) WHERE adv_id = ?', (now, adv_id))
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def _change(self, adv_id, observed_at, field, old, new):
+        self.db.execute('INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)',
+                        (adv_id, observed_at, field, None if old is None else str(old),
+                         None if new is None else str(new)))
+
+    # Function to return an ad's change events and visit samples in time order
+    def history(self, adv_id):
+        changes = [(datetime.fromtimestamp(observed_at), field, old, new) for observed_at, field, old, new in
+                   self.db.execute('SELECT observed_at, field, old, new FROM changes WHERE adv_id = ? '
+                                   'ORDER BY observed_at', (adv_id,))]
+        visits = [(datetime.fromtimestamp(observed_at), count) for observed_at, count in
+                  self.db.execute('SELECT observed_at, count FROM visits WHERE adv_id = ? ORDER BY observed_at',
+                                  (adv_id,))]
+        return changes, visits
+
+    # Function to list (adv_id, when, old price, new price) for price changes in the last `days` days
+    def price_changes(self, days=7, now=None):
+        since = int((now if now is not None else time.time()) - days * DAY)
+        return [(adv_id, datetime.fromtimestamp(observed_at), old, new) for adv_id, observed_at, old, new in
+                self.db.execute("SELECT adv_id, observed_at, old, new FROM changes "
+                                "WHERE field = 'price' AND observed_at >= ? ORDER BY observed_at", (since,))]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-ad price and visit history across runs")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help="record a CSV or Parquet snapshot")
+    ingest.add_argument('store')
+    ingest.add_argument('inputs', nargs='+')
+    ingest.add_argument('--date', help="when the snapshot was taken (YYYY-MM-DD, default: now)")
+
+    ad = commands.add_parser('ad', help="print the history of one ad")
+    ad.add_argument('store')
+    ad.add_argument('adv_id')
+
+    price_changes = commands.add_parser('price-changes', help="list ads whose price changed recently")
+    price_changes.add_argument('store')
+    price_changes.add_argument('--days', type=float, default=7)
+    return parser.parse_args()
+
+
+def main(args):
+    store = HistoryStore(args.store)
+    if args.command == 'ingest':
+        observed_at = datetime.fromisoformat(args.date).timestamp() if args.date else None
+        observed = 0
+        for path in args.inputs:
+            for rows in read_chunks(path):
+                for row in rows:
+                    store.observe(row, observed_at)
+                    observed += 1
+        print(f"Recorded {observed} observations in {args.store}")
+    elif args.command == 'ad':
+        changes, visits = store.history(args.adv_id)
+        for when, field, old, new in changes:
+            print(f"{when:%Y-%m-%d %H:%M} {field}: {old} -> {new}")
+        for when, count in visits:
+            print(f"{when:%Y-%m-%d %H:%M} visits: {count}")
+    else:
+        for adv_id, when, old, new in store.price_changes(args.days):
+            print(f"{when:%Y-%m-%d %H:%M} {adv_id}: {old} -> {new}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,160 +1,73 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import chardet
-import re
-from datetime import datetime
-from urllib.parse import urlparse, urljoin
+import os
+from parsing import parse_listing_page, parse_detail_page
+from record_writer import RecordWriter
+from fetcher import fetch_raw
+from encoding import encoding_summary
+from scheduler import RequestScheduler, scheduler_limits
+from retries import RetryPolicy, DeadLetters, FetchError
+from scrape_logging import setup_logging, get_logger, fields, SampledLog
+from metrics import write_env_snapshot
 import aiohttp
 import asyncio
 
-# Function to extract URLs of all pages from the pagination section
-def extract_pagination_urls(soup, base_url):
-    page_urls = []
-    for link in soup.find_all('a', class_='pageNumbersSelect'):
-        href = format_url(link['href'], base_url)
-        page_urls.append(href)
-    for link in soup.find_all('a', class_='pageNumbers'):
-        href = format_url(link['href'], base_url)
-        page_urls.append(href)
-    return page_urls
-
-# Function to format URLs correctly
-def format_url(href, base_url):
-    if href.startswith('//'):
-        return 'https:' + href
-    return urljoin(base_url, href)
-
-# Regular expression pattern to match Bulgarian date format
-def parse_date(date_str):
-    bulgarian_months = {
-        'януари': 1, 'февруари': 2, 'март': 3, 'април': 4, 'май': 5, 'юни': 6,
-        'юли': 7, 'август': 8, 'септември': 9, 'октомври': 10, 'ноември': 11, 'декември': 12
-    }
-    pattern = r"(Публикувана в|Коригирана в) (\d{2}:\d{2}) на (\d+) ([а-я]+), (\d{4}) год."
-    match = re.search(pattern, date_str, re.IGNORECASE)
-    if match:
-        action, time, day, month, year = match.groups()
-        month_number = bulgarian_months.get(month.lower(), 1)
-        date_time_str = f"{year}-{month_number:02d}-{day} {time}:00"
-        return action, datetime.strptime(date_time_str, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
-    return 'N/A', 'N/A'
-
-async def fetch(session, url):
-    async with session.get(url) as response:
-        raw_content = await response.read()
-        detected_encoding = chardet.detect(raw_content)['encoding']
-        return raw_content.decode(detected_encoding, errors='replace')
-
-async def fetch_property_details(session, href_value):
-    try:
-        detail_response = await fetch(session, href_value)
-        property_soup = BeautifulSoup(detail_response, 'html.parser')
-
-        ad_price_div = property_soup.find('div', class_='adPrice')
-        if ad_price_div:
-            # Extract price per square meter
-            price_per_sqm_span = ad_price_div.find('span', id='cenakv')
-            price_per_sqm = price_per_sqm_span.get_text(strip=True) if price_per_sqm_span else 'N/A'
-
-            # Extract publish or edit timestamp
-            info_div = ad_price_div.find('div', class_='info')
-            publish_time_div = info_div.find_all('div')[0] if info_div else None
-            if publish_time_div:
-                publish_time_text = publish_time_div.get_text(strip=True)
-                action, date_time = parse_date(publish_time_text)
-                if action == "Коригирана в":
-                    publish_date = 'N/A'
-                    edit_date = date_time
-                else:
-                    publish_date = date_time
-                    edit_date = 'N/A'
-            else:
-                publish_date = 'N/A'
-                edit_date = 'N/A'
+# Columns of properties.csv / private_seller_properties.csv
+COLUMNS = ('Price', 'Currency', 'URL', 'Seller', 'Location', 'Size', 'Floor', 'Year', 'Property Type',
+           'Phone', 'Price per sqm', 'Publish Date', 'Edit Date', 'Visits Count')
 
-            # Extract number of visits
-            visits_span = info_div.find('span', style='font-weight:bold;')
-            visits_count = visits_span.get_text(strip=True) if visits_span else 'N/A'
+# Parser backend: 'html.parser', 'lxml' or 'selectolax' (see parser_backends.py).
+# Run parser_parity.py over saved pages before switching.
+PARSER_BACKEND = 'html.parser'
 
-            return price_per_sqm, publish_date, edit_date, visits_count, href_value
-    except Exception as e:
-        print(f"An error occurred while fetching property details: {e}")
-        return 'N/A', 'N/A', 'N/A', 'N/A', href_value
+# URLs that failed for good, kept apart from optimised.py's dead_letters.jsonl
+DEAD_LETTERS_PATH = 'main4_dead_letters.jsonl'
 
-async def scrape_properties(session, url):
+log = get_logger('main4')
+# Per-property lines are sampled (see scrape_logging.py)
+record_log = SampledLog(log)
+
+async def fetch_property_details(session, href_value, scheduler, retry, dead_letters):
     try:
-        main_page_content = await fetch(session, url)
-        soup = BeautifulSoup(main_page_content, 'html.parser')
+        content, content_type = await fetch_raw(session, href_value, scheduler, retry=retry)
+        record = parse_detail_page(content, content_type, href_value, 'N/A', PARSER_BACKEND)
+
+        # An edited ad shows its edit time instead of its publish time
+        if record['Status'] == "Коригирана в":
+            publish_date, edit_date = 'N/A', record['Publish Date']
+        else:
+            publish_date, edit_date = record['Publish Date'], 'N/A'
+
+        return record['Price per sqm'], publish_date, edit_date, record['Visits Count'], href_value
+    except FetchError as e:
+        log.warning(f"An error occurred while fetching property details: {e}",
+                    extra=fields(url=href_value, error=type(e).__name__))
+        dead_letters.add(href_value, e)
+    except Exception as e:
+        # Fetched but not parsed; fetching it again wouldn't help, so no dead letter
+        log.warning(f"An error occurred while parsing property details: {e}",
+                    extra=fields(url=href_value, error=type(e).__name__), exc_info=True)
+    return 'N/A', 'N/A', 'N/A', 'N/A', href_value
 
-        properties = soup.find_all('table', width='660', cellspacing='0', cellpadding='0', border='0')
+# page is the raw (content, Content-Type) of url when it has already been fetched
+async def scrape_properties(session, url, scheduler, retry, dead_letters, page=None):
+    try:
+        content, content_type = page or await fetch_raw(session, url, scheduler, retry=retry)
+        listings, _ = parse_listing_page(content, content_type, url, backend=PARSER_BACKEND)
 
         property_data = []
         private_seller_data = []
         seen_urls = set()
 
-        phone_pattern = r'тел\.: (\d{10,12})'
-        price_pattern = r'(\d+\s?\d*)\s*(лв\.|EUR)'
-
         tasks = []
 
-        for property_table in properties:
-            try:
-                price_div = property_table.find('div', class_='price')
-                price_text = price_div.get_text(strip=True) if price_div else 'N/A'
-
-                price_match = re.search(price_pattern, price_text)
-                if price_match:
-                    price = int(price_match.group(1).replace(' ', ''))
-                    currency = price_match.group(2)
-                else:
-                    price = 'N/A'
-                    currency = 'N/A'
-
-                href_a_tag = property_table.find('a', class_='photoLink')
-                href_value = href_a_tag['href'] if href_a_tag else 'N/A'
-
-                if href_value != 'N/A':
-                    href_value = format_url(href_value, url)
-
-                seller_a_tag = property_table.find('a', class_='logoLink')
-                seller = seller_a_tag['href'].replace('//', '') if seller_a_tag else 'N/A'
-
-                location_a_tag = property_table.find('a', class_='lnk2')
-                location = location_a_tag.get_text(strip=True) if location_a_tag else 'N/A'
-
-                property_type_a_tag = property_table.find('a', class_='lnk1')
-                property_type = property_type_a_tag.get_text(strip=True) if property_type_a_tag else 'N/A'
-
-                description_td = property_table.find('td', width='520', colspan='3', height='50', style='padding-left:4px')
-                if description_td:
-                    description_text = description_td.get_text(strip=True)
-
-                    size_pattern = r'(\d+)\s*кв\.м'
-                    size_match = re.search(size_pattern, description_text)
-                    size = size_match.group(1) if size_match else 'N/A'
-
-                    floor_pattern = r'(\d+)-ти\s*ет'
-                    floor_match = re.search(floor_pattern, description_text)
-                    floor = floor_match.group(1) if floor_match else 'N/A'
-
-                    year_pattern = r'Тухла\s*(\d{4})\s*г\.'
-                    year_match = re.search(year_pattern, description_text)
-                    year = year_match.group(1) if year_match else 'N/A'
-
-                    phone_number = 'N/A'
-                    phone_match = re.search(phone_pattern, description_text)
-                    if phone_match:
-                        phone_number = phone_match.group(1)
-
-                    if href_value != 'N/A' and price != 'N/A' and href_value not in seen_urls:
-                        seen_urls.add(href_value)
-                        task = asyncio.ensure_future(fetch_property_details(session, href_value))
-                        tasks.append(task)
-                        property_entry = (price, currency, href_value, seller, location, size, floor, year, property_type, phone_number)
-                        property_data.append(property_entry)
-            except Exception as e:
-                print(f"An error occurred while scraping property: {e}")
+        for listing in listings:
+            href_value = listing['URL']
+            # Ads without a price are skipped, and an ad shown twice on the page is kept once
+            if listing['Price'] != 'N/A' and href_value not in seen_urls:
+                seen_urls.add(href_value)
+                task = asyncio.ensure_future(fetch_property_details(session, href_value, scheduler, retry,
+                                                                      dead_letters))
+                tasks.append(task)
+                property_data.append(listing)
 
         results = await asyncio.gather(*tasks)
 
@@ -162,70 +75,76 @@ async def scrape_properties(session, url):
 
         for i, result in enumerate(results):
             price_per_sqm, publish_date, edit_date, visits_count, detail_url = result
-            price, currency, href_value, seller, location, size, floor, year, property_type, phone_number = property_data[i]
-
-            property_entry = {
-                'Price': price,
-                'Currency': currency,
-                'URL': detail_url,  # Store the second URL
-                'Seller': seller,
-                'Location': location,
-                'Size': size,
-                'Floor': floor,
-                'Year': year,
-                'Property Type': property_type,
-                'Phone': phone_number,
-                'Price per sqm': price_per_sqm,
-                'Publish Date': publish_date,
-                'Edit Date': edit_date,  # Added field for edit date
-                'Visits Count': visits_count
-            }
-
-            if seller == 'N/A':
+            property_entry = dict(property_data[i])
+            property_entry['URL'] = detail_url  # Store the second URL
+            property_entry['Price per sqm'] = price_per_sqm
+            property_entry['Publish Date'] = publish_date
+            property_entry['Edit Date'] = edit_date  # Added field for edit date
+            property_entry['Visits Count'] = visits_count
+
+            if property_entry['Seller'] == 'N/A':
                 private_seller_data.append(property_entry)
             else:
                 final_property_data.append(property_entry)
 
-            print(f"Price: {price}, Currency: {currency}, URL: {detail_url}, Seller: {seller}, Location: {location}, Size: {size}, Floor: {floor}, Year: {year}, Property Type: {property_type}, Phone: {phone_number}")
-            print(f"Price per sqm: {price_per_sqm}, Publish Date: {publish_date}, Edit Date: {edit_date}, Visits Count: {visits_count}")
+            record_log.debug("Scraped property", **property_entry)
 
         return final_property_data, private_seller_data
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching page {url}: {e}")
+    except FetchError as e:
+        # Only after the retries; the page is in main4_dead_letters.jsonl for a later run
+        log.error(f"Error fetching page {url}: {e}", extra=fields(url=url, error=type(e).__name__))
+        dead_letters.add(url, e)
+        return [], []
+    except Exception as e:
+        log.error(f"Error parsing page {url}: {e}", extra=fields(url=url, error=type(e).__name__), exc_info=True)
         return [], []
 
 async def main():
-    base_url = 'https://imoti-plovdiv.imot.bg/'  # replace with actual URL
-
-    async with aiohttp.ClientSession() as session:
-        main_page_content = await fetch(session, base_url)
-        soup = BeautifulSoup(main_page_content, 'html.parser')
+    base_url = os.environ.get('IMOT_BASE_URL', 'https://imoti-plovdiv.imot.bg/')  # set IMOT_BASE_URL to crawl another search
 
-        page_urls = [base_url] + extract_pagination_urls(soup, base_url)
-        print(f"Total pages to scrape: {len(page_urls)}")
-
-        all_property_data = []
-        all_private_seller_data = []
-
-        tasks = []
-        for url in page_urls:
-            task = asyncio.ensure_future(scrape_properties(session, url))
-            tasks.append(task)
-
-        results = await asyncio.gather(*tasks)
-
-        for property_data, private_seller_data in results:
-            all_property_data.extend(property_data)
-            all_private_seller_data.extend(private_seller_data)
-
-        df = pd.DataFrame(all_property_data)
-        df_private = pd.DataFrame(all_private_seller_data)
-
-        df.to_csv('properties.csv', index=False)
-        df_private.to_csv('private_seller_properties.csv', index=False)
-
-        print("Scraping completed and data saved to properties.csv and private_seller_properties.csv")
+    # Limits from the IMOT_* variables (see scheduler.py), or the defaults
+    scheduler = RequestScheduler(**scheduler_limits())
+    retry = RetryPolicy()
+    dead_letters = DeadLetters(DEAD_LETTERS_PATH)
+    try:
+        async with aiohttp.ClientSession() as session:
+            reporter = asyncio.create_task(scheduler.report())
+            try:
+                first_page = await fetch_raw(session, base_url, scheduler, retry=retry)
+
+                # Every page of the search, deduplicated, this page first (see pagination.py)
+                _, page_urls = parse_listing_page(*first_page, base_url, True, PARSER_BACKEND)
+                log.info(f"Total pages to scrape: {len(page_urls)}", extra=fields(pages=len(page_urls)))
+
+                tasks = []
+                for index, url in enumerate(page_urls):
+                    # The first page is base_url, already fetched above
+                    task = asyncio.ensure_future(scrape_properties(session, url, scheduler, retry, dead_letters,
+                                                                   first_page if index == 0 else None))
+                    tasks.append(task)
+
+                # Write each page's properties as soon as the page is done, rather
+                # than holding every page's results until the end
+                with RecordWriter('properties.csv', COLUMNS) as property_writer, \
+                        RecordWriter('private_seller_properties.csv', COLUMNS) as private_seller_writer:
+                    for task in asyncio.as_completed(tasks):
+                        property_data, private_seller_data = await task
+                        property_writer.write_many(property_data)
+                        private_seller_writer.write_many(private_seller_data)
+            finally:
+                reporter.cancel()
+    finally:
+        dead_letters.close()
+        write_env_snapshot()
+
+    log.info("Scraping completed and data saved to properties.csv and private_seller_properties.csv")
+    log.info(f"Encoding resolution: {encoding_summary()}")
+    log.info(f"Retries: {retry.summary()}")
+    if dead_letters.count:
+        log.warning(f"{dead_letters.count} URLs failed and were written to {dead_letters.path}",
+                    extra=fields(dead_letters=dead_letters.count))
 
 if __name__ == '__main__':
+    setup_logging()
     asyncio.run(main())
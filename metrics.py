@@ -0,0 +1,238 @@
+import asyncio
+import bisect
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Per-stage instrumentation for the crawl. Each stage (fetch, decode, chardet,
+# parse, extract, write) records a latency histogram, byte counts and errors
+# by exception type, and every emitted record updates the fraction of 'N/A'
+# per field. optimised.py can serve the live numbers in the Prometheus text
+# format (--metrics-port) or write them as a JSON snapshot every few seconds
+# (--metrics-json), and logs a summary to scraping_log.log at the end.
+#
+# Parse worker processes have their own crawl_metrics; ParsePool sends each
+# call's numbers back to the parent and merges them in.
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+SNAPSHOT_INTERVAL = 10.0
+
+# Set by crawl_benchmark.py: where a crawler writes its final JSON snapshot
+METRICS_JSON_VARIABLE = 'IMOT_METRICS_JSON'
+
+MISSING_VALUES = (None, '', 'N/A')
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the overflow (+Inf) bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+    # Upper bound of the bucket holding the q-th value (the last finite bound for overflow)
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {'counts': self.counts, 'count': self.count, 'sum': self.total}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts, histogram.count, histogram.total = list(data['counts']), data['count'], data['sum']
+        return histogram
+
+
+class CrawlMetrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+        self.bytes = Counter()
+        self.errors = Counter()
+        self.records = 0
+        self.missing = Counter()
+
+    def _histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        return histogram
+
+    # Time the block as one call of `stage`; an exception is counted by type and re-raised
+    @contextmanager
+    def time(self, stage, nbytes=0):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[(stage, type(e).__name__)] += 1
+            raise
+        finally:
+            self._histogram(stage).observe(time.perf_counter() - started)
+            if nbytes:
+                self.bytes[stage] += nbytes
+
+    def add_bytes(self, stage, nbytes):
+        self.bytes[stage] += nbytes
+
+    def error(self, stage, e):
+        self.errors[(stage, type(e).__name__)] += 1
+
+    # Function to count the fields of an emitted record that came out as 'N/A'
+    def record_fields(self, record):
+        self.records += 1
+        for field, value in record.items():
+            if value in MISSING_VALUES:
+                self.missing[field] += 1
+            elif field not in self.missing:
+                self.missing[field] = 0
+
+    def to_dict(self):
+        return {
+            'stages': {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            'bytes': dict(self.bytes),
+            'errors': [[stage, error, count] for (stage, error), count in self.errors.items()],
+            'records': self.records,
+            'missing': dict(self.missing),
+        }
+
+    def merge(self, data):
+        for stage, histogram in data['stages'].items():
+            self._histogram(stage).merge(Histogram.from_dict(histogram))
+        self.bytes.update(data['bytes'])
+        for stage, error, count in data['errors']:
+            self.errors[(stage, error)] += count
+        self.records += data['records']
+        self.missing.update(data['missing'])
+
+    # Readable view: per-stage count, mean/p50/p99 in ms and bytes, errors and N/A fractions
+    def snapshot(self):
+        stages = {}
+        for stage, histogram in self.stages.items():
+            stages[stage] = {
+                'count': histogram.count,
+                'mean_ms': histogram.total / histogram.count * 1000 if histogram.count else None,
+                'p50_ms': (histogram.quantile(0.5) or 0) * 1000,
+                'p99_ms': (histogram.quantile(0.99) or 0) * 1000,
+                'total_s': histogram.total,
+                'bytes': self.bytes.get(stage, 0),
+            }
+        return {
+            'elapsed_s': time.time() - self.started,
+            'stages': stages,
+            'errors': {f"{stage}/{error}": count for (stage, error), count in self.errors.items()},
+            'records': self.records,
+            'missing_fraction': {field: count / self.records for field, count in self.missing.items()}
+                                if self.records else {},
+        }
+
+    def prometheus(self):
+        lines = ['# TYPE imot_stage_seconds histogram']
+        for stage, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'imot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'imot_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'imot_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines.append('# TYPE imot_stage_bytes_total counter')
+        lines += [f'imot_stage_bytes_total{{stage="{stage}"}} {nbytes}' for stage, nbytes in self.bytes.items()]
+        lines.append('# TYPE imot_stage_errors_total counter')
+        lines += [f'imot_stage_errors_total{{stage="{stage}",type="{error}"}} {count}'
+                  for (stage, error), count in self.errors.items()]
+        lines.append('# TYPE imot_records_total counter')
+        lines.append(f'imot_records_total {self.records}')
+        lines.append('# TYPE imot_field_missing_ratio gauge')
+        if self.records:
+            lines += [f'imot_field_missing_ratio{{field="{field}"}} {count / self.records}'
+                      for field, count in self.missing.items()]
+        return '\n'.join(lines) + '\n'
+
+    # Function to return the end-of-run summary as lines of text
+    def summary_lines(self):
+        snapshot = self.snapshot()
+        lines = [f"Run took {snapshot['elapsed_s']:.1f}s, {self.records} records"]
+        for stage, stats in snapshot['stages'].items():
+            line = (f"{stage}: {stats['count']} calls, {stats['total_s']:.2f}s total, "
+                    f"mean {stats['mean_ms']:.1f}ms, p50 <= {stats['p50_ms']:g}ms, p99 <= {stats['p99_ms']:g}ms")
+            if stats['bytes']:
+                line += f", {stats['bytes'] / 1024:,.0f} KB"
+            lines.append(line)
+        if snapshot['errors']:
+            lines.append("Errors: " + ', '.join(f"{key}={count}" for key, count in snapshot['errors'].items()))
+        missing = {field: fraction for field, fraction in snapshot['missing_fraction'].items() if fraction}
+        if missing:
+            lines.append("N/A fraction: " + ', '.join(f"{field}={fraction:.1%}" for field, fraction in
+                                                      sorted(missing.items(), key=lambda item: -item[1])))
+        return lines
+
+
+# Metrics for this process
+crawl_metrics = CrawlMetrics()
+
+
+# Function to serve /metrics (Prometheus text) and /metrics.json until the runner is cleaned up
+async def serve_metrics(port, host='127.0.0.1'):
+    async def text(request):
+        return web.Response(text=crawl_metrics.prometheus(), content_type='text/plain')
+
+    async def snapshot(request):
+        return web.json_response(crawl_metrics.snapshot())
+
+    app = web.Application()
+    app.router.add_get('/metrics', text)
+    app.router.add_get('/metrics.json', snapshot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def write_snapshot(path):
+    part_path = path + '.part'
+    with open(part_path, 'w', encoding='utf-8') as f:
+        json.dump(crawl_metrics.snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(part_path, path)
+
+
+# Function to write the JSON snapshot to $IMOT_METRICS_JSON, if it is set
+def write_env_snapshot(environ=None):
+    path = (os.environ if environ is None else environ).get(METRICS_JSON_VARIABLE)
+    if path:
+        write_snapshot(path)
+
+
+# Periodically write the JSON snapshot until cancelled
+async def write_snapshots(path, interval=SNAPSHOT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        write_snapshot(path)
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from collections import Counter
+
+from pymongo import AsyncMongoClient
+from pymongo.results import BulkWriteResult
+
+from scrape_logging import get_logger, fields
+from mongoconnect import INDEXES, DATABASE, COLLECTION, to_document, upsert_pairs, upsert_operations, \
+    count_result, summary
+
+# Writes records from the async crawler straight into MongoDB, upserted by ad
+# id exactly as mongoconnect.py does. Records are sent in batches of up to
+# BATCH_SIZE, or whatever has arrived after FLUSH_INTERVAL seconds. At most
+# MAX_IN_FLIGHT bulk writes run at once; when that many are outstanding,
+# write() waits, which backs up the record queue and slows the crawl to the
+# rate MongoDB can absorb.
+#
+# open_collection('memory://') returns an in-memory stand-in, so the sink can
+# be exercised without a mongod.
+
+log = get_logger('mongo_sink')
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 5.0
+MAX_IN_FLIGHT = 2
+
+MEMORY_URI = 'memory://'
+
+
+class MongoSink:
+    def __init__(self, collection, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_in_flight=MAX_IN_FLIGHT):
+        self.collection = collection
+        # How a batch becomes bulk_write operations; the in-memory stand-in takes plain pairs
+        self.operations = upsert_pairs if isinstance(collection, MemoryCollection) else upsert_operations
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.pending = []
+        self.oldest_pending = None
+        self.writes = set()
+        self.flusher = None
+        self.stats = Counter()
+
+    async def start(self):
+        for keys, options in INDEXES:
+            await self.collection.create_index(keys, **options)
+        self.flusher = asyncio.create_task(self._flush_periodically())
+
+    async def write(self, record):
+        document = to_document(record)
+        if document is None:
+            self.stats['skipped'] += 1
+            return
+        if not self.pending:
+            self.oldest_pending = time.monotonic()
+        self.pending.append(document)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+
+    # Function to hand the pending documents to a background bulk write,
+    # waiting first if MAX_IN_FLIGHT writes are already running
+    async def flush(self):
+        if not self.pending:
+            return
+        await self.in_flight.acquire()
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self._bulk_write(batch))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    async def _bulk_write(self, batch):
+        try:
+            result = await self.collection.bulk_write(self.operations(batch), ordered=False)
+            count_result(self.stats, result)
+        except Exception as e:
+            self.stats['failed'] += len(batch)
+            log.error(f"MongoDB bulk write of {len(batch)} documents failed: {e}",
+                      extra=fields(documents=len(batch), error=type(e).__name__))
+        finally:
+            self.in_flight.release()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval / 2)
+            if self.pending and time.monotonic() - self.oldest_pending >= self.flush_interval:
+                await self.flush()
+
+    # Function to write whatever is left and wait for every bulk write to finish
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+        await self.flush()
+        await asyncio.gather(*self.writes)
+
+    def summary(self):
+        return summary(self.stats) + f", failed={self.stats['failed']}"
+
+
+# In-memory stand-in for an async collection, implementing just the upserts
+# MongoSink issues. Documents are kept in a dict by adv_id. The sink hands it
+# the (filter, update) pairs from upsert_pairs() rather than UpdateOne
+# operations, which don't expose them.
+class MemoryCollection:
+    def __init__(self):
+        self.documents = {}
+
+    async def create_index(self, keys, **options):
+        return '_'.join(f"{key}_{direction}" for key, direction in keys)
+
+    async def bulk_write(self, operations, ordered=True):
+        upserted, matched, modified = [], 0, 0
+        for index, (filter, update) in enumerate(operations):
+            key = filter['adv_id']
+            changes = update['$set']
+            document = self.documents.get(key)
+            if document is None:
+                self.documents[key] = dict(changes)
+                upserted.append({'index': index, '_id': key})
+                continue
+            matched += 1
+            if any(document.get(field) != value for field, value in changes.items()):
+                document.update(changes)
+                modified += 1
+        await asyncio.sleep(0)
+        return BulkWriteResult({'nUpserted': len(upserted), 'nMatched': matched, 'nModified': modified,
+                                'upserted': upserted}, True)
+
+
+# Function to return (client, collection) for a MongoDB URI, or the stand-in for memory://
+def open_collection(uri, database=DATABASE, collection=COLLECTION):
+    if uri == MEMORY_URI:
+        return None, MemoryCollection()
+    client = AsyncMongoClient(uri)
+    return client, client[database][collection]
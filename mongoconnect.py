@@ -1,21 +1,151 @@
+import argparse
+import os
+import time
+from collections import Counter
+
 import pandas as pd
-from pymongo import MongoClient
-
-# MongoDB setup
-print("Connecting to MongoDB...")
-mongo_client = MongoClient('mongodb://localhost:27017/')
-db = mongo_client['imot-scrape']
-collection = db['imoti-for-sale']
-
-# Read CSV data into DataFrame
-print("Importing CSV...")
-df = pd.read_csv('properties.csv', dtype={'Phone': str})
-
-# Ensure phone numbers are strings
-df['Phone'] = df['Phone'].astype(str)
-
-# Convert DataFrame to dictionary and insert into MongoDB
-print("Inserting data into MongoDB...")
-data_dict = df.to_dict("records")
-collection.insert_many(data_dict)
-print(f"Inserted {len(data_dict)} records from CSV into MongoDB.")
+import pyarrow.dataset as ds
+from pymongo import MongoClient, UpdateOne, ASCENDING
+
+from fields import parse_adv_id, MISSING
+from parquet_writer import DETAIL_SCHEMA
+
+# Loads scraped properties into MongoDB. The CSV (or the Parquet dataset from
+# optimised.py --format parquet) is streamed in chunks, and every row is
+# upserted by its ad id in unordered bulk writes, so rerunning a load updates
+# documents instead of duplicating them. Fields are typed with the Parquet
+# schema's converters, so a CSV load, a Parquet load and the crawler's sink
+# (mongo_sink.py) store the same BSON types for a field.
+#
+#   python mongoconnect.py
+#   python mongoconnect.py properties_parquet --batch-size 5000
+
+MONGO_URI = 'mongodb://localhost:27017/'
+DATABASE = 'imot-scrape'
+COLLECTION = 'imoti-for-sale'
+
+# Rows read and written per bulk_write
+BATCH_SIZE = 2000
+
+# Indexes on the collection: the unique ad id plus the usual query fields
+INDEXES = (
+    ([('adv_id', ASCENDING)], {'unique': True}),
+    ([('Location', ASCENDING)], {}),
+    ([('Property Type', ASCENDING)], {}),
+    ([('Publish Date', ASCENDING)], {}),
+)
+
+# Columns that look numeric but must stay strings (leading zeros)
+STRING_COLUMNS = {'Phone': str, 'Seller Phone': str}
+
+# Record column -> converter to its stored type
+CONVERTERS = {name: converter for name, _, converter in DETAIL_SCHEMA}
+
+
+def ensure_indexes(collection):
+    for keys, options in INDEXES:
+        collection.create_index(keys, **options)
+
+
+# Function to read the rows of a CSV file or Parquet dataset in chunks of dicts
+def read_chunks(path, batch_size=BATCH_SIZE):
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+        return
+
+    for chunk in pd.read_csv(path, dtype=STRING_COLUMNS, chunksize=batch_size):
+        if 'Publish Date' in chunk:
+            chunk['Publish Date'] = pd.to_datetime(chunk['Publish Date'], errors='coerce')
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield chunk.to_dict('records')
+
+
+# Function to turn a row into a typed document keyed by its ad id; None without
+# one. Missing fields (None, or 'N/A' in records straight from the scraper) are left out.
+def to_document(row):
+    adv_id = parse_adv_id(row.get('URL') or '')
+    if adv_id == MISSING:
+        return None
+    document = {}
+    for key, value in row.items():
+        converter = CONVERTERS.get(key)
+        if converter is not None:
+            value = converter(value)
+        if value is not None and value != MISSING:
+            document[key] = value
+    document['adv_id'] = adv_id
+    return document
+
+
+# Function to build the (filter, update) of each upsert for a batch of
+# documents. $set leaves a document untouched when nothing changed, so
+# matched-but-not-modified counts as unchanged.
+def upsert_pairs(documents):
+    return [({'adv_id': document['adv_id']}, {'$set': document}) for document in documents]
+
+
+def upsert_operations(documents):
+    return [UpdateOne(filter, update, upsert=True) for filter, update in upsert_pairs(documents)]
+
+
+# Function to add a bulk_write result to the inserted/updated/unchanged counts
+def count_result(stats, result):
+    stats['inserted'] += result.upserted_count
+    stats['updated'] += result.modified_count
+    stats['unchanged'] += result.matched_count - result.modified_count
+
+
+def load(collection, path, batch_size=BATCH_SIZE):
+    stats = Counter()
+    started = time.perf_counter()
+    for rows in read_chunks(path, batch_size):
+        documents = []
+        for row in rows:
+            document = to_document(row)
+            if document is None:
+                stats['skipped'] += 1
+            else:
+                documents.append(document)
+        if documents:
+            count_result(stats, collection.bulk_write(upsert_operations(documents), ordered=False))
+
+        elapsed = time.perf_counter() - started
+        loaded = stats['inserted'] + stats['updated'] + stats['unchanged']
+        print(f"{loaded} documents in {elapsed:.1f}s ({loaded / elapsed:.0f} docs/s): {summary(stats)}")
+    return stats, time.perf_counter() - started
+
+
+def summary(stats):
+    return ', '.join(f"{key}={stats[key]}" for key in ('inserted', 'updated', 'unchanged', 'skipped'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upsert scraped properties into MongoDB by ad id")
+    parser.add_argument('path', nargs='?', default='properties.csv',
+                        help="properties CSV, Parquet file or partitioned Parquet directory")
+    parser.add_argument('--uri', default=MONGO_URI)
+    parser.add_argument('--db', default=DATABASE)
+    parser.add_argument('--collection', default=COLLECTION)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    return parser.parse_args()
+
+
+def main(args):
+    print("Connecting to MongoDB...")
+    mongo_client = MongoClient(args.uri)
+    collection = mongo_client[args.db][args.collection]
+    ensure_indexes(collection)
+
+    print(f"Loading {args.path}...")
+    stats, elapsed = load(collection, args.path, args.batch_size)
+    for key in ('inserted', 'updated', 'unchanged'):
+        print(f"{key}: {stats[key]} ({stats[key] / elapsed:.0f}/s)")
+    if stats['skipped']:
+        print(f"skipped (no ad id in URL): {stats['skipped']}")
+    mongo_client.close()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,133 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from parquet_writer import to_floor
+
+# Turns the raw scraped output (the CSVs, or the Parquet dataset from
+# optimised.py --format parquet) into a typed frame for analysis. Every step is
+# a vectorised pandas/NumPy operation. load_properties() caches the result as
+# Parquet keyed by a hash of the input files, so repeated loads skip the work.
+#
+#   from normalise import load_properties
+#   df = load_properties()
+
+DEFAULT_INPUTS = ('properties.csv', 'private_seller_properties.csv')
+CACHE_DIR = '.normalise_cache'
+
+# Bump when normalise() changes so stale cached frames are not reused
+NORMALISE_VERSION = 2
+
+# Fixed lev/euro rate
+EUR_TO_BGN = 1.95583
+
+INT_COLUMNS = ('Size', 'Total Floors', 'Year', 'Visits Count')
+CATEGORY_COLUMNS = ('Currency', 'Seller Type', 'Material', 'Property Type', 'Location', 'Status')
+
+# Columns that look numeric but must stay strings (leading zeros)
+STRING_COLUMNS = {'Phone': str, 'Seller Phone': str}
+
+NUMBER_PATTERN = r'(-?\d+(?:[.,]\d+)?)'
+
+
+# Function to pull the first number out of text columns like '(1 424 EUR/m2)' or '2-ри'
+def extract_number(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('Float64')
+    text = series.astype('string').str.replace(r'\s', '', regex=True)
+    return pd.to_numeric(text.str.extract(NUMBER_PATTERN, expand=False).str.replace(',', '.'),
+                         errors='coerce').astype('Float64')
+
+
+# Function to convert amounts in 'EUR'/'лв.' to both currencies
+def convert_currency(amount, currency):
+    is_eur = currency.astype('string').str.startswith('EUR').fillna(False).to_numpy(dtype=bool)
+    values = amount.to_numpy(dtype='float64', na_value=np.nan)
+    bgn = np.where(is_eur, values * EUR_TO_BGN, values)
+    eur = np.where(is_eur, values, values / EUR_TO_BGN)
+    return pd.Series(bgn, index=amount.index), pd.Series(eur, index=amount.index)
+
+
+# Function to read '2-ри', '3-ти', '5', 'Партер' as floor numbers with the
+# Parquet writer's converter, run once per distinct value
+def parse_floor(series):
+    text = series.astype('string').str.strip()
+    floors = {value: to_floor(value) for value in text.dropna().unique()}
+    return text.map(floors).astype('Int64')
+
+
+# Function to type a raw properties frame
+def normalise(df):
+    df = df.copy()
+    df['Price'] = extract_number(df['Price'])
+    df['Price in BGN'], df['Price in EUR'] = convert_currency(df['Price'], df['Currency'])
+
+    for column in INT_COLUMNS:
+        if column in df:
+            df[column] = extract_number(df[column]).round().astype('Int64')
+    if 'Floor' in df:
+        df['Floor'] = parse_floor(df['Floor'])
+
+    # '(1424 EUR/m2)' is in the currency named in the text; fall back to
+    # price / size when the page had no price per sqm
+    if 'Price per sqm' in df:
+        sqm_text = df['Price per sqm'].astype('string')
+        sqm_currency = sqm_text.str.extract(r'(EUR|лв)', expand=False).fillna(df['Currency'].astype('string'))
+        df['Price per sqm'] = extract_number(df['Price per sqm'])
+        df['Price per sqm BGN'], _ = convert_currency(df['Price per sqm'], sqm_currency)
+    else:
+        df['Price per sqm BGN'] = np.nan
+    if 'Size' in df:
+        size = df['Size'].to_numpy(dtype='float64', na_value=np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            computed = np.where(size > 0, df['Price in BGN'].to_numpy() / size, np.nan)
+        df['Price per sqm BGN'] = df['Price per sqm BGN'].fillna(pd.Series(computed, index=df.index))
+
+    if 'Publish Date' in df:
+        df['Publish Date'] = pd.to_datetime(df['Publish Date'], errors='coerce')
+
+    for column in CATEGORY_COLUMNS:
+        if column in df:
+            df[column] = df[column].replace('N/A', np.nan).astype('category')
+    return df
+
+
+def read_raw(path):
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    try:
+        return pd.read_csv(path, dtype=STRING_COLUMNS)
+    except pd.errors.EmptyDataError:
+        # An empty DataFrame.to_csv() leaves a file with no header at all
+        return pd.DataFrame()
+
+
+# Cache key: the normaliser version plus each input's path, size and
+# modification time (hashing metadata keeps a cache hit in the milliseconds)
+def cache_key(paths):
+    digest = hashlib.sha256(f"v{NORMALISE_VERSION}".encode())
+    for path in paths:
+        for root, _, files in (os.walk(path) if os.path.isdir(path) else [('', None, [path])]):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f"{os.path.join(root, name)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:32]
+
+
+# Function to load and normalise the inputs, reusing a cached result when the inputs haven't changed
+def load_properties(paths=DEFAULT_INPUTS, cache_dir=CACHE_DIR):
+    paths = [path for path in paths if os.path.exists(path)]
+    cache_path = os.path.join(cache_dir, cache_key(paths) + '.parquet')
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    frames = [read_raw(path) for path in paths]
+    df = normalise(pd.concat([frame for frame in frames if len(frame)] or frames, ignore_index=True))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    part_path = cache_path + '.part'
+    df.to_parquet(part_path, index=False)
+    os.replace(part_path, cache_path)
+    return df
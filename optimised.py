@@ -1,226 +1,506 @@
+import argparse
+import os
 import asyncio
 import aiohttp
-import pandas as pd
-from bs4 import BeautifulSoup
-import re
-from datetime import datetime
-from urllib.parse import urlparse, urljoin
-import chardet
-
-# Function to extract URLs of all pages from the pagination section
-def extract_pagination_urls(soup, base_url):
-    page_urls = []
-
-    # First, extract the current page number
-    current_page_num = None
-    page_info_span = soup.find('span', class_='pageNumbersInfo')
-    if page_info_span:
-        page_info_text = page_info_span.get_text(strip=True)
-        if 'Страница' in page_info_text:
-            parts = page_info_text.split(' ')
-            current_page_num = int(parts[1])
-
-    # Next, extract URLs of all available pages
-    page_numbers_select = soup.find_all('a', class_='pageNumbersSelect')
-    for link in page_numbers_select:
-        href = link['href']
-        page_urls.append(format_url(href, base_url))
-
-    page_numbers = soup.find_all('a', class_='pageNumbers')
-    for link in page_numbers:
-        href = link['href']
-        page_urls.append(format_url(href, base_url))
-
-    return page_urls
-
-# Function to format URLs correctly
-def format_url(href, base_url):
-    if href.startswith('//'):
-        href = 'https:' + href
-    elif href.startswith('/'):
-        parsed_base_url = urlparse(base_url)
-        href = urljoin(base_url, href)
-    elif not href.startswith('http'):
-        href = urljoin(base_url, href)
-    return href
-
-# Regular expression pattern to match Bulgarian date format
-def parse_publish_date(date_str):
-    bulgarian_months = {
-        'януари': 1, 'февруари': 2, 'март': 3, 'април': 4, 'май': 5, 'юни': 6,
-        'юли': 7, 'август': 8, 'септември': 9, 'октомври': 10, 'ноември': 11, 'декември': 12
-    }
-    pattern = r"(Публикувана|Коригирана) в (\d{2}:\d{2}) на (\d+) ([а-я]+), (\d{4}) год."
-    match = re.search(pattern, date_str, re.IGNORECASE)
-    if match:
-        status, time, day, month, year = match.groups()
-        month_number = bulgarian_months.get(month.lower(), 1)
-        date_time_str = f"{year}-{month_number:02d}-{day} {time}:00"
-        return status, datetime.strptime(date_time_str, '%Y-%m-%d %H:%M:%S')
-    return 'N/A', 'N/A'
-
-async def fetch(session, url):
-    async with session.get(url) as response:
-        content = await response.read()
-        encoding = chardet.detect(content)['encoding']
-        return content.decode(encoding)
-
-async def scrape_properties(session, url):
+from fetcher import fetch_raw
+from encoding import encoding_summary
+from scheduler import RequestScheduler, add_scheduler_arguments, limits_from_args
+from retries import RetryPolicy, DeadLetters, DEFAULT_DEAD_LETTERS_PATH
+from parsing import parse_listing_page, parse_detail_page, DETAIL_COLUMNS
+from record_writer import RecordWriter
+from fields import parse_adv_id, MISSING
+from searches import Search, RoundRobinQueue, load_searches
+from parse_pool import ParsePool
+from http_cache import ResponseCache, DEFAULT_CACHE_PATH
+from crawl_state import CrawlState, DEFAULT_STATE_PATH, MAX_DETAIL_AGE_DAYS
+from crawl_journal import CrawlJournal, DEFAULT_JOURNAL_PATH
+from pagination import PageProgress, shard_pages
+from metrics import crawl_metrics, serve_metrics, write_snapshot, write_snapshots, METRICS_JSON_VARIABLE
+from scrape_logging import setup_logging, get_logger, fields, SampledLog, RECORD_SAMPLE_EVERY
+
+# Pipeline sizing: listing page workers, detail page workers and the bound on
+# each queue between the stages (a full queue blocks the stage feeding it)
+PAGE_WORKERS = 4
+DETAIL_WORKERS = 16
+QUEUE_SIZE = 100
+
+# Parsing runs in this many worker processes (0 parses on the event loop,
+# None uses every core), with at most MAX_PENDING_PARSES pages handed to the
+# pool at once (None means twice the worker count)
+PARSE_WORKERS = 0
+MAX_PENDING_PARSES = None
+
+# Parser backend: 'html.parser', 'lxml' or 'selectolax' (see parser_backends.py).
+# Run parser_parity.py over saved pages before switching.
+PARSER_BACKEND = 'html.parser'
+
+# Stand-in for "the module's default" in the --mongo/--aggregates/--history
+# options. Their modules pull in pandas, pyarrow or pymongo, so they are only
+# imported once the option is used.
+DEFAULT = 'default'
+
+# Parse only the page regions the extraction reads (see parse_benchmark.py)
+RESTRICTED_PARSE = False
+
+log = get_logger('optimised')
+# Per-record lines are sampled (see scrape_logging.py)
+record_log = SampledLog(log)
+
+# State shared by the pipeline stages for one run
+class Crawl:
+    def __init__(self, session, scheduler, parse_pool, cache=None, state=None, journal=None, mongo=None,
+                 aggregates=None, history=None, shard=None, searches=(), retry=None, dead_letters=None):
+        self.session = session
+        self.scheduler = scheduler
+        self.retry = retry
+        # URLs that still failed after their retries (see retries.py)
+        self.dead_letters = dead_letters
+        self.parse_pool = parse_pool
+        self.cache = cache
+        self.state = state
+        self.journal = journal
+        self.mongo = mongo
+        self.aggregates = aggregates
+        self.history = history
+        # (index, count) to crawl only that share of the pages, or None for all of them
+        self.shard = shard
+        self.progress = PageProgress()
+        # Listing pages of every search, taken in weighted round-robin order
+        self.page_queue = RoundRobinQueue(searches)
+        self.detail_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.record_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        # Ad key (see listing_key) -> search that queued it
+        self.seen_ads = {}
+        # Listings found again by a different search, and not fetched again
+        self.shared_listings = 0
+        # URLs whose previous record was carried forward unchanged (incremental mode)
+        self.carried_forward = set()
+
+    async def fetch(self, url):
+        return await fetch_raw(self.session, url, self.scheduler, self.cache, self.retry)
+
+    def failed(self, url, error, **context):
+        if self.dead_letters is not None:
+            self.dead_letters.add(url, error, **context)
+
+    async def parse_listing(self, content, content_type, url, include_pagination=False):
+        return await self.parse_pool.run(parse_listing_page, content, content_type, url, include_pagination,
+                                         PARSER_BACKEND, RESTRICTED_PARSE)
+
+    async def parse_detail(self, content, content_type, href_value, phone_number):
+        return await self.parse_pool.run(parse_detail_page, content, content_type, href_value, phone_number,
+                                         PARSER_BACKEND, RESTRICTED_PARSE)
+
+# Function to identify an ad across searches: its URL differs per search
+# (slink, f1), its adv id doesn't
+def listing_key(url):
+    adv_id = parse_adv_id(url)
+    return url if adv_id == MISSING else adv_id
+
+# Function to queue the listings of a parsed page, skipping ads already queued
+# by this or any other search. Each listing is tagged with its search.
+# In incremental mode unchanged ads skip the detail fetch and their previous
+# record goes straight to the sink.
+async def enqueue_listings(crawl, listings, search):
+    for listing in listings:
+        key = listing_key(listing['URL'])
+        if key in crawl.seen_ads:
+            if crawl.seen_ads[key] not in (search, None):
+                crawl.shared_listings += 1
+            continue
+        crawl.seen_ads[key] = search
+        listing['Search'] = search
+
+        if crawl.state is not None:
+            reason, previous_record = crawl.state.needs_detail(listing)
+            if reason is None:
+                record = dict(previous_record, Search=search)
+                crawl.carried_forward.add(record['URL'])
+                if crawl.journal is not None:
+                    crawl.journal.record_carried(record)
+                await crawl.record_queue.put(record)
+                continue
+        if crawl.journal is not None:
+            crawl.journal.detail_queued(listing)
+        await crawl.detail_queue.put(listing)
+
+# Stage 1: discover every search concurrently. A resumed crawl first
+# re-queues whatever the journal has left unfinished (carried-forward records
+# go straight to the sink), and only discovers the searches whose first page
+# was never completed. Unfinished detail pages are re-queued even when no
+# first page was, since a crash can land between queuing a first page's
+# listings and marking the page done. Retrying dead letters queues just those
+# URLs instead.
+async def discover_pages(crawl, searches, dead_letters=None):
+    if dead_letters is not None:
+        await requeue_dead_letters(crawl, searches, dead_letters)
+        return
+    if crawl.journal is not None:
+        first_pages = {search.url for search in searches}
+        started = [search for search in searches if crawl.journal.is_page_done(search.url)]
+        pending_details = crawl.journal.pending_details()
+        pending_carried = crawl.journal.pending_carried()
+        # Marked as seen here, so rediscovered first pages don't queue them twice
+        for listing in pending_details:
+            crawl.seen_ads[listing_key(listing['URL'])] = listing.get('Search')
+            await crawl.detail_queue.put(listing)
+        for record in pending_carried:
+            crawl.seen_ads[listing_key(record['URL'])] = record.get('Search')
+            crawl.carried_forward.add(record['URL'])
+            await crawl.record_queue.put(record)
+        pending_pages = [(url, name) for url, name in crawl.journal.pending_pages() if url not in first_pages]
+        crawl.progress.total += len(pending_pages)
+        for page_url, name in pending_pages:
+            await crawl.page_queue.put(name or searches[0].name, page_url)
+        if started or pending_details or pending_carried:
+            log.info(f"Resuming crawl: {crawl.journal.summary()}")
+        searches = [search for search in searches if search not in started]
+
+    await asyncio.gather(*(discover_search(crawl, search) for search in searches))
+
+# Function to fetch a search's first page, queue its listings, then queue its
+# other pages (up to max_pages, and only this shard's share of them)
+async def discover_search(crawl, search):
     try:
-        content = await fetch(session, url)
-        soup = BeautifulSoup(content, 'html.parser')
-
-        properties = soup.find_all('table', width='660', cellspacing='0', cellpadding='0', border='0')
-
-        property_data = []
-        private_seller_data = []
-        seen_urls = set()
-
-        for property_table in properties:
-            try:
-                href_a_tag = property_table.find('a', class_='photoLink')
-                href_value = href_a_tag['href'] if href_a_tag else 'N/A'
-                if href_value != 'N/A':
-                    href_value = format_url(href_value, url)
-
-                if href_value not in seen_urls:
-                    seen_urls.add(href_value)
-
-                    detail_content = await fetch(session, href_value)
-                    detail_soup = BeautifulSoup(detail_content, 'html.parser')
-
-                    ad_price_div = detail_soup.find('div', class_='adPrice')
-                    cena_div = ad_price_div.find('div', id='cena')
-                    price_text = cena_div.get_text(strip=True) if cena_div else 'N/A'
-                    price_pattern = r'(\d+\s?\d*)\s*(лв\.|EUR)'
-                    price_match = re.search(price_pattern, price_text)
-                    if price_match:
-                        price = int(price_match.group(1).replace(' ', ''))
-                        currency = price_match.group(2)
-                    else:
-                        price = 'N/A'
-                        currency = 'N/A'
-
-                    # Extract additional information from adParams
-                    ad_params_div = detail_soup.find('div', class_='adParams')
-                    size, floor, total_floors, material, year = 'N/A', 'N/A', 'N/A', 'N/A', 'N/A'
-                    if ad_params_div:
-                        for div in ad_params_div.find_all('div'):
-                            text = div.get_text(strip=True)
-                            if "Площ:" in text:
-                                size_text = text.split(":")[1].strip()
-                                size_match = re.search(r'(\d+)', size_text)
-                                size = int(size_match.group(1)) if size_match else 'N/A'
-                            elif "Етаж:" in text:
-                                floor_text = text.split(":")[1].strip()
-                                floor_match = re.search(r'(\d+)-ти от (\d+)', floor_text)
-                                if floor_match:
-                                    floor = floor_match.group(1)
-                                    total_floors = floor_match.group(2)
-                                else:
-                                    floor = floor_text.split(" ")[0]
-                            elif "Строителство:" in text:
-                                material_year_text = text.split(":")[1].strip()
-                                material_year_match = re.search(r'(.*), (\d{4}) г\.', material_year_text)
-                                if material_year_match:
-                                    material = material_year_match.group(1).strip()
-                                    year = material_year_match.group(2)
-
-                    # Extract publish timestamp
-                    info_div = ad_price_div.find('div', class_='info')
-                    publish_time_div = info_div.find('div')
-                    if publish_time_div:
-                        publish_time_text = publish_time_div.get_text(strip=True)
-                        status, publish_date = parse_publish_date(publish_time_text)
-                    else:
-                        publish_date = 'N/A'
-                        status = 'N/A'
-
-                    # Extract number of visits
-                    visits_span = info_div.find('span', style='font-weight:bold;')
-                    visits_count = visits_span.get_text(strip=True) if visits_span else 'N/A'
-
-                    # Extract location and property type
-                    adv_header_div = detail_soup.find('div', class_='advHeader')
-                    property_type_div = adv_header_div.find('div', class_='title')
-                    property_type = property_type_div.get_text(strip=True) if property_type_div else 'N/A'
-                    location_div = adv_header_div.find('div', class_='location')
-                    location = location_div.get_text(strip=True) if location_div else 'N/A'
-
-                    phone_pattern = r'тел\.: (\d{10,12})'
-                    description_td = property_table.find('td', width='520', colspan='3', height='50', style='padding-left:4px')
-                    phone_number = 'N/A'
-                    if description_td:
-                        description_text = description_td.get_text(strip=True)
-                        phone_match = re.search(phone_pattern, description_text)
-                        if phone_match:
-                            phone_number = phone_match.group(1)
-
-                    # Calculate price per sqm if not found
-                    price_per_sqm_span = ad_price_div.find('span', id='cenakv')
-                    if price_per_sqm_span:
-                        price_per_sqm = price_per_sqm_span.get_text(strip=True)
-                    else:
-                        price_per_sqm = price / size if size != 'N/A' and size != 0 else 'N/A'
-
-                    property_entry = {
-                        'Price': price,
-                        'Currency': currency,
-                        'URL': href_value,
-                        'Seller': 'N/A',  # Placeholder as it's not being captured in new logic
-                        'Location': location,
-                        'Size': size,
-                        'Floor': floor,
-                        'Total Floors': total_floors,
-                        'Year': year,
-                        'Material': material,
-                        'Property Type': property_type,
-                        'Phone': phone_number,
-                        'Price per sqm': price_per_sqm,
-                        'Publish Date': publish_date,
-                        'Visits Count': visits_count,
-                        'Status': status
-                    }
-
-                    property_data.append(property_entry)
-
-                    print(f"Price: {price}, Currency: {currency}, URL: {href_value}, Location: {location}, Size: {size}, Floor: {floor}, Total Floors: {total_floors}, Year: {year}, Material: {material}, Property Type: {property_type}, Phone: {phone_number}, Publish Date: {publish_date}, Visits Count: {visits_count}, Status: {status}")
-
-            except Exception as e:
-                print(f"An error occurred while scraping property: {e}")
-
-        return property_data, private_seller_data
-
+        content, content_type = await crawl.fetch(search.url)
+        listings, page_urls = await crawl.parse_listing(content, content_type, search.url, True)
     except Exception as e:
-        print(f"Error fetching page {url}: {e}")
-        return [], []
+        log.error(f"Error fetching first page of {search.name} {search.url}: {e}",
+                  extra=fields(search=search.name, url=search.url, error=type(e).__name__))
+        crawl.failed(search.url, e, search=search.name)
+        return
+
+    # page_urls is the full, deduplicated page list with the first page first
+    if search.max_pages:
+        page_urls = page_urls[:search.max_pages]
+    pages = shard_pages(page_urls, *crawl.shard) if crawl.shard else page_urls
+    if pages and pages[0] == search.url:
+        await enqueue_listings(crawl, listings, search.name)
+        pages = pages[1:]
+
+    crawl.progress.total += len(pages)
+    if crawl.journal is not None:
+        crawl.journal.page_completed(search.url, pages, search.name)
+    log.info(f"Total pages to scrape for {search.name}: {len(page_urls)}, {len(pages)} left to fetch",
+             extra=fields(search=search.name, pages=len(page_urls), queued=len(pages)))
+    for page_url in pages:
+        await crawl.page_queue.put(search.name, page_url)
+
+# Function to queue the entries of a dead-letter file: a search's first page
+# is discovered again, other listing pages and detail pages are queued as is
+async def requeue_dead_letters(crawl, searches, dead_letters):
+    by_url = {search.url: search for search in searches}
+    first_pages = []
+    for entry in dead_letters:
+        url, search = entry['url'], entry.get('search') or searches[0].name
+        if url in by_url:
+            first_pages.append(by_url[url])
+        elif entry['kind'] == 'detail':
+            listing = entry.get('listing') or {'URL': url, 'Phone': MISSING, 'Search': search}
+            crawl.seen_ads[listing_key(url)] = search
+            if crawl.journal is not None:
+                crawl.journal.detail_queued(listing)
+            await crawl.detail_queue.put(listing)
+        else:
+            crawl.progress.total += 1
+            await crawl.page_queue.put(search, url)
+    log.info(f"Retrying {len(dead_letters)} dead letters", extra=fields(dead_letters=len(dead_letters)))
+    await asyncio.gather(*(discover_search(crawl, search) for search in first_pages))
+
+# Stage 2: listing page workers turn page URLs into detail URLs
+async def listing_worker(crawl):
+    while True:
+        search, url = await crawl.page_queue.get()
+        try:
+            content, content_type = await crawl.fetch(url)
+            listings, _ = await crawl.parse_listing(content, content_type, url)
+            await enqueue_listings(crawl, listings, search)
+            if crawl.journal is not None:
+                crawl.journal.page_completed(url)
+        except Exception as e:
+            log.error(f"Error fetching page {url}: {e}", extra=fields(url=url, error=type(e).__name__))
+            crawl.failed(url, e, search=search)
+        finally:
+            if crawl.progress.page_done():
+                log.info(f"Listing pages: {crawl.progress.summary()}",
+                         extra=fields(done=crawl.progress.done, total=crawl.progress.total))
+            crawl.page_queue.task_done()
+
+# Stage 3: detail workers fetch and extract each property
+async def detail_worker(crawl):
+    while True:
+        listing = await crawl.detail_queue.get()
+        href_value = listing['URL']
+        try:
+            content, content_type = await crawl.fetch(href_value)
+            property_entry = await crawl.parse_detail(content, content_type, href_value, listing['Phone'])
+            property_entry['Search'] = listing.get('Search')
+            if crawl.state is not None:
+                crawl.state.record_detail(listing, property_entry)
+            await crawl.record_queue.put(property_entry)
+        except Exception as e:
+            log.error(f"An error occurred while scraping property {href_value}: {e}",
+                      extra=fields(url=href_value, error=type(e).__name__))
+            crawl.failed(href_value, e, search=listing.get('Search'), listing=listing)
+        finally:
+            crawl.detail_queue.task_done()
+
+# Stage 4: the sink streams records to the CSV (and MongoDB) as they arrive
+async def record_sink(crawl, property_writer):
+    while True:
+        property_entry = await crawl.record_queue.get()
+        try:
+            if crawl.journal is not None:
+                crawl.journal.record_emitted(property_entry)
+            with crawl_metrics.time('write'):
+                property_writer.write(property_entry)
+            crawl_metrics.record_fields(property_entry)
+            if crawl.aggregates is not None:
+                crawl.aggregates.add(property_entry)
+            if crawl.history is not None:
+                if property_entry['URL'] in crawl.carried_forward:
+                    # Values from an earlier run, not a new observation; only the listing is new
+                    crawl.history.touch(property_entry)
+                else:
+                    crawl.history.observe(property_entry)
+            if crawl.mongo is not None:
+                await crawl.mongo.write(property_entry)
+            record_log.debug("Scraped property", **property_entry)
+        except Exception as e:
+            # One bad record must not stop the sink, or record_queue.join() never returns
+            log.error(f"Error writing property {property_entry.get('URL')}: {e}",
+                      extra=fields(url=property_entry.get('URL'), error=type(e).__name__), exc_info=True)
+        finally:
+            crawl.record_queue.task_done()
+
+# Function to discover the pages and wait until every stage has drained its queue
+async def run_pipeline(crawl, searches, retried):
+    await discover_pages(crawl, searches, retried)
+
+    # Drain the stages in order; each join returns once every item
+    # put on that queue has been fully processed
+    await crawl.page_queue.join()
+    await crawl.detail_queue.join()
+    await crawl.record_queue.join()
+
+# Function to run the pipeline while watching the stage tasks: they only
+# end when cancelled, so one that finishes first has crashed, and waiting on
+# the queues it no longer drains would hang. Its exception is raised instead.
+async def supervise(pipeline, workers):
+    pipeline = asyncio.ensure_future(pipeline)
+    done, _ = await asyncio.wait([pipeline, *workers], return_when=asyncio.FIRST_COMPLETED)
+    if pipeline in done:
+        return pipeline.result()
+    pipeline.cancel()
+    await asyncio.gather(pipeline, return_exceptions=True)
+    for worker in done:
+        if worker.exception() is not None:
+            raise worker.exception()
+    raise RuntimeError("A pipeline stage stopped before the crawl finished")
+
+# Function to open the output for one dataset ('properties', ...) in the chosen
+# format; Parquet files are partitioned by each record's search
+def open_writer(args, name, searches):
+    if args.format == 'parquet':
+        from parquet_writer import SearchPartitionedWriter
+        return SearchPartitionedWriter(f"{name}_parquet", searches[0].name)
+    return RecordWriter(f"{name}.csv", DETAIL_COLUMNS + ('Search',))
+
+# Function to log the run's per-stage metrics summary (to scraping_log.log)
+def log_metrics(searches):
+    log.info(f"Crawl of {', '.join(search.name for search in searches)}",
+             extra=fields(searches={search.name: search.url for search in searches}))
+    for line in crawl_metrics.summary_lines():
+        log.info(line)
+    log.debug("Stage metrics", extra=fields(metrics=crawl_metrics.snapshot()))
+
+# Function to read --shard 'I/N' as (I, N)
+def parse_shard(value):
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Crawl imot.bg listings into properties.csv")
+    parser.add_argument('--config', default=None, metavar='PATH',
+                        help="JSON list of searches to crawl together, with priority and max_pages "
+                             "(see searches.py; default: the one search in IMOT_BASE_URL)")
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_PATH, default=None, metavar='PATH',
+                        help=f"cache responses on disk (default path: {DEFAULT_CACHE_PATH})")
+    parser.add_argument('--offline', action='store_true',
+                        help="serve every page from the cache and never touch the site (implies --cache)")
+    parser.add_argument('--incremental', nargs='?', const=DEFAULT_STATE_PATH, default=None, metavar='PATH',
+                        help="only fetch detail pages of new, changed or stale ads, carrying the rest "
+                             f"forward from the state store (default path: {DEFAULT_STATE_PATH})")
+    parser.add_argument('--max-detail-age', type=float, default=MAX_DETAIL_AGE_DAYS, metavar='DAYS',
+                        help="refetch detail pages older than this in incremental mode")
+    parser.add_argument('--journal', default=DEFAULT_JOURNAL_PATH, metavar='PATH',
+                        help=f"crawl journal used by --resume (default: {DEFAULT_JOURNAL_PATH})")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue the crawl recorded in the journal instead of starting over")
+    parser.add_argument('--format', choices=('csv', 'parquet'), default='csv',
+                        help="write properties.csv, or a typed Parquet dataset partitioned by scrape date "
+                             "and search under properties_parquet/")
+    parser.add_argument('--mongo', nargs='?', const=DEFAULT, default=None, metavar='URI',
+                        help="also upsert records into MongoDB as they are scraped (default URI: MONGO_URI in "
+                             "mongoconnect.py; memory:// uses an in-memory stand-in)")
+    parser.add_argument('--aggregates', nargs='?', const=DEFAULT, default=None, metavar='PATH',
+                        help="update the market aggregates store with every record "
+                             "(default path: aggregates.json; query it with aggregates.py)")
+    parser.add_argument('--history', nargs='?', const=DEFAULT, default=None, metavar='PATH',
+                        help="record price/status changes and visit counts per ad across runs "
+                             "(default path: listing_history.sqlite; query it with listing_history.py)")
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help="serve live per-stage metrics at http://127.0.0.1:PORT/metrics (Prometheus text) "
+                             "and /metrics.json")
+    parser.add_argument('--metrics-json', default=os.environ.get(METRICS_JSON_VARIABLE), metavar='PATH',
+                        help="write a JSON snapshot of the per-stage metrics to PATH every few seconds "
+                             f"(default: ${METRICS_JSON_VARIABLE})")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='I/N',
+                        help="crawl only every N-th page of the search, starting at page I+1 (0-based I); "
+                             "run one process per shard, each with its own --journal and output directory")
+    parser.add_argument('--dead-letters', default=DEFAULT_DEAD_LETTERS_PATH, metavar='PATH',
+                        help="write the URLs that still failed after their retries to PATH, one JSON object "
+                             f"per line (default: {DEFAULT_DEAD_LETTERS_PATH})")
+    parser.add_argument('--retry-dead-letters', nargs='?', const=DEFAULT_DEAD_LETTERS_PATH, default=None,
+                        metavar='PATH', help="fetch only the URLs in a dead-letter file, adding their records to "
+                                             "the journalled crawl's output (implies --resume)")
+    add_scheduler_arguments(parser)
+    parser.add_argument('--log-sample', type=int, default=RECORD_SAMPLE_EVERY, metavar='N',
+                        help="log every N-th scraped record to scraping_log.log (1 logs them all)")
+    parser.add_argument('--log-text', action='store_true',
+                        help="write scraping_log.log as plain text instead of JSON lines")
+    args = parser.parse_args()
+    if args.offline and args.cache is None:
+        args.cache = DEFAULT_CACHE_PATH
+    if args.retry_dead_letters:
+        args.resume = True
+    return args
+
+async def main(args):
+    if args.config:
+        searches = load_searches(args.config)
+    else:
+        base_url = os.environ.get('IMOT_BASE_URL', 'https://www.imot.bg/pcgi/imot.cgi?act=3&slink=av2f36&f1=1')
+        searches = [Search(base_url)]
+    crawl_metrics.reset()
+    scheduler = RequestScheduler(**limits_from_args(args))
+    retry = RetryPolicy()
+    # Read before the new run's dead-letter file replaces it
+    retried = DeadLetters.load(args.retry_dead_letters) if args.retry_dead_letters else None
+    dead_letters = DeadLetters(args.dead_letters)
+    parse_pool = ParsePool(PARSE_WORKERS, MAX_PENDING_PARSES)
+    cache = ResponseCache(args.cache, offline=args.offline) if args.cache else None
+    state = CrawlState(args.incremental, args.max_detail_age) if args.incremental else None
+    journal = CrawlJournal(args.journal)
+    journal.start(' '.join(search.url for search in searches), args.resume,
+                  [(search.url, search.name) for search in searches])
+
+    property_writer = open_writer(args, 'properties', searches)
+    private_seller_writer = open_writer(args, 'private_seller_properties', searches)
+    aggregates, history = None, None
+    if args.aggregates:
+        from aggregates import MarketAggregates, DEFAULT_AGGREGATES_PATH
+        if args.aggregates == DEFAULT:
+            args.aggregates = DEFAULT_AGGREGATES_PATH
+        aggregates = MarketAggregates.load(args.aggregates)
+    if args.history:
+        from listing_history import HistoryStore, DEFAULT_HISTORY_PATH
+        history = HistoryStore(DEFAULT_HISTORY_PATH if args.history == DEFAULT else args.history)
+    # On resume the records emitted before the interruption are kept, and
+    # their ads are not queued again. The interrupted run already observed
+    # them in the history.
+    for property_entry in journal.records():
+        property_writer.write(property_entry)
+        if aggregates is not None:
+            aggregates.add(property_entry)
+        if history is not None:
+            history.touch(property_entry)
+
+    metrics_runner = await serve_metrics(args.metrics_port) if args.metrics_port else None
+    mongo_client, mongo = None, None
+    if args.mongo:
+        from mongo_sink import MongoSink, open_collection
+        from mongoconnect import MONGO_URI
+        mongo_client, collection = open_collection(MONGO_URI if args.mongo == DEFAULT else args.mongo)
+        mongo = MongoSink(collection)
+        await mongo.start()
 
-async def main():
-    base_url = 'https://www.imot.bg/pcgi/imot.cgi?act=3&slink=av2f36&f1=1'
     async with aiohttp.ClientSession() as session:
-        content = await fetch(session, base_url)
-        soup = BeautifulSoup(content, 'html.parser')
-
-        page_urls = [base_url] + extract_pagination_urls(soup, base_url)
-        print(f"Total pages to scrape: {len(page_urls)}")
-
-        all_property_data = []
-        all_private_seller_data = []
-
-        tasks = [scrape_properties(session, url) for url in page_urls]
-        results = await asyncio.gather(*tasks)
-
-        for property_data, private_seller_data in results:
-            all_property_data.extend(property_data)
-            all_private_seller_data.extend(private_seller_data)
-
-        df = pd.DataFrame(all_property_data)
-        df_private = pd.DataFrame(all_private_seller_data)
-
-        df.to_csv('properties.csv', index=False)
-        df_private.to_csv('private_seller_properties.csv', index=False)
-
-        print("Scraping completed and data saved to properties.csv and private_seller_properties.csv")
+        crawl = Crawl(session, scheduler, parse_pool, cache, state, journal, mongo, aggregates, history, args.shard,
+                      searches, retry, dead_letters)
+        crawl.seen_ads.update((listing_key(url), None) for url in journal.completed_urls())
+        reporter = asyncio.create_task(scheduler.report())
+        snapshots = asyncio.create_task(write_snapshots(args.metrics_json)) if args.metrics_json else None
+        workers = [asyncio.create_task(listing_worker(crawl)) for _ in range(PAGE_WORKERS)]
+        workers += [asyncio.create_task(detail_worker(crawl)) for _ in range(DETAIL_WORKERS)]
+        workers.append(asyncio.create_task(record_sink(crawl, property_writer)))
+
+        try:
+            await supervise(run_pipeline(crawl, searches, retried), workers)
+        except BaseException:
+            # Leave the existing CSVs in place; the journal has the progress
+            property_writer.abort()
+            private_seller_writer.abort()
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+            if snapshots is not None:
+                snapshots.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            parse_pool.shutdown()
+            if cache is not None:
+                cache.close()
+            if state is not None:
+                state.close()
+            journal.close()
+            dead_letters.close()
+            if history is not None:
+                history.close()
+            if mongo is not None:
+                await mongo.close()
+            if mongo_client is not None:
+                await mongo_client.close()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            if args.metrics_json:
+                write_snapshot(args.metrics_json)
+            log_metrics(searches)
+
+    property_writer.close()
+    private_seller_writer.close()
+    if aggregates is not None:
+        aggregates.save(args.aggregates)
+
+    # An empty Parquet dataset writes no files, so only name the outputs that got records
+    saved = [writer.path for writer in (property_writer, private_seller_writer) if writer.count]
+    log.info(f"Scraping completed and data saved to {' and '.join(saved)}" if saved
+             else "Scraping completed, no records to save")
+    # With a parse pool the charsets are resolved (and counted) in the workers
+    if parse_pool.executor is None:
+        log.info(f"Encoding resolution: {encoding_summary()}")
+    log.info(f"Retries: {retry.summary()}")
+    if dead_letters.count:
+        log.warning(f"{dead_letters.count} URLs failed; retry them with --retry-dead-letters {dead_letters.path}",
+                    extra=fields(dead_letters=dead_letters.count))
+    if cache is not None:
+        log.info(f"Response cache: {cache.summary()}")
+    if state is not None:
+        log.info(f"Incremental crawl: {state.summary()}")
+    if mongo is not None:
+        log.info(f"MongoDB: {mongo.summary()}")
+    if len(searches) > 1:
+        log.info(f"Searches: {len(searches)}, listings found by more than one search: {crawl.shared_listings}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    setup_logging(json_lines=not args.log_text)
+    record_log.every = max(1, args.log_sample)
+    asyncio.run(main(args))
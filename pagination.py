@@ -0,0 +1,114 @@
+import re
+import time
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+from http_cache import canonical_url
+
+# Pagination planner. The first listing page says "Страница 1 от 25" in its
+# pageNumbersInfo span, but only links to a handful of nearby pages. Instead
+# of following those links, plan_pages() reads the total, takes the page
+# parameter from one of the visible links, and generates every page URL up
+# front: page 1 is the URL that was fetched, pages 2..total are built from
+# that link. URLs are deduplicated on their canonical form (see
+# http_cache.canonical_url), so the first page is never fetched twice.
+#
+# Without a page count (a one-page search, or a page layout we don't know)
+# the plan falls back to the visible links.
+
+# Query parameter imot.bg uses for the page number
+PAGE_PARAM = 'f1'
+
+PAGE_INFO_PATTERN = re.compile(r'Страница\s+(\d+)\s+от\s+(\d+)')
+
+
+# Function to read (current page, total pages) from "Страница 3 от 25"; (None, None) if absent
+def parse_page_info(text):
+    match = PAGE_INFO_PATTERN.search(text or '')
+    if match is None:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+# Function to find which query parameter holds the page number, from links whose text is that number
+def find_page_param(links):
+    for href, text in links:
+        text = text.strip()
+        if not text.isdigit():
+            continue
+        for name, value in parse_qsl(urlparse(href).query, keep_blank_values=True):
+            if value == text:
+                return name
+    return PAGE_PARAM
+
+
+# Function to set the page number in a URL, keeping its other parameters in order
+def page_url(url, number, param=PAGE_PARAM):
+    parsed = urlparse(url)
+    query = [(name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True) if name != param]
+    query.append((param, str(number)))
+    return urlunparse(parsed._replace(query=urlencode(query, safe='/')))
+
+
+# Function to pick a deterministic share of the pages: worker `index` of
+# `count` gets every count-th page, so shards never overlap
+def shard_pages(urls, index, count):
+    return [url for number, url in enumerate(urls) if number % count == index]
+
+
+# Function to list every page of a search, first page first, from that page's
+# pageNumbersInfo text and its pagination links as (absolute href, link text)
+def plan_pages(base_url, page_info_text, links):
+    urls = [base_url]
+    seen = {canonical_url(base_url)}
+
+    def add(url):
+        key = canonical_url(url)
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+
+    current, total = parse_page_info(page_info_text)
+    if total and links:
+        param = find_page_param(links)
+        template = links[0][0]
+        for number in range(1, total + 1):
+            if number != current:
+                add(page_url(template, number, param))
+    else:
+        for href, _ in links:
+            add(href)
+    return urls
+
+
+# Pages done out of a known total, with throughput and ETA
+class PageProgress:
+    def __init__(self, total=0, done=0):
+        self.total = total
+        self.done = done
+        self.started = time.monotonic()
+        self.started_done = done
+        self.reported = done
+
+    # Function to count a finished page; returns True when another tenth of the pages is done
+    def page_done(self):
+        self.done += 1
+        step = max(1, self.total // 10)
+        if self.done - self.reported >= step or self.done == self.total:
+            self.reported = self.done
+            return True
+        return False
+
+    def eta(self):
+        elapsed = time.monotonic() - self.started
+        finished = self.done - self.started_done
+        if not finished or not elapsed:
+            return None
+        return (self.total - self.done) / (finished / elapsed)
+
+    def summary(self):
+        eta = self.eta()
+        percent = self.done / self.total if self.total else 1
+        line = f"{self.done}/{self.total} pages ({percent:.0%})"
+        if eta is not None and self.done < self.total:
+            line += f", ETA {eta:.0f}s"
+        return line
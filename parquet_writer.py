@@ -0,0 +1,223 @@
+import os
+import re
+from datetime import date, datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fields import MISSING
+
+# Typed Parquet output, an alternative to the CSV written by RecordWriter
+# (record_writer.py) with the same write/close interface. Every column has a
+# declared type: the 'N/A' placeholders become nulls, counts become nullable
+# ints, "(1424 EUR/m2)" becomes 1424.0, and Publish Date becomes a timestamp.
+# Low-cardinality text columns are dictionary encoded, so pandas reads them
+# as categoricals.
+#
+# Files are laid out as a hive-partitioned dataset:
+#
+#   <root>/scrape_date=2024-07-12/search=av2f36/part-0.parquet
+#
+# pd.read_parquet(root) reads every partition and adds scrape_date and search
+# as columns. Filtering on them only opens the matching directories. A run
+# writes every record of its searches, so rerunning a search on the same day
+# replaces that partition's file rather than adding a second one next to it.
+
+DEFAULT_PARQUET_ROOT = 'properties_parquet'
+
+# Rows per row group. Records are buffered until a full group is ready, so
+# each group is large enough for column-pruned reads to skip most of the file.
+ROW_GROUP_SIZE = 20000
+
+PART_FILE_NAME = 'part-0.parquet'
+
+NUMBER_PATTERN = re.compile(r'-?\d+(?:[.,]\d+)?')
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Floors written as words rather than ordinals
+FLOOR_WORDS = {'Партер': 0, 'Сутерен': -1}
+
+
+def _missing(value):
+    return value is None or value == MISSING or value == ''
+
+
+# Function to read a whole number out of 125000, '100' or '2-ри'
+def to_int(value):
+    if _missing(value):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = NUMBER_PATTERN.search(str(value).replace(' ', ''))
+    return int(float(match.group(0).replace(',', '.'))) if match else None
+
+
+# Function to read '2-ри', '5' or 'Партер' as a floor number; normalise.py
+# uses it too, so the Parquet output and the analysis frame agree
+def to_floor(value):
+    if _missing(value):
+        return None
+    floor = to_int(value)
+    return FLOOR_WORDS.get(str(value).strip()) if floor is None else floor
+
+
+# Function to read a number out of 1424.5 or '(1 424 EUR/m2)'
+def to_float(value):
+    if _missing(value):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER_PATTERN.search(str(value).replace(' ', ''))
+    return float(match.group(0).replace(',', '.')) if match else None
+
+
+# Publish Date is a datetime from parse_publish_date, or its str() once it
+# has been through the crawl journal or incremental state
+def to_timestamp(value):
+    if _missing(value):
+        return None
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def to_str(value):
+    return None if _missing(value) else str(value)
+
+
+# Column, Arrow type and converter for every record column (DETAIL_COLUMNS)
+DETAIL_SCHEMA = (
+    ('Price', pa.int64(), to_int),
+    ('Currency', CATEGORY, to_str),
+    ('URL', pa.string(), to_str),
+    ('Seller', pa.string(), to_str),
+    ('Seller URL', pa.string(), to_str),
+    ('Seller Address', pa.string(), to_str),
+    ('Seller Phone', pa.string(), to_str),
+    ('Seller Type', CATEGORY, to_str),
+    ('Location', pa.string(), to_str),
+    ('Size', pa.int32(), to_int),
+    ('Floor', pa.int16(), to_floor),
+    ('Total Floors', pa.int16(), to_int),
+    ('Year', pa.int16(), to_int),
+    ('Material', CATEGORY, to_str),
+    ('Property Type', CATEGORY, to_str),
+    ('Phone', pa.string(), to_str),
+    ('Price per sqm', pa.float64(), to_float),
+    ('Publish Date', pa.timestamp('s'), to_timestamp),
+    ('Visits Count', pa.int32(), to_int),
+    ('Status', CATEGORY, to_str),
+)
+
+
+class ParquetRecordWriter:
+    def __init__(self, root, search, schema=DETAIL_SCHEMA, scrape_date=None, row_group_size=ROW_GROUP_SIZE):
+        self.columns = tuple(name for name, _, _ in schema)
+        self.converters = tuple(converter for _, _, converter in schema)
+        self.schema = pa.schema([(name, arrow_type) for name, arrow_type, _ in schema])
+        self.row_group_size = row_group_size
+        self.buffer = [[] for _ in self.columns]
+        self.buffered = 0
+        self.count = 0
+
+        directory = os.path.join(root, f"scrape_date={(scrape_date or date.today()).isoformat()}",
+                                 f"search={search}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, PART_FILE_NAME)
+        # Dataset readers skip files starting with '.', so the file stays
+        # invisible until close() renames it over the previous run's
+        self.part_path = os.path.join(directory, f".{PART_FILE_NAME}.{os.getpid()}")
+        self.writer = pq.ParquetWriter(self.part_path, self.schema, compression='zstd')
+
+    def write(self, record):
+        for values, name, converter in zip(self.buffer, self.columns, self.converters):
+            values.append(converter(record.get(name)))
+        self.buffered += 1
+        self.count += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    # Function to write the buffered rows out as one row group
+    def flush(self):
+        if not self.buffered:
+            return
+        arrays = [pa.array(values, type=field.type) for values, field in zip(self.buffer, self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=self.row_group_size)
+        self.buffer = [[] for _ in self.columns]
+        self.buffered = 0
+
+    # Function to finish the file and move it into place, replacing the partition's previous contents
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.part_path, self.path)
+        # Part files named per run by older versions would be read as duplicates
+        for name in os.listdir(self.directory):
+            if name.startswith('part-') and name.endswith('.parquet') and name != PART_FILE_NAME:
+                os.remove(os.path.join(self.directory, name))
+
+    # Function to stop without publishing the file; the hidden part file is left behind
+    def abort(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Writes each record to the partition of its 'Search' field, with one
+# ParquetRecordWriter per search opened on that search's first record
+class SearchPartitionedWriter:
+    def __init__(self, root, default_search, **options):
+        self.path = root
+        self.default_search = default_search
+        self.options = options
+        self.writers = {}
+
+    # Records written so far; no partition (or directory) is created until the first
+    @property
+    def count(self):
+        return sum(writer.count for writer in self.writers.values())
+
+    def write(self, record):
+        search = record.get('Search') or self.default_search
+        writer = self.writers.get(search)
+        if writer is None:
+            writer = self.writers[search] = ParquetRecordWriter(self.path, search, **self.options)
+        writer.write(record)
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,116 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from parser_backends import available_backends, get_backend
+from parser_parity import PAGE_URL, load_pages, diff_output
+from parsing import (parse_page, parse_listing_page, parse_detail_page,
+                     LISTING_REGIONS, PAGINATION_REGIONS, DETAIL_REGIONS)
+
+# Compares full and restricted (pre-sliced) parses over saved pages, laid out
+# as for parser_parity.py. For every backend it reports the parse+extract
+# time per page and the RSS added per page while all pages' trees are
+# held at once, which is what limits how many pages can be in flight.
+# Each measurement runs in a fresh process so RSS measurements don't mix.
+#
+#   python parse_benchmark.py saved_pages
+#   python parse_benchmark.py saved_pages --backends lxml --repeat 20
+
+
+# Current RSS in KB; falls back to the peak RSS where /proc isn't available
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Function to measure one backend in one mode; runs in its own process
+def measure(pages_dir, backend_name, restricted, repeat):
+    listing_pages = load_pages(pages_dir, 'listing')
+    detail_pages = load_pages(pages_dir, 'detail')
+    backend = get_backend(backend_name)
+    page_count = len(listing_pages) + len(detail_pages)
+
+    # Memory: keep every page's tree alive together, like concurrent pages
+    gc.collect()
+    baseline = rss_kb()
+    trees = [parse_page(backend, content, None, PAGE_URL, LISTING_REGIONS + PAGINATION_REGIONS, restricted)
+             for _, content in listing_pages]
+    trees += [parse_page(backend, content, None, PAGE_URL, DETAIL_REGIONS, restricted)
+              for _, content in detail_pages]
+    rss_per_page = (rss_kb() - baseline) / page_count
+    del trees
+    gc.collect()
+
+    # Time: the full parse + extraction path, repeated
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for _, content in listing_pages:
+            parse_listing_page(content, None, PAGE_URL, True, backend_name, restricted)
+        for _, content in detail_pages:
+            parse_detail_page(content, None, PAGE_URL, 'N/A', backend_name, restricted)
+    ms_per_page = (time.perf_counter() - started) * 1000 / (repeat * page_count)
+
+    return {'ms_per_page': ms_per_page, 'rss_kb_per_page': rss_per_page}
+
+
+def run_measurement(pages_dir, backend, restricted, repeat):
+    command = [sys.executable, __file__, pages_dir, '--measure', backend,
+               '--repeat', str(repeat)]
+    if restricted:
+        command.append('--restricted')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+# Function to check that restricted parsing extracts exactly what full parsing does
+def check_parity(pages_dir, backend):
+    differing = []
+    for name, content in load_pages(pages_dir, 'listing'):
+        full = parse_listing_page(content, None, PAGE_URL, True, backend, False)
+        restricted = parse_listing_page(content, None, PAGE_URL, True, backend, True)
+        if diff_output(full, restricted):
+            differing.append('listing/' + name)
+    for name, content in load_pages(pages_dir, 'detail'):
+        full = parse_detail_page(content, None, PAGE_URL, 'N/A', backend, False)
+        restricted = parse_detail_page(content, None, PAGE_URL, 'N/A', backend, True)
+        if diff_output(full, restricted):
+            differing.append('detail/' + name)
+    return differing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full and restricted parses of saved imot.bg pages")
+    parser.add_argument('pages_dir')
+    parser.add_argument('--backends', nargs='+', default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--restricted', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.pages_dir, args.measure, args.restricted, args.repeat)))
+        return
+
+    print(f"{'backend':<12} {'mode':<11} {'ms/page':>9} {'RSS KB/page':>12}")
+    for backend in args.backends or available_backends():
+        for restricted in (False, True):
+            result = run_measurement(args.pages_dir, backend, restricted, args.repeat)
+            mode = 'restricted' if restricted else 'full'
+            print(f"{backend:<12} {mode:<11} {result['ms_per_page']:>9.2f} {result['rss_kb_per_page']:>12.1f}")
+        differing = check_parity(args.pages_dir, backend)
+        if differing:
+            print(f"  restricted output differs from full on: {', '.join(differing)}")
+        else:
+            print("  restricted output matches full")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import crawl_metrics
+from scrape_logging import get_logger, collect_logging, replay_records
+
+
+# Runs parse functions off the event loop. With workers=0 they run inline
+# (the old behaviour); otherwise they go to a ProcessPoolExecutor, and at
+# most max_pending pages are handed to the pool at any one time so raw
+# page bytes don't pile up in memory while the workers are busy. Log lines
+# written in a worker come back with its result and go to this process's log.
+class ParsePool:
+    def __init__(self, workers=0, max_pending=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                            initargs=(get_logger().getEffectiveLevel(),)) if workers else None
+        self.pending = asyncio.Semaphore(max_pending or max(1, 2 * workers))
+
+    async def run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            result, metrics, records, error = await loop.run_in_executor(self.executor, measured, func, *args)
+        crawl_metrics.merge(metrics)
+        replay_records(records)
+        if error is not None:
+            raise error
+        return result
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+# The worker's log records, collected until measured() sends them back
+collector = None
+
+
+# Runs once in each worker; the parent's log queue doesn't reach other processes
+def init_worker(level):
+    global collector
+    collector = collect_logging(level)
+
+
+# Runs in the worker: call func and hand back its stage metrics, log records
+# (and any error) along with the result, so the parent can merge them
+def measured(func, *args):
+    crawl_metrics.reset()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, e
+    return result, crawl_metrics.to_dict(), collector.take() if collector is not None else [], error
@@ -0,0 +1,188 @@
+# Parser backends used by parsing.py. Each backend exposes the same handful of
+# DOM operations (parse, find, find_all, text, attr) over its own node type,
+# so the field extraction is written once and runs on any of them.
+#
+#   html.parser - BeautifulSoup with the stdlib parser (the original behaviour)
+#   lxml        - lxml.html with XPath
+#   selectolax  - selectolax's lexbor engine with CSS selectors
+
+
+# A tag + exact-attribute selector, the same subset bs4's find() was used
+# with: Selector('div', class_='price'), Selector('span', id='cenakv'),
+# Selector('td', width='520', colspan='3')
+class Selector:
+    def __init__(self, tag, class_=None, id=None, **attrs):
+        self.tag = tag
+        self.class_ = class_
+        self.id = id
+        self.attrs = attrs
+        self.css = self._to_css()
+        self.xpath = self._to_xpath()
+
+    def bs4_kwargs(self):
+        kwargs = dict(self.attrs)
+        if self.class_:
+            kwargs['class_'] = self.class_
+        if self.id:
+            kwargs['id'] = self.id
+        return kwargs
+
+    # Whether a start tag with these attributes (names lower-cased) matches
+    def matches(self, attrs):
+        if self.id and attrs.get('id') != self.id:
+            return False
+        if self.class_ and self.class_ not in attrs.get('class', '').split():
+            return False
+        return all(attrs.get(name) == value for name, value in self.attrs.items())
+
+    def _to_css(self):
+        css = self.tag
+        if self.id:
+            css += f'#{self.id}'
+        if self.class_:
+            css += f'.{self.class_}'
+        for name, value in self.attrs.items():
+            css += f'[{name}="{value}"]'
+        return css
+
+    def _to_xpath(self):
+        conditions = []
+        if self.id:
+            conditions.append(f"@id='{self.id}'")
+        if self.class_:
+            conditions.append(f"contains(concat(' ', normalize-space(@class), ' '), ' {self.class_} ')")
+        for name, value in self.attrs.items():
+            conditions.append(f"@{name}='{value}'")
+        xpath = f'.//{self.tag}'
+        if conditions:
+            xpath += '[' + ' and '.join(conditions) + ']'
+        return xpath
+
+    def __repr__(self):
+        return f'Selector({self.css!r})'
+
+
+class ParserBackend:
+    name = None
+
+    def parse(self, html):
+        raise NotImplementedError
+
+    # First descendant of node matching selector, or None
+    def find(self, node, selector):
+        raise NotImplementedError
+
+    # All descendants of node matching selector, in document order
+    def find_all(self, node, selector):
+        raise NotImplementedError
+
+    # Text of node with every text piece stripped and joined, like get_text(strip=True)
+    def text(self, node):
+        raise NotImplementedError
+
+    def attr(self, node, name):
+        raise NotImplementedError
+
+
+class BeautifulSoupBackend(ParserBackend):
+    name = 'html.parser'
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        self.BeautifulSoup = BeautifulSoup
+
+    def parse(self, html):
+        return self.BeautifulSoup(html, 'html.parser')
+
+    def find(self, node, selector):
+        return node.find(selector.tag, **selector.bs4_kwargs())
+
+    def find_all(self, node, selector):
+        return node.find_all(selector.tag, **selector.bs4_kwargs())
+
+    def text(self, node):
+        return node.get_text(strip=True)
+
+    def attr(self, node, name):
+        return node.get(name)
+
+
+class LxmlBackend(ParserBackend):
+    name = 'lxml'
+
+    def __init__(self):
+        import lxml.html
+        self.lxml_html = lxml.html
+
+    def parse(self, html):
+        return self.lxml_html.document_fromstring(html)
+
+    def find(self, node, selector):
+        found = node.xpath(selector.xpath)
+        return found[0] if found else None
+
+    def find_all(self, node, selector):
+        return node.xpath(selector.xpath)
+
+    def text(self, node):
+        # text() skips comments, matching bs4's get_text()
+        return ''.join(piece.strip() for piece in node.xpath('.//text()'))
+
+    def attr(self, node, name):
+        return node.get(name)
+
+
+class SelectolaxBackend(ParserBackend):
+    name = 'selectolax'
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self.LexborHTMLParser = LexborHTMLParser
+
+    def parse(self, html):
+        return self.LexborHTMLParser(html).root
+
+    # selectolax matches the node itself as well as its descendants
+    def find(self, node, selector):
+        for match in node.css(selector.css):
+            if match != node:
+                return match
+        return None
+
+    def find_all(self, node, selector):
+        return [match for match in node.css(selector.css) if match != node]
+
+    def text(self, node):
+        return node.text(deep=True, separator='', strip=True)
+
+    def attr(self, node, name):
+        return node.attributes.get(name)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (BeautifulSoupBackend, LxmlBackend, SelectolaxBackend)
+}
+
+_instances = {}
+
+
+# Function to return the (cached) backend instance for a setting value
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown parser backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
+
+
+# Function to list the backends whose library is installed
+def available_backends():
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
@@ -0,0 +1,137 @@
+import argparse
+import os
+import sys
+import time
+
+from parser_backends import available_backends
+from parsing import parse_listing_page, parse_detail_page
+
+# Parity harness for the parser backends. Runs every installed backend over
+# the same saved pages and diffs the extracted records against the reference
+# backend (html.parser). Saved pages are laid out as
+#
+#   <pages_dir>/listing/*.html   listing pages (search results)
+#   <pages_dir>/detail/*.html    detail pages (act=5&adv=...)
+#
+# exactly as downloaded, undecoded. Listings are compared field by field,
+# including the location and property type links (lnk2/lnk1) and the
+# description fields the listing-only scrapers (main.py, main2.py, main4.py)
+# write. Exits non-zero on any difference.
+#
+#   python parser_parity.py saved_pages
+#   python parser_parity.py saved_pages --backends html.parser selectolax
+
+REFERENCE_BACKEND = 'html.parser'
+PAGE_URL = 'https://www.imot.bg/pcgi/imot.cgi'
+
+
+def load_pages(pages_dir, kind):
+    directory = os.path.join(pages_dir, kind)
+    if not os.path.isdir(directory):
+        return []
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.html'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                pages.append((name, f.read()))
+    return pages
+
+
+# Function to run one backend over every page, returning outputs by page name and the time taken
+def run_backend(backend, listing_pages, detail_pages):
+    outputs = {}
+    started = time.perf_counter()
+    for name, content in listing_pages:
+        try:
+            outputs['listing/' + name] = parse_listing_page(content, None, PAGE_URL, True, backend)
+        except Exception as e:
+            outputs['listing/' + name] = f"error: {type(e).__name__}: {e}"
+    for name, content in detail_pages:
+        try:
+            outputs['detail/' + name] = parse_detail_page(content, None, PAGE_URL, 'N/A', backend)
+        except Exception as e:
+            outputs['detail/' + name] = f"error: {type(e).__name__}: {e}"
+    return outputs, time.perf_counter() - started
+
+
+# Function to compare the listings of a page by URL, field by field (price,
+# seller, location, property type, description fields, ...)
+def diff_listings(expected, actual):
+    diffs = []
+    actual_by_url = {listing['URL']: listing for listing in actual}
+    for listing in expected:
+        other = actual_by_url.get(listing['URL'])
+        if other is None:
+            diffs.append(f"listing missing: {listing['URL']}")
+            continue
+        diffs += [f"{listing['URL']} {diff}" for diff in diff_output(listing, other)]
+    expected_urls = {listing['URL'] for listing in expected}
+    diffs += [f"listing extra: {listing['URL']}" for listing in actual if listing['URL'] not in expected_urls]
+    if not diffs and [listing['URL'] for listing in expected] != [listing['URL'] for listing in actual]:
+        diffs.append("listings in a different order")
+    return diffs
+
+
+# Function to describe how one output differs from the reference
+def diff_output(expected, actual):
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        diffs = []
+        for field in sorted(set(expected) | set(actual)):
+            if expected.get(field) != actual.get(field):
+                diffs.append(f"{field}: {expected.get(field)!r} != {actual.get(field)!r}")
+        return diffs
+    if isinstance(expected, tuple) and isinstance(actual, tuple):
+        (expected_listings, expected_pages), (actual_listings, actual_pages) = expected, actual
+        diffs = diff_listings(expected_listings, actual_listings)
+        missing = [page for page in expected_pages if page not in actual_pages]
+        extra = [page for page in actual_pages if page not in expected_pages]
+        if missing:
+            diffs.append(f"pages missing: {missing}")
+        if extra:
+            diffs.append(f"pages extra: {extra}")
+        if not missing and not extra and list(expected_pages) != list(actual_pages):
+            diffs.append("pages in a different order")
+        return diffs
+    return [] if expected == actual else [f"{expected!r} != {actual!r}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare parser backends over saved imot.bg pages")
+    parser.add_argument('pages_dir')
+    parser.add_argument('--backends', nargs='+', default=None,
+                        help="backends to compare (default: every installed backend)")
+    args = parser.parse_args()
+
+    backends = args.backends or available_backends()
+    if REFERENCE_BACKEND not in backends:
+        backends = [REFERENCE_BACKEND] + backends
+
+    listing_pages = load_pages(args.pages_dir, 'listing')
+    detail_pages = load_pages(args.pages_dir, 'detail')
+    print(f"Pages: {len(listing_pages)} listing, {len(detail_pages)} detail")
+
+    results = {backend: run_backend(backend, listing_pages, detail_pages) for backend in backends}
+    reference, reference_time = results[REFERENCE_BACKEND]
+
+    mismatches = 0
+    for backend in backends:
+        outputs, elapsed = results[backend]
+        page_diffs = {}
+        for page, expected in reference.items():
+            diffs = diff_output(expected, outputs[page])
+            if diffs:
+                page_diffs[page] = diffs
+        mismatches += len(page_diffs)
+
+        speedup = reference_time / elapsed if elapsed else float('inf')
+        print(f"{backend}: {elapsed:.3f}s ({speedup:.1f}x {REFERENCE_BACKEND}), {len(page_diffs)} page(s) differ")
+        for page, diffs in page_diffs.items():
+            print(f"  {page}")
+            for diff in diffs:
+                print(f"    {diff}")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+from urllib.parse import urljoin
+
+from encoding import decode_content, resolve_encoding
+from fields import parse_description, parse_price, parse_ad_params, parse_publish_date, parse_seller_phone
+from html_slicer import slice_regions
+from metrics import crawl_metrics
+from pagination import plan_pages
+from parser_backends import Selector, get_backend
+from scrape_logging import get_logger, fields
+
+# Extraction for the listing and detail pages. Everything here works on raw
+# response bytes and returns plain tuples/dicts, so it can run either inline
+# or in a ProcessPoolExecutor worker (see ParsePool in parse_pool.py).
+# The DOM is accessed only through a parser backend (parser_backends.py),
+# chosen by name with PARSER_BACKEND or the backend argument. Nodes are
+# always checked with `is not None`: lxml elements without children are falsy.
+PARSER_BACKEND = 'html.parser'
+
+# With RESTRICTED_PARSE only the regions below are cut out of the raw page
+# (html_slicer.py) and parsed, instead of building the whole DOM
+RESTRICTED_PARSE = False
+
+log = get_logger('parsing')
+
+# Listing page regions
+PAGE_INFO = Selector('span', class_='pageNumbersInfo')
+PAGE_NUMBERS_SELECT = Selector('a', class_='pageNumbersSelect')
+PAGE_NUMBERS = Selector('a', class_='pageNumbers')
+LISTING_TABLE = Selector('table', width='660', cellspacing='0', cellpadding='0', border='0')
+LISTING_PHOTO_LINK = Selector('a', class_='photoLink')
+LISTING_PRICE = Selector('div', class_='price')
+LISTING_SELLER_LINK = Selector('a', class_='logoLink')
+LISTING_TYPE_LINK = Selector('a', class_='lnk1')
+LISTING_LOCATION_LINK = Selector('a', class_='lnk2')
+LISTING_DESCRIPTION = Selector('td', width='520', colspan='3', height='50', style='padding-left:4px')
+
+# Detail page regions
+AD_PRICE = Selector('div', class_='adPrice')
+PRICE = Selector('div', id='cena')
+PRICE_PER_SQM = Selector('span', id='cenakv')
+INFO = Selector('div', class_='info')
+DIV = Selector('div')
+VISITS = Selector('span', style='font-weight:bold;')
+AD_PARAMS = Selector('div', class_='adParams')
+ADV_HEADER = Selector('div', class_='advHeader')
+TITLE = Selector('div', class_='title')
+LOCATION = Selector('div', class_='location')
+AGENCY_BOX = Selector('div', class_='boxAgenciaPaid')
+AGENCY_NAME = Selector('a', class_='name')
+AGENCY_ADDRESS = Selector('div', class_='adress')
+PHONE = Selector('div', class_='phone')
+PRIVATE_SELLER_BOX = Selector('div', class_='AG')
+STRONG = Selector('strong')
+
+LISTING_REGIONS = (LISTING_TABLE,)
+PAGINATION_REGIONS = (PAGE_INFO, PAGE_NUMBERS_SELECT, PAGE_NUMBERS)
+DETAIL_REGIONS = (ADV_HEADER, AD_PRICE, AD_PARAMS, AGENCY_BOX, PRIVATE_SELLER_BOX)
+
+# Columns of the record built by parse_detail_page, in output order
+DETAIL_COLUMNS = ('Price', 'Currency', 'URL', 'Seller', 'Seller URL', 'Seller Address', 'Seller Phone',
+                  'Seller Type', 'Location', 'Size', 'Floor', 'Total Floors', 'Year', 'Material',
+                  'Property Type', 'Phone', 'Price per sqm', 'Publish Date', 'Visits Count', 'Status')
+
+# Function to decode and parse a raw page, optionally only the given regions
+def parse_page(backend, content, content_type, url, regions, restricted=None):
+    if restricted is None:
+        restricted = RESTRICTED_PARSE
+    with crawl_metrics.time('decode', len(content)):
+        if restricted:
+            # The charset is resolved on the full page, where the <meta> tag is
+            encoding = resolve_encoding(content, content_type, url)
+            html = slice_regions(content, regions).decode(encoding, errors='replace')
+        else:
+            html = decode_content(content, content_type, url)
+    with crawl_metrics.time('parse'):
+        return backend.parse(html)
+
+# Function to list the URLs of every page of the search, this page first.
+# The total comes from "Страница X от Y" (see pagination.py), not just the
+# page links that happen to be shown.
+def extract_pagination_urls(backend, root, base_url):
+    page_info_span = backend.find(root, PAGE_INFO)
+    page_info_text = backend.text(page_info_span) if page_info_span is not None else ''
+
+    links = []
+    for selector in (PAGE_NUMBERS_SELECT, PAGE_NUMBERS):
+        for link in backend.find_all(root, selector):
+            href = backend.attr(link, 'href')
+            if href:
+                links.append((format_url(href, base_url), backend.text(link)))
+
+    return plan_pages(base_url, page_info_text, links)
+
+# Function to format URLs correctly
+def format_url(href, base_url):
+    if href.startswith('//'):
+        href = 'https:' + href
+    elif href.startswith('/'):
+        href = urljoin(base_url, href)
+    elif not href.startswith('http'):
+        href = urljoin(base_url, href)
+    return href
+
+# Function to pull the detail URL, price, seller, location, property type and
+# the description fields (size, floor, year, phone) out of every listing table on a page
+def extract_listings(backend, root, url):
+    listings = []
+
+    for property_table in backend.find_all(root, LISTING_TABLE):
+        try:
+            href_a_tag = backend.find(property_table, LISTING_PHOTO_LINK)
+            href_value = backend.attr(href_a_tag, 'href') if href_a_tag is not None else None
+            if not href_value:
+                continue
+            href_value = format_url(href_value, url)
+
+            price_div = backend.find(property_table, LISTING_PRICE)
+            price, currency = parse_price(backend.text(price_div)) if price_div is not None else ('N/A', 'N/A')
+
+            seller_a_tag = backend.find(property_table, LISTING_SELLER_LINK)
+            seller_href = backend.attr(seller_a_tag, 'href') if seller_a_tag is not None else None
+            seller = seller_href.replace('//', '') if seller_href else 'N/A'
+
+            location_a_tag = backend.find(property_table, LISTING_LOCATION_LINK)
+            location = backend.text(location_a_tag) if location_a_tag is not None else 'N/A'
+
+            property_type_a_tag = backend.find(property_table, LISTING_TYPE_LINK)
+            property_type = backend.text(property_type_a_tag) if property_type_a_tag is not None else 'N/A'
+
+            description_td = backend.find(property_table, LISTING_DESCRIPTION)
+            description = parse_description(backend.text(description_td) if description_td is not None else '')
+
+            listings.append({
+                'Price': price,
+                'Currency': currency,
+                'URL': href_value,
+                'Seller': seller,
+                'Location': location,
+                'Size': description['Size'],
+                'Floor': description['Floor'],
+                'Year': description['Year'],
+                'Property Type': property_type,
+                'Phone': description['Phone']
+            })
+        except Exception as e:
+            log.warning(f"An error occurred while scraping property: {e}",
+                        extra=fields(url=url, error=type(e).__name__))
+
+    return listings
+
+# Function to parse a raw listing page into its listings and, optionally, the pagination URLs
+def parse_listing_page(content, content_type, url, include_pagination=False, backend=None, restricted=None):
+    backend = get_backend(backend or PARSER_BACKEND)
+    regions = LISTING_REGIONS + PAGINATION_REGIONS if include_pagination else LISTING_REGIONS
+    root = parse_page(backend, content, content_type, url, regions, restricted)
+    with crawl_metrics.time('extract'):
+        listings = extract_listings(backend, root, url)
+        page_urls = extract_pagination_urls(backend, root, url) if include_pagination else []
+    return listings, page_urls
+
+# Function to extract the agency or private seller details
+def extract_seller(backend, root, url):
+    seller_name, seller_url, seller_address, seller_phone, seller_type = 'N/A', 'N/A', 'N/A', 'N/A', 'N/A'
+    seller_div = backend.find(root, AGENCY_BOX)
+    if seller_div is not None:
+        seller_a_tag = backend.find(seller_div, AGENCY_NAME)
+        if seller_a_tag is not None:
+            seller_name = backend.text(seller_a_tag)
+            seller_href = backend.attr(seller_a_tag, 'href')
+            if seller_href:
+                seller_url = format_url(seller_href, url)
+
+        seller_address_div = backend.find(seller_div, AGENCY_ADDRESS)
+        if seller_address_div is not None:
+            seller_address = backend.text(seller_address_div)
+
+        seller_phone_div = backend.find(seller_div, PHONE)
+        if seller_phone_div is not None:
+            seller_phone = parse_seller_phone(backend.text(seller_phone_div))
+
+    # Check for private seller
+    private_seller_div = backend.find(root, PRIVATE_SELLER_BOX)
+    if private_seller_div is not None:
+        private_seller_strong = backend.find(private_seller_div, STRONG)
+        if private_seller_strong is not None and "Частно лице" in backend.text(private_seller_strong):
+            seller_type = "Частно лице"
+            private_seller_phone_div = backend.find(private_seller_div, PHONE)
+            if private_seller_phone_div is not None:
+                seller_phone = parse_seller_phone(backend.text(private_seller_phone_div))
+        else:
+            seller_type = "Агенция"
+
+    return seller_name, seller_url, seller_address, seller_phone, seller_type
+
+# Function to build the property record from a raw detail page
+def parse_detail_page(content, content_type, href_value, phone_number, backend=None, restricted=None):
+    backend = get_backend(backend or PARSER_BACKEND)
+    root = parse_page(backend, content, content_type, href_value, DETAIL_REGIONS, restricted)
+    with crawl_metrics.time('extract'):
+        return extract_detail(backend, root, href_value, phone_number)
+
+# Function to build the property record from a parsed detail page
+def extract_detail(backend, root, href_value, phone_number):
+    ad_price_div = backend.find(root, AD_PRICE)
+    cena_div = backend.find(ad_price_div, PRICE)
+    price_text = backend.text(cena_div) if cena_div is not None else 'N/A'
+    price, currency = parse_price(price_text)
+
+    # Extract additional information from adParams
+    ad_params_div = backend.find(root, AD_PARAMS)
+    row_texts = [backend.text(div) for div in backend.find_all(ad_params_div, DIV)] if ad_params_div is not None else []
+    ad_params = parse_ad_params(row_texts)
+    size = ad_params['Size']
+
+    # Extract publish timestamp
+    info_div = backend.find(ad_price_div, INFO)
+    publish_time_div = backend.find(info_div, DIV)
+    if publish_time_div is not None:
+        publish_time_text = backend.text(publish_time_div)
+        status, publish_date = parse_publish_date(publish_time_text)
+    else:
+        publish_date = 'N/A'
+        status = 'N/A'
+
+    # Extract number of visits
+    visits_span = backend.find(info_div, VISITS)
+    visits_count = backend.text(visits_span) if visits_span is not None else 'N/A'
+
+    # Extract location and property type
+    adv_header_div = backend.find(root, ADV_HEADER)
+    property_type_div = backend.find(adv_header_div, TITLE)
+    property_type = backend.text(property_type_div) if property_type_div is not None else 'N/A'
+    location_div = backend.find(adv_header_div, LOCATION)
+    location = backend.text(location_div) if location_div is not None else 'N/A'
+
+    seller_name, seller_url, seller_address, seller_phone, seller_type = extract_seller(backend, root, href_value)
+
+    # Calculate price per sqm if not found
+    price_per_sqm_span = backend.find(ad_price_div, PRICE_PER_SQM)
+    if price_per_sqm_span is not None:
+        price_per_sqm = backend.text(price_per_sqm_span)
+    else:
+        price_per_sqm = price / size if size != 'N/A' and size != 0 and price != 'N/A' else 'N/A'
+
+    return {
+        'Price': price,
+        'Currency': currency,
+        'URL': href_value,
+        'Seller': seller_name,
+        'Seller URL': seller_url,
+        'Seller Address': seller_address,
+        'Seller Phone': seller_phone,
+        'Seller Type': seller_type,
+        'Location': location,
+        'Size': size,
+        'Floor': ad_params['Floor'],
+        'Total Floors': ad_params['Total Floors'],
+        'Year': ad_params['Year'],
+        'Material': ad_params['Material'],
+        'Property Type': property_type,
+        'Phone': phone_number if phone_number != 'N/A' else seller_phone,
+        'Price per sqm': price_per_sqm,
+        'Publish Date': publish_date,
+        'Visits Count': visits_count,
+        'Status': status
+    }
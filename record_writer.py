@@ -0,0 +1,72 @@
+import csv
+import os
+import time
+
+# Streaming CSV output for the scrapers. Records are appended in batches while
+# the crawl runs, so memory doesn't grow with the number of listings and a
+# crash still leaves everything written so far on disk. The rows go to
+# "<path>.part" and the file is only renamed over <path> once the run
+# finishes, so the previous complete CSV is never replaced by a partial one.
+
+# Records held in memory before a batch is written out
+BATCH_SIZE = 500
+
+# A smaller batch is still written (and synced) after this many seconds
+FLUSH_INTERVAL = 30
+
+
+class RecordWriter:
+    def __init__(self, path, columns, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.part_path = path + '.part'
+        self.columns = tuple(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.count = 0
+        self.last_flush = time.monotonic()
+
+        self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+        # Keys outside the schema are dropped and missing ones left empty, so
+        # every row lines up with the header
+        self.writer = csv.DictWriter(self.file, fieldnames=self.columns, restval='', extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, record):
+        self.batch.append(record)
+        self.count += 1
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    # Function to write the pending batch and sync it to disk
+    def flush(self):
+        if self.batch:
+            self.writer.writerows(self.batch)
+            self.batch = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush = time.monotonic()
+
+    # Function to finish the file and move it into place
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+    # Function to stop without replacing <path>; the rows written so far stay in the .part file
+    def abort(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
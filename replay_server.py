@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+from string import Template
+
+from aiohttp import web
+
+# Local stand-in for imot.bg used by crawl_benchmark.py. It serves the
+# windows-1251 fixtures in bench_fixtures/ as a search of PAGES listing pages
+# with PER_PAGE ads each, plus each ad's detail page. Every response can be
+# delayed (latency + jitter), failed with a 503 (error rate), or refused with
+# a 429 + Retry-After once the request rate exceeds the limit.
+#
+#   python replay_server.py --port 8765 --pages 20 --latency 50 --jitter 20 --error-rate 0.01
+#
+# Start URL: http://127.0.0.1:8765/pcgi/imot.cgi?act=3&slink=bench&f1=1
+# Any other slink is another search over the same ads, starting a few pages
+# further on, so searches overlap the way real ones do.
+# GET /_stats returns request counts, latency percentiles and any URL served more
+# than once (a crawler fetching the same page twice), GET /_reset clears them.
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures')
+SLINK = 'bench'
+
+NEIGHBOURHOODS = ('Кършияка', 'Център', 'Тракия', 'Смирненски', 'Младежки хълм', 'Каменица 1', 'Христо Смирненски')
+ROOMS = ('1-СТАЕН', '2-СТАЕН', '3-СТАЕН', 'МНОГОСТАЕН')
+FLOOR_SUFFIXES = {1: 'ви', 2: 'ри', 7: 'ми', 8: 'ми'}
+
+# Like the real site, a listing page only links to the pages around it
+PAGE_LINKS = 5
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='cp1251') as f:
+        return Template(f.read())
+
+
+# Pages of ads a search skips before its first page
+def search_offset(slink, pages):
+    return 0 if slink == SLINK else sum(slink.encode()) % max(1, pages)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ReplaySite:
+    def __init__(self, pages=10, per_page=20, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=None, seed=1):
+        self.pages = pages
+        self.per_page = per_page
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.listing = load_fixture('listing.html')
+        self.listing_row = load_fixture('listing_row.html')
+        self.detail_agency = load_fixture('detail_agency.html')
+        self.detail_private = load_fixture('detail_private.html')
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.served = {}
+        self.latencies = []
+        self.tokens = self.rate_limit or 0
+        self.refilled = time.monotonic()
+
+    # Everything an ad's listing row and detail page show, derived from its number
+    def ad(self, base, page, index, slink=SLINK, listed_page=None):
+        number = page * 1000 + index
+        rng = random.Random(number)
+        size = rng.randint(35, 140)
+        currency = 'EUR' if number % 5 else 'лв.'
+        price = size * rng.randint(900, 2200) // 100 * 100
+        floor = rng.randint(1, 8)
+        return {
+            'base': base,
+            'slink': slink,
+            'page': listed_page or page,
+            'adv': f"1b{page:06d}{index:05d}",
+            'rooms': ROOMS[number % len(ROOMS)],
+            'neighbourhood': NEIGHBOURHOODS[number % len(NEIGHBOURHOODS)],
+            'price_text': f"{price:,}".replace(',', ' ') + f" {currency}",
+            'price_per_sqm': price // size,
+            'currency': currency.rstrip('.'),
+            'seller_logo': '<a href="//agency.imot.bg" class="logoLink"><img src="logo.gif"></a>' if number % 2 else '',
+            'size': size,
+            'floor_text': f"{floor}-{FLOOR_SUFFIXES.get(floor, 'ти')}",
+            'total_floors': max(floor, rng.randint(4, 12)),
+            'year': rng.randint(1965, 2024),
+            'phone': f"0888{number % 1000000:06d}",
+            'status': 'Коригирана в' if number % 3 else 'Публикувана в',
+            'day': 1 + number % 28,
+            'visits': rng.randint(10, 3000),
+            'agency': f"agency{number % 7}",
+            'agency_name': f"АГЕНЦИЯ {number % 7}",
+            'agency_phone': f"{number % 7:06d}",
+        }
+
+    def listing_page(self, base, page, slink=SLINK):
+        pagination = []
+        first = max(1, min(page - PAGE_LINKS // 2, self.pages - PAGE_LINKS + 1))
+        for number in range(first, min(self.pages, first + PAGE_LINKS - 1) + 1):
+            css_class = 'pageNumbersSelect' if number == page else 'pageNumbers'
+            pagination.append(f'<a href="{base}/pcgi/imot.cgi?act=3&slink={slink}&f1={number}" '
+                              f'class="{css_class}">{number}</a>')
+        offset = search_offset(slink, self.pages)
+        rows = [self.listing_row.safe_substitute(self.ad(base, page + offset, index, slink, page))
+                for index in range(self.per_page)]
+        return self.listing.safe_substitute(page=page, pages=self.pages, pagination=' '.join(pagination),
+                                            rows=''.join(rows))
+
+    def detail_page(self, base, adv):
+        page, index = int(adv[2:8]), int(adv[8:])
+        template = self.detail_agency if (page * 1000 + index) % 2 else self.detail_private
+        return template.safe_substitute(self.ad(base, page, index))
+
+    def _rate_limited(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def _count(self, kind):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    async def handle(self, request):
+        started = time.perf_counter()
+        query = request.query
+        kind = 'detail' if query.get('act') == '5' else 'listing'
+        try:
+            if self._rate_limited():
+                self._count('429')
+                return web.Response(status=429, headers={'Retry-After': '1'})
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.random.random() < self.error_rate:
+                self._count('503')
+                return web.Response(status=503)
+
+            base = f"{request.scheme}://{request.host}"
+            if kind == 'detail':
+                adv = query.get('adv', '')
+                page, index = (int(adv[2:8]), int(adv[8:])) if len(adv) == 13 and adv[2:].isdigit() else (0, -1)
+                if not (1 <= page <= 2 * self.pages and 0 <= index < self.per_page):
+                    self._count('404')
+                    return web.Response(status=404)
+                body = self.detail_page(base, adv)
+            else:
+                page = int(query.get('f1', 1))
+                if not 1 <= page <= self.pages:
+                    self._count('404')
+                    return web.Response(status=404)
+                body = self.listing_page(base, page, query.get('slink', SLINK))
+            self._count(kind)
+            self.served[request.path_qs] = self.served.get(request.path_qs, 0) + 1
+            # Like the real site, the charset is only declared in the <meta> tag
+            return web.Response(body=body.encode('cp1251'), content_type='text/html')
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    async def stats(self, request):
+        return web.json_response({
+            'counts': self.counts,
+            'requests': len(self.latencies),
+            'latency_p50_ms': (percentile(self.latencies, 0.5) or 0) * 1000,
+            'latency_p99_ms': (percentile(self.latencies, 0.99) or 0) * 1000,
+            'duplicate_fetches': {url: count for url, count in self.served.items() if count > 1},
+        })
+
+    async def reset_stats(self, request):
+        self.reset()
+        return web.json_response({'reset': True})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/pcgi/imot.cgi', self.handle)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_get('/_reset', self.reset_stats)
+        return app
+
+
+def start_url(port, host='127.0.0.1'):
+    return f"http://{host}:{port}/pcgi/imot.cgi?act=3&slink={SLINK}&f1=1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve imot.bg-like fixtures locally for benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pages', type=int, default=10, help="listing pages in the search")
+    parser.add_argument('--per-page', type=int, default=20, help="ads per listing page")
+    parser.add_argument('--latency', type=float, default=0.0, help="added delay per response, in ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="+/- random delay, in ms")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument('--rate-limit', type=float, default=None, help="requests/s before answering 429")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def main(args):
+    site = ReplaySite(args.pages, args.per_page, args.latency / 1000, args.jitter / 1000,
+                      args.error_rate, args.rate_limit, args.seed)
+    print(f"Serving {args.pages} pages x {args.per_page} ads at {start_url(args.port, args.host)}", flush=True)
+    web.run_app(site.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main(parse_args())
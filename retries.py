@@ -0,0 +1,223 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import aiohttp
+
+from http_cache import url_class
+from scrape_logging import get_logger, fields
+
+# Retry policy for fetch() (fetcher.py). A request that fails with a
+# connection error or timeout, a 5xx or a 429 is tried up to MAX_ATTEMPTS
+# times in all. Before each retry it waits a random time between 0 and
+# BASE_DELAY * 2**n seconds (full jitter, so requests that failed together
+# don't retry together), or longer if the response's Retry-After asks for it.
+# Other 4xx statuses fail at once.
+#
+# Each host has a circuit breaker. After BREAKER_THRESHOLD failures in a row
+# the site is taken to be rejecting us, and every request to that host fails
+# at once for BREAKER_COOLDOWN seconds. Then a single trial request is let
+# through; it closes the circuit if it succeeds and reopens it if it fails.
+#
+# URLs that fail for good are written to a DeadLetters file
+# (dead_letters.jsonl; main4.py and test.py keep their own). optimised.py
+# --retry-dead-letters fetches just those again.
+
+MAX_ATTEMPTS = 4
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+# Longest Retry-After honoured; a longer one fails the request instead
+MAX_RETRY_AFTER = 120.0
+
+# Statuses worth retrying, and statuses that only count against the circuit
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+REJECT_STATUSES = frozenset((403,))
+RETRY_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+BREAKER_THRESHOLD = 20
+BREAKER_COOLDOWN = 60.0
+
+DEFAULT_DEAD_LETTERS_PATH = 'dead_letters.jsonl'
+
+log = get_logger('retries')
+
+
+class FetchError(Exception):
+    def __init__(self, url, message, status=None, attempts=1):
+        super().__init__(f"{message} for {url}" + (f" after {attempts} attempts" if attempts > 1 else ""))
+        self.url = url
+        self.status = status
+        self.attempts = attempts
+
+
+class CircuitOpenError(FetchError):
+    pass
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower()
+
+
+# Function to read a Retry-After header (seconds, or an HTTP date) as seconds from now
+def retry_after_seconds(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# Function to raise FetchError for an error status, for fetches made without a RetryPolicy
+def check_status(url, status):
+    if status >= 400:
+        raise FetchError(url, f"HTTP {status}", status)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = Counter()
+        # Host -> when its circuit opened
+        self.opened = {}
+        # Hosts with a trial request in flight
+        self.trials = set()
+        self.trips = 0
+        self.rejected = 0
+
+    # Function to raise CircuitOpenError if requests to the URL's host are cut off
+    def check(self, url):
+        host = host_of(url)
+        opened = self.opened.get(host)
+        if opened is None:
+            return
+        if time.monotonic() - opened < self.cooldown or host in self.trials:
+            self.rejected += 1
+            raise CircuitOpenError(url, "Circuit open")
+        self.trials.add(host)
+
+    def success(self, url):
+        host = host_of(url)
+        self.failures[host] = 0
+        self.trials.discard(host)
+        if self.opened.pop(host, None) is not None:
+            log.info(f"Circuit for {host} closed again", extra=fields(host=host))
+
+    def failure(self, url):
+        host = host_of(url)
+        self.failures[host] += 1
+        if host in self.trials:
+            self.trials.discard(host)
+            self.opened[host] = time.monotonic()
+            log.warning(f"Trial request to {host} failed; circuit open for another {self.cooldown:g}s",
+                        extra=fields(host=host))
+        elif host not in self.opened and self.failures[host] >= self.threshold:
+            self.opened[host] = time.monotonic()
+            self.trips += 1
+            log.error(f"{self.failures[host]} requests to {host} failed in a row; failing its requests for "
+                      f"{self.cooldown:g}s", extra=fields(host=host, failures=self.failures[host]))
+
+    # Function to forget a trial request that was cancelled before it finished
+    def release(self, url):
+        self.trials.discard(host_of(url))
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 retry_statuses=RETRY_STATUSES, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.stats = Counter()
+
+    # Seconds to wait before retry number `attempt`
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return delay if retry_after is None else max(delay, retry_after)
+
+    # Function to run request() -> (status, content, headers) until it
+    # succeeds, fails for good or runs out of attempts; raises FetchError
+    async def run(self, url, request):
+        for attempt in range(1, self.max_attempts + 1):
+            self.breaker.check(url)
+            retry_after = None
+            try:
+                status, content, headers = await request()
+            except RETRY_ERRORS as e:
+                error = FetchError(url, f"{type(e).__name__}: {e}", attempts=attempt)
+                error.__cause__ = e
+            except BaseException:
+                self.breaker.release(url)
+                raise
+            else:
+                if status < 400:
+                    self.breaker.success(url)
+                    return status, content, headers
+                if status not in self.retry_statuses and status < 500:
+                    if status in REJECT_STATUSES:
+                        self.breaker.failure(url)
+                    else:
+                        self.breaker.success(url)
+                    self.stats['failed'] += 1
+                    raise FetchError(url, f"HTTP {status}", status, attempt)
+                error = FetchError(url, f"HTTP {status}", status, attempt)
+                retry_after = retry_after_seconds(headers.get('Retry-After'))
+
+            self.breaker.failure(url)
+            if attempt == self.max_attempts or (retry_after or 0) > MAX_RETRY_AFTER:
+                self.stats['gave_up'] += 1
+                raise error
+            delay = self.delay(attempt, retry_after)
+            self.stats['retries'] += 1
+            log.debug(f"Retrying {url} in {delay:.2f}s after {error}",
+                      extra=fields(url=url, attempt=attempt, delay=delay, status=error.status))
+            await asyncio.sleep(delay)
+
+    def summary(self):
+        return (f"retries={self.stats['retries']}, gave up={self.stats['gave_up']}, "
+                f"failed={self.stats['failed']}, circuit trips={self.breaker.trips}, "
+                f"cut off by the circuit={self.breaker.rejected}")
+
+
+# URLs that failed for good, one JSON object per line: url, kind (listing or
+# detail), error, attempts, time, plus whatever the caller knows about it
+# (its search, the listing a detail page came from). The file is rewritten
+# by every run, so it lists the failures of the last run only.
+class DeadLetters:
+    def __init__(self, path=DEFAULT_DEAD_LETTERS_PATH):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def add(self, url, error, **context):
+        entry = {
+            'url': url,
+            'kind': url_class(url),
+            'error': f"{type(error).__name__}: {error}",
+            'attempts': getattr(error, 'attempts', 1),
+            'time': datetime.now().isoformat(timespec='seconds'),
+        }
+        entry.update(context)
+        self.file.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(path=DEFAULT_DEAD_LETTERS_PATH):
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,184 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+from scrape_logging import get_logger, fields
+
+# Default limits, kept well below what imot.bg starts throttling at
+MAX_CONCURRENCY = 20
+MAX_PER_HOST = 6
+REQUESTS_PER_SECOND = 8.0
+BURST = 8
+
+# Environment variables overriding the limits above, so the scripts without
+# options (main4.py, test.py) can be tuned too; 0 disables a limit
+LIMIT_VARIABLES = (
+    ('max_concurrency', 'IMOT_MAX_CONCURRENCY', int),
+    ('max_per_host', 'IMOT_MAX_PER_HOST', int),
+    ('requests_per_second', 'IMOT_RPS', float),
+    ('burst', 'IMOT_BURST', int),
+)
+
+log = get_logger('scheduler')
+
+
+# Token bucket limiting how many requests per second are started
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Function to return the scheduler limits: the defaults above, overridden by
+# any IMOT_* variable that is set
+def scheduler_limits(environ=None):
+    environ = os.environ if environ is None else environ
+    limits = {'max_concurrency': MAX_CONCURRENCY, 'max_per_host': MAX_PER_HOST,
+              'requests_per_second': REQUESTS_PER_SECOND, 'burst': BURST}
+    for name, variable, convert in LIMIT_VARIABLES:
+        value = environ.get(variable)
+        if value:
+            try:
+                limits[name] = convert(value)
+            except ValueError:
+                raise ValueError(f"{variable} must be a number, got {value!r}") from None
+    return limits
+
+
+# Function to add --max-concurrency/--max-per-host/--rps/--burst to a parser,
+# defaulting to scheduler_limits()
+def add_scheduler_arguments(parser):
+    limits = scheduler_limits()
+    parser.add_argument('--max-concurrency', type=int, default=limits['max_concurrency'], metavar='N',
+                        help="requests in flight at once, 0 for no cap (env IMOT_MAX_CONCURRENCY; "
+                             f"default: {limits['max_concurrency']})")
+    parser.add_argument('--max-per-host', type=int, default=limits['max_per_host'], metavar='N',
+                        help=f"requests in flight per host, 0 for no cap (env IMOT_MAX_PER_HOST; "
+                             f"default: {limits['max_per_host']})")
+    parser.add_argument('--rps', dest='requests_per_second', type=float, default=limits['requests_per_second'],
+                        metavar='RPS', help="requests started per second, 0 for no limit (env IMOT_RPS; "
+                                            f"default: {limits['requests_per_second']:g})")
+    parser.add_argument('--burst', type=int, default=limits['burst'], metavar='N',
+                        help=f"request starts allowed in one burst (env IMOT_BURST; default: {limits['burst']})")
+
+
+# Function to pick the limits added by add_scheduler_arguments() out of parsed arguments
+def limits_from_args(args):
+    return {name: getattr(args, name) for name, _, _ in LIMIT_VARIABLES}
+
+
+# Function to turn limits into IMOT_* variables for a child process; None
+# becomes 0, which disables the limit
+def limits_environ(limits):
+    return {variable: str(limits[name] or 0) for name, variable, _ in LIMIT_VARIABLES}
+
+
+# Scheduler wrapped around every fetch(): a global concurrency cap, a cap per
+# host (www.imot.bg and each city subdomain count separately) and a global
+# requests-per-second limit. Pass None or 0 for any limit to disable it.
+# The defaults are fixed; scheduler_limits() gives the configured ones.
+class RequestScheduler:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_per_host=MAX_PER_HOST,
+                 requests_per_second=REQUESTS_PER_SECOND, burst=BURST):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.global_limit = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.host_limits = {}
+        self.bucket = TokenBucket(requests_per_second, burst) if requests_per_second else None
+
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.queued_by_host = defaultdict(int)
+        self.in_flight_by_host = defaultdict(int)
+
+    def _host_limit(self, host):
+        if not self.max_per_host:
+            return None
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host_limits[host]
+
+    # Usage: async with scheduler.slot(url): ... issue the request ...
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlparse(url).hostname or ''
+        host_limit = self._host_limit(host)
+
+        self.queued += 1
+        self.queued_by_host[host] += 1
+        acquired_host = acquired_global = False
+        try:
+            # Take the host slot first so one busy host cannot hog global slots
+            if host_limit:
+                await host_limit.acquire()
+                acquired_host = True
+            if self.global_limit:
+                await self.global_limit.acquire()
+                acquired_global = True
+            if self.bucket:
+                await self.bucket.acquire()
+        except BaseException:
+            if acquired_global:
+                self.global_limit.release()
+            if acquired_host:
+                host_limit.release()
+            raise
+        finally:
+            self.queued -= 1
+            self.queued_by_host[host] -= 1
+
+        self.in_flight += 1
+        self.in_flight_by_host[host] += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.in_flight_by_host[host] -= 1
+            self.completed += 1
+            if self.global_limit:
+                self.global_limit.release()
+            if host_limit:
+                host_limit.release()
+
+    # Snapshot of queue depth and in-flight counts, overall and per host
+    def stats(self):
+        hosts = set(self.queued_by_host) | set(self.in_flight_by_host)
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'hosts': {
+                host: {'queued': self.queued_by_host[host], 'in_flight': self.in_flight_by_host[host]}
+                for host in sorted(hosts)
+            },
+        }
+
+    # Periodically log the scheduler state until cancelled
+    async def report(self, interval=5.0):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.stats()
+            log.info(f"Scheduler: queued={stats['queued']}, in flight={stats['in_flight']}, "
+                     f"completed={stats['completed']}",
+                     extra=fields(queued=stats['queued'], in_flight=stats['in_flight'], completed=stats['completed']))
@@ -0,0 +1,138 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime
+
+# Logging for the scrapers. Log calls only put the record on a queue; a
+# QueueListener thread formats it and does the file and console I/O, so a
+# slow terminal or disk never stalls the event loop. scraping_log.log gets
+# one JSON object per line; the console gets plain INFO and above.
+#
+# Per-record lines ("scraped this property") are DEBUG and sampled: only
+# every RECORD_SAMPLE_EVERY-th one is logged at all.
+#
+#   from scrape_logging import setup_logging, get_logger, SampledLog
+#   setup_logging()
+#   log = get_logger('optimised')
+#   log.warning(f"Error fetching page {url}: {e}", extra=fields(url=url))
+
+LOG_PATH = 'scraping_log.log'
+LOGGER_NAME = 'imot-scrape'
+
+RECORD_SAMPLE_EVERY = 100
+
+CONSOLE_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+# One JSON object per line: time, level, logger, message, any fields passed
+# with extra={'fields': {...}}, and the traceback if there was one
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Keeps the traceback as exc_text for the formatters instead of folding it
+# into the message, as the stock QueueHandler.prepare does
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+# Keeps the records in a list instead of queueing them, for a worker process
+# that hands its records back to the parent (see parse_pool.py)
+class RecordCollector(StructuredQueueHandler):
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def enqueue(self, record):
+        self.records.append(record)
+
+    # Function to return the records collected so far and start a new list
+    def take(self):
+        records, self.records = self.records, []
+        return records
+
+
+# Function to build the `extra` argument that attaches structured fields to a log line
+def fields(**values):
+    return {'fields': values}
+
+
+def get_logger(name=None):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+# Function to route every imot-scrape logger through a queue to the log file
+# (JSON lines) and the console; returns the listener, which is also stopped at exit
+def setup_logging(path=LOG_PATH, level=logging.DEBUG, console_level=logging.INFO, json_lines=True):
+    file_handler = logging.FileHandler(path, encoding='utf-8')
+    file_handler.setLevel(level)
+    file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(CONSOLE_FORMAT))
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = get_logger()
+    logger.handlers[:] = [StructuredQueueHandler(log_queue)]
+    logger.setLevel(min(level, console_level))
+    logger.propagate = False
+    return listener
+
+
+# Function to collect every imot-scrape log record of this process in a
+# RecordCollector instead of writing it; returns the collector
+def collect_logging(level=logging.DEBUG):
+    collector = RecordCollector()
+    logger = get_logger()
+    logger.handlers[:] = [collector]
+    logger.setLevel(level)
+    logger.propagate = False
+    return collector
+
+
+# Function to pass records collected in another process to this process's handlers
+def replay_records(records):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+# Logs only every `every`-th call, and skips building the line entirely when
+# DEBUG is off; for per-record lines in the hot loop
+class SampledLog:
+    def __init__(self, logger, every=RECORD_SAMPLE_EVERY):
+        self.logger = logger
+        self.every = max(1, every)
+        self.seen = 0
+
+    def debug(self, message, **fields):
+        self.seen += 1
+        if self.seen % self.every or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.logger.debug(message, extra={'fields': fields})
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import re
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+# Searches crawled together by optimised.py --config. The config is a JSON
+# list of searches (or {"searches": [...]}):
+#
+#   [
+#     {"url": "https://www.imot.bg/pcgi/imot.cgi?act=3&slink=av2f36&f1=1", "priority": 2},
+#     {"name": "sofia-3room", "url": "https://www.imot.bg/pcgi/imot.cgi?act=3&slink=b1x9k2&f1=1",
+#      "max_pages": 20}
+#   ]
+#
+# name defaults to the slink (or the city subdomain), priority to 1 and
+# max_pages to every page. Listing pages of all searches share one queue,
+# taken in weighted round-robin order: each turn a search gets up to
+# `priority` pages before the next search's turn.
+
+
+# Function to name the search a listing URL belongs to (also its Parquet
+# partition): its slink parameter, or the subdomain (imoti-plovdiv) without one
+def search_name(url):
+    parsed = urlparse(url)
+    slink = parse_qs(parsed.query).get('slink')
+    name = slink[0] if slink else parsed.hostname.split('.')[0]
+    return re.sub(r'[^\w-]', '_', name)
+
+
+class Search:
+    def __init__(self, url, name=None, priority=1, max_pages=None):
+        self.url = url
+        self.name = re.sub(r'[^\w-]', '_', name) if name else search_name(url)
+        self.priority = priority
+        self.max_pages = max_pages
+
+    def __repr__(self):
+        return f"Search({self.name!r}, {self.url!r})"
+
+
+# Function to read the searches from a JSON config file
+def load_searches(path):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    entries = config['searches'] if isinstance(config, dict) else config
+
+    searches = []
+    for entry in entries:
+        if 'url' not in entry:
+            raise ValueError(f"{path}: every search needs a url: {entry}")
+        priority = int(entry.get('priority', 1))
+        max_pages = entry.get('max_pages')
+        if priority < 1 or (max_pages is not None and int(max_pages) < 1):
+            raise ValueError(f"{path}: priority and max_pages must be at least 1: {entry}")
+        searches.append(Search(entry['url'], entry.get('name'), priority,
+                               None if max_pages is None else int(max_pages)))
+
+    names = [search.name for search in searches]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: search names must be unique, repeated: {', '.join(duplicates)}")
+    if not searches:
+        raise ValueError(f"{path}: no searches configured")
+    return searches
+
+
+# Unbounded queue of (search name, item) handed out in weighted round-robin
+# order across searches. Same get/put/task_done/join interface as
+# asyncio.Queue, with get() returning the pair.
+class RoundRobinQueue:
+    def __init__(self, searches=()):
+        self.queues = {}
+        self.priorities = {}
+        for search in searches:
+            self.add_search(search.name, search.priority)
+        self.position = 0
+        self.taken = 0
+        self.items = asyncio.Semaphore(0)
+        self.unfinished = 0
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def add_search(self, name, priority=1):
+        if name not in self.queues:
+            self.queues[name] = deque()
+            self.priorities[name] = priority
+
+    async def put(self, search, item):
+        self.add_search(search)
+        self.queues[search].append(item)
+        self.unfinished += 1
+        self.finished.clear()
+        self.items.release()
+
+    async def get(self):
+        await self.items.acquire()
+        names = list(self.queues)
+        # At least one queue has an item, so this finds it within one round
+        while True:
+            name = names[self.position % len(names)]
+            if self.queues[name] and self.taken < self.priorities[name]:
+                self.taken += 1
+                return name, self.queues[name].popleft()
+            self.position = (self.position + 1) % len(names)
+            self.taken = 0
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+    def qsize(self):
+        return sum(len(queue) for queue in self.queues.values())
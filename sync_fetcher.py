@@ -0,0 +1,164 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+from encoding import decode_content
+from metrics import crawl_metrics
+from retries import FetchError, check_status, MAX_ATTEMPTS, BASE_DELAY, MAX_DELAY, RETRY_STATUSES
+from scheduler import MAX_PER_HOST, scheduler_limits
+
+# Shared HTTP transport for the synchronous scrapers (main.py, main2.py), the
+# counterpart of fetcher.py. One requests.Session keeps a pool of keep-alive
+# connections per host, so every page after the first reuses an open
+# TCP+TLS connection. The session also:
+# - asks for compressed responses with every encoding urllib3 can decode
+#   (gzip and deflate, plus br and zstd when brotli/zstandard are installed);
+# - gives every request a connect and a read timeout;
+# - retries connection errors, 5xx and 429 in urllib3 with exponential
+#   backoff, jitter and Retry-After, using the limits in retries.py.
+#
+# fetch() and fetch_raw() work like their async versions in fetcher.py: the
+# decoded page, or the raw body and its Content-Type, and FetchError for
+# anything that fails. fetch_many() fetches a batch of pages (the detail
+# pages of one listing page) on a thread pool.
+#
+# Requests given a ThreadScheduler keep to the same politeness limits as the
+# async scrapers: at most max_per_host at once per host and a token bucket on
+# request starts, with scheduler.py's limits (IMOT_* variables included).
+# fetch_many() always uses one.
+
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+# Connections kept open per host
+POOL_SIZE = 10
+
+# Threads for fetch_many(), at most the per-host cap
+FETCH_WORKERS = scheduler_limits()['max_per_host'] or MAX_PER_HOST
+
+
+# Thread-safe counterpart of scheduler.RequestScheduler: a semaphore per host
+# and a token bucket shared by every thread. Pass None or 0 to disable a limit.
+class ThreadScheduler:
+    def __init__(self, max_per_host=MAX_PER_HOST, requests_per_second=None, burst=None):
+        self.max_per_host = max_per_host
+        self.host_limits = {}
+        self.rate = requests_per_second
+        self.capacity = burst or max(1, int(requests_per_second or 0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_limits(cls, limits=None):
+        limits = limits or scheduler_limits()
+        return cls(limits['max_per_host'], limits['requests_per_second'], limits['burst'])
+
+    def _host_limit(self, host):
+        if not self.max_per_host:
+            return None
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_limits[host]
+
+    # Function to take a token, sleeping until it is due; a thread that has
+    # to wait reserves its token first, so waiting threads start in turn
+    def _take_token(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    # Usage: with scheduler.slot(url): ... issue the request ...
+    @contextmanager
+    def slot(self, url):
+        host_limit = self._host_limit(urlparse(url).hostname or '')
+        if host_limit is not None:
+            host_limit.acquire()
+        try:
+            self._take_token()
+            yield
+        finally:
+            if host_limit is not None:
+                host_limit.release()
+
+
+_default_scheduler = None
+
+
+# Function to return the scheduler shared by every request of this process
+def default_scheduler():
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = ThreadScheduler.from_limits()
+    return _default_scheduler
+
+
+# Function to open the shared session: pooled keep-alive connections,
+# compression and retries. Use it as a context manager to close the pool.
+def open_session(pool_size=POOL_SIZE):
+    retry = Retry(total=MAX_ATTEMPTS - 1, backoff_factor=BASE_DELAY, backoff_max=MAX_DELAY,
+                  backoff_jitter=BASE_DELAY, status_forcelist=RETRY_STATUSES, allowed_methods=('GET', 'HEAD'),
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def fetch(session, url, scheduler=None):
+    content, content_type = fetch_raw(session, url, scheduler)
+    return decode_content(content, content_type, url)
+
+
+def fetch_raw(session, url, scheduler=None):
+    try:
+        if scheduler is None:
+            content, response = _get(session, url)
+        else:
+            with scheduler.slot(url):
+                content, response = _get(session, url)
+    except requests.exceptions.RequestException as e:
+        raise FetchError(url, f"{type(e).__name__}: {e}") from e
+    crawl_metrics.add_bytes('fetch', len(content))
+    check_status(url, response.status_code)
+    return content, response.headers.get('Content-Type')
+
+
+def _get(session, url):
+    with crawl_metrics.time('fetch'):
+        response = session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        return response.content, response
+
+
+# Function to fetch several pages, on the executor's threads if one is given
+# (they share the session's connection pool), within the scheduler's limits
+# (default_scheduler() unless one is given); returns ((body, Content-Type),
+# error) for each URL in order, with one of the two None
+def fetch_many(session, urls, executor=None, scheduler=None):
+    scheduler = scheduler or default_scheduler()
+
+    def fetch_one(url):
+        try:
+            return fetch_raw(session, url, scheduler), None
+        except FetchError as e:
+            return None, e
+
+    if executor is None:
+        return [fetch_one(url) for url in urls]
+    return list(executor.map(fetch_one, urls))
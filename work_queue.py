@@ -0,0 +1,419 @@
+import asyncio
+import heapq
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+
+# Durable work queue shared by the processes of a distributed crawl (see
+# distributed.py). The coordinator puts listing pages on it; workers lease an
+# item, process it and ack it with what it produced: the detail pages found
+# on a listing page, or the record extracted from a detail page. Records are
+# kept on the queue until the coordinator collects them.
+#
+# A lease expires after its timeout. An item whose worker died or failed is
+# handed out again, up to MAX_DELIVERIES times, after which it is set aside
+# as dead. An ack on a lease that was meanwhile given to another worker is
+# refused, so every item produces its results once.
+#
+# Every item has a key, unique per kind: a page's canonical URL, an ad's adv
+# id. Putting a key that's already on the queue does nothing, which is what
+# deduplicates ads across workers and searches.
+#
+# Backends, chosen by open_queue(uri):
+#   PATH or sqlite:///PATH  SqliteWorkQueue, a file shared by processes on one host
+#   memory://               MemoryWorkQueue, an in-process stand-in
+#   http://HOST:PORT        HttpWorkQueue, a client of a queue served by serve_queue(),
+#                           for workers on other machines
+# All three have the same async interface.
+
+DEFAULT_QUEUE_PATH = 'work_queue.sqlite'
+MEMORY_URI = 'memory://'
+
+# Seconds a worker has to ack an item before it is handed to another worker
+LEASE_TIMEOUT = 120.0
+# Deliveries of one item before it is given up on
+MAX_DELIVERIES = 5
+# Seconds to wait for the queue server to answer
+REQUEST_TIMEOUT = 30.0
+# Most records returned by one results() call
+RESULTS_BATCH = 500
+
+STATES = ('pending', 'leased', 'done', 'dead')
+
+# Queue methods a served queue answers; reset() and finish_discovery() stay with the coordinator
+SERVED_METHODS = ('put', 'lease', 'ack', 'fail', 'status', 'results', 'dead_items')
+
+dump_json = partial(json.dumps, ensure_ascii=False, default=str)
+
+
+# Function to rank an item for leasing: detail pages (0) before listing pages
+# (1), so a crawl finishes the ads it found before discovering more
+def priority(kind):
+    return 1 if kind == 'page' else 0
+
+
+# Function to tell from status() whether the crawl is over: discovery has
+# finished and every item is done or dead
+def is_finished(status):
+    return status['discovered'] and not status['pending'] and not status['leased']
+
+
+class SqliteWorkQueue:
+    def __init__(self, path=DEFAULT_QUEUE_PATH, max_deliveries=MAX_DELIVERIES):
+        self.path = path
+        self.max_deliveries = max_deliveries
+        # Every call runs on this one thread: waiting up to 30s for another
+        # process's lock must not stall the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='work-queue')
+        # Transactions are explicit (BEGIN IMMEDIATE), so two processes
+        # can't lease the same item
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL,
+                                              priority INTEGER NOT NULL DEFAULT 0,
+                                              payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending',
+                                              token TEXT, worker TEXT, expires REAL,
+                                              deliveries INTEGER NOT NULL DEFAULT 0, error TEXT,
+                                              UNIQUE (kind, key));
+            CREATE TABLE IF NOT EXISTS results (seq INTEGER PRIMARY KEY, record TEXT NOT NULL);
+        ''')
+        if 'priority' not in {row[1] for row in self.db.execute('PRAGMA table_info(items)')}:
+            # Queue file written before items had a stored priority
+            self.db.execute('ALTER TABLE items ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+            self.db.execute("UPDATE items SET priority = 1 WHERE kind = 'page'")
+        # Leasing reads the first pending item in (priority, id) order straight off this index
+        self.db.executescript('''
+            DROP INDEX IF EXISTS items_state;
+            CREATE INDEX IF NOT EXISTS items_state_priority ON items (state, priority, id);
+        ''')
+
+    @contextmanager
+    def _transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def _put(self, items):
+        before = self.db.total_changes
+        self.db.executemany('INSERT OR IGNORE INTO items (kind, key, priority, payload) VALUES (?, ?, ?, ?)',
+                            ((item['kind'], item['key'], priority(item['kind']), dump_json(item['payload']))
+                             for item in items))
+        return self.db.total_changes - before
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Function to clear the queue for a new crawl
+    async def reset(self):
+        await self._run(self._reset)
+
+    def _reset(self):
+        with self._transaction():
+            self.db.execute('DELETE FROM items')
+            self.db.execute('DELETE FROM results')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('discovered', '0')")
+
+    async def finish_discovery(self):
+        await self._run(self.db.execute, "INSERT OR REPLACE INTO meta VALUES ('discovered', '1')")
+
+    # Function to add items ({'kind', 'key', 'payload'}); returns how many were new
+    async def put(self, items):
+        return await self._run(self._put_new, list(items))
+
+    def _put_new(self, items):
+        with self._transaction():
+            return self._put(items)
+
+    # Function to lease the next item, detail pages before listing pages;
+    # None when nothing is available right now
+    async def lease(self, worker, timeout=LEASE_TIMEOUT):
+        return await self._run(self._lease, worker, timeout)
+
+    def _lease(self, worker, timeout):
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction():
+            self.db.execute("UPDATE items SET state = 'dead', error = 'lease expired' "
+                            "WHERE state = 'leased' AND expires < ? AND deliveries >= ?", (now, self.max_deliveries))
+            # Two index lookups rather than one OR query, which would sort every pending row
+            rows = [self.db.execute("SELECT priority, id, kind, key, payload, deliveries FROM items "
+                                    "WHERE state = 'pending' ORDER BY priority, id LIMIT 1").fetchone(),
+                    self.db.execute("SELECT priority, id, kind, key, payload, deliveries FROM items "
+                                    "WHERE state = 'leased' AND expires < ? ORDER BY priority, id LIMIT 1",
+                                    (now,)).fetchone()]
+            rows = [row for row in rows if row is not None]
+            if not rows:
+                return None
+            _, item_id, kind, key, payload, deliveries = min(rows)
+            self.db.execute("UPDATE items SET state = 'leased', token = ?, worker = ?, expires = ?, "
+                            "deliveries = deliveries + 1 WHERE id = ?", (token, worker, now + timeout, item_id))
+        return {'id': item_id, 'kind': kind, 'key': key, 'payload': json.loads(payload), 'token': token,
+                'deliveries': deliveries + 1}
+
+    # Function to finish a leased item, storing its records and queueing the
+    # items it found; False (and nothing stored) if the lease was lost
+    async def ack(self, id, token, records=(), items=()):
+        return await self._run(self._ack, id, token, list(records), list(items))
+
+    def _ack(self, id, token, records, items):
+        with self._transaction():
+            acked = self.db.execute("UPDATE items SET state = 'done', token = NULL, expires = NULL "
+                                    "WHERE id = ? AND token = ? AND state = 'leased'", (id, token)).rowcount
+            if acked:
+                self._put(items)
+                self.db.executemany('INSERT INTO results (record) VALUES (?)',
+                                    ((dump_json(record),) for record in records))
+        return bool(acked)
+
+    # Function to give a leased item back after an error, or set it aside once it used up its deliveries
+    async def fail(self, id, token, error):
+        await self._run(self._fail, id, token, error)
+
+    def _fail(self, id, token, error):
+        with self._transaction():
+            self.db.execute("UPDATE items SET state = CASE WHEN deliveries >= ? THEN 'dead' ELSE 'pending' END, "
+                            "token = NULL, expires = NULL, error = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                            (self.max_deliveries, error, id, token))
+
+    # Item counts by state, stored records, and whether discovery has finished
+    async def status(self):
+        return await self._run(self._status)
+
+    def _status(self):
+        status = dict.fromkeys(STATES, 0)
+        status.update(self.db.execute('SELECT state, COUNT(*) FROM items GROUP BY state'))
+        status['results'] = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'discovered'").fetchone()
+        status['discovered'] = row is not None and row[0] == '1'
+        return status
+
+    # Function to return stored records after sequence number `after`, as [seq, record] pairs
+    async def results(self, after=0, limit=RESULTS_BATCH):
+        return await self._run(self._results, after, limit)
+
+    def _results(self, after, limit):
+        return [[seq, json.loads(record)] for seq, record in
+                self.db.execute('SELECT seq, record FROM results WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit))]
+
+    async def dead_items(self):
+        return await self._run(self._dead_items)
+
+    def _dead_items(self):
+        return [{'kind': kind, 'key': key, 'error': error} for kind, key, error in
+                self.db.execute("SELECT kind, key, error FROM items WHERE state = 'dead' ORDER BY id")]
+
+    async def close(self):
+        await self._run(self.db.close)
+        self.executor.shutdown()
+
+
+# In-memory stand-in with the same behaviour as SqliteWorkQueue, for a
+# crawl whose workers all run in (or are served by) one process
+class MemoryWorkQueue:
+    def __init__(self, max_deliveries=MAX_DELIVERIES):
+        self.max_deliveries = max_deliveries
+        self.items = {}
+        self.keys = {}
+        self.records = []
+        self.discovered = False
+        # Heaps of (priority, id) for pending items and (priority, id, token)
+        # for leases that expired, in the order SqliteWorkQueue leases them;
+        # an entry whose item has since moved on is skipped when it surfaces
+        self.pending = []
+        self.expired = []
+        # Heap of (expires, id, token) for every lease handed out
+        self.leases = []
+        self.counts = dict.fromkeys(STATES, 0)
+
+    async def reset(self):
+        self.items.clear()
+        self.keys.clear()
+        self.records.clear()
+        self.discovered = False
+        self.pending.clear()
+        self.expired.clear()
+        self.leases.clear()
+        self.counts = dict.fromkeys(STATES, 0)
+
+    def _set_state(self, item, state, **fields):
+        self.counts[item['state']] -= 1
+        self.counts[state] += 1
+        item.update(state=state, **fields)
+        if state == 'pending':
+            heapq.heappush(self.pending, (item['priority'], item['id']))
+
+    async def finish_discovery(self):
+        self.discovered = True
+
+    def _put(self, items):
+        added = 0
+        for item in items:
+            if (item['kind'], item['key']) in self.keys:
+                continue
+            item_id = len(self.items) + 1
+            self.keys[(item['kind'], item['key'])] = item_id
+            # Round-tripped through JSON like the other backends, so callers can't share state through it
+            self.items[item_id] = {'id': item_id, 'kind': item['kind'], 'key': item['key'],
+                                   'priority': priority(item['kind']), 'payload': dump_json(item['payload']),
+                                   'state': 'pending', 'token': None, 'expires': None, 'deliveries': 0,
+                                   'error': None}
+            self.counts['pending'] += 1
+            heapq.heappush(self.pending, (self.items[item_id]['priority'], item_id))
+            added += 1
+        return added
+
+    async def put(self, items):
+        return self._put(items)
+
+    # Function to tell whether a heap entry still stands for an item that can be leased
+    def _available(self, entry):
+        item = self.items[entry[1]]
+        if len(entry) == 2:
+            return item['state'] == 'pending'
+        return item['state'] == 'leased' and item['token'] == entry[2]
+
+    async def lease(self, worker, timeout=LEASE_TIMEOUT):
+        now = time.time()
+        while self.leases and self.leases[0][0] < now:
+            _, item_id, token = heapq.heappop(self.leases)
+            item = self.items[item_id]
+            if item['state'] != 'leased' or item['token'] != token:
+                continue
+            if item['deliveries'] >= self.max_deliveries:
+                self._set_state(item, 'dead', error='lease expired')
+            else:
+                heapq.heappush(self.expired, (item['priority'], item_id, token))
+        heaps = []
+        for heap in (self.pending, self.expired):
+            while heap and not self._available(heap[0]):
+                heapq.heappop(heap)
+            if heap:
+                heaps.append(heap)
+        if not heaps:
+            return None
+        _, item_id, *_ = heapq.heappop(min(heaps, key=lambda heap: heap[0][:2]))
+        item = self.items[item_id]
+        self._set_state(item, 'leased', token=uuid.uuid4().hex, worker=worker, expires=now + timeout,
+                        deliveries=item['deliveries'] + 1)
+        heapq.heappush(self.leases, (item['expires'], item_id, item['token']))
+        return {'id': item['id'], 'kind': item['kind'], 'key': item['key'], 'payload': json.loads(item['payload']),
+                'token': item['token'], 'deliveries': item['deliveries']}
+
+    def _leased(self, id, token):
+        item = self.items.get(id)
+        if item is None or item['state'] != 'leased' or item['token'] != token:
+            return None
+        return item
+
+    async def ack(self, id, token, records=(), items=()):
+        item = self._leased(id, token)
+        if item is None:
+            return False
+        self._set_state(item, 'done', token=None, expires=None)
+        self._put(items)
+        self.records += [json.loads(dump_json(record)) for record in records]
+        return True
+
+    async def fail(self, id, token, error):
+        item = self._leased(id, token)
+        if item is not None:
+            self._set_state(item, 'dead' if item['deliveries'] >= self.max_deliveries else 'pending',
+                            token=None, expires=None, error=error)
+
+    async def status(self):
+        status = dict(self.counts)
+        status['results'] = len(self.records)
+        status['discovered'] = self.discovered
+        return status
+
+    async def results(self, after=0, limit=RESULTS_BATCH):
+        return [[seq, record] for seq, record in enumerate(self.records[after:after + limit], after + 1)]
+
+    async def dead_items(self):
+        return [{'kind': item['kind'], 'key': item['key'], 'error': item['error']}
+                for item in self.items.values() if item['state'] == 'dead']
+
+    async def close(self):
+        pass
+
+
+# Client of a queue served by serve_queue() on another host
+class HttpWorkQueue:
+    def __init__(self, url, timeout=REQUEST_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+
+    async def _call(self, method, **arguments):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self.session.post(f"{self.url}/queue/{method}", data=dump_json(arguments),
+                                     headers={'Content-Type': 'application/json'}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def put(self, items):
+        return await self._call('put', items=items)
+
+    async def lease(self, worker, timeout=LEASE_TIMEOUT):
+        return await self._call('lease', worker=worker, timeout=timeout)
+
+    async def ack(self, id, token, records=(), items=()):
+        return await self._call('ack', id=id, token=token, records=records, items=items)
+
+    async def fail(self, id, token, error):
+        return await self._call('fail', id=id, token=token, error=error)
+
+    async def status(self):
+        return await self._call('status')
+
+    async def results(self, after=0, limit=RESULTS_BATCH):
+        return await self._call('results', after=after, limit=limit)
+
+    async def dead_items(self):
+        return await self._call('dead_items')
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+# Function to serve a queue to HttpWorkQueue clients (POST /queue/<method>
+# with the arguments as JSON) until the runner is cleaned up
+async def serve_queue(queue, port, host='127.0.0.1'):
+    async def call(request):
+        method = request.match_info['method']
+        if method not in SERVED_METHODS:
+            raise web.HTTPNotFound()
+        result = await getattr(queue, method)(**await request.json())
+        return web.json_response(result, dumps=dump_json)
+
+    app = web.Application(client_max_size=16 * 1024 ** 2)
+    app.router.add_post('/queue/{method}', call)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# Function to open the queue backend for a path, sqlite:///path, memory:// or http://host:port
+def open_queue(uri=DEFAULT_QUEUE_PATH, max_deliveries=MAX_DELIVERIES):
+    if uri == MEMORY_URI:
+        return MemoryWorkQueue(max_deliveries)
+    if uri.startswith(('http://', 'https://')):
+        return HttpWorkQueue(uri)
+    return SqliteWorkQueue(uri.removeprefix('sqlite:///'), max_deliveries)